@@ -9,3 +9,12 @@ def get_version():
 
 
 __version__ = get_version()
+
+
+def warmup(fonts=None, svgs=None, images=None):
+    '''
+    Preloads fonts, styles, the barcode library, SVG files and images before a
+    pre-forking server forks, see pdfgen.preload.warmup
+    '''
+    from pdfgen.preload import warmup
+    warmup(fonts, svgs, images)
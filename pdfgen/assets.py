@@ -0,0 +1,101 @@
+import hashlib
+import logging
+
+logger = logging.getLogger('pdfgen')
+
+# shared drawings aren't clipped, so their forms get a bounding box that is
+# much larger than any page
+FORM_BBOX = (-10000, -10000, 10000, 10000)
+
+# kinds of assets that ReportLab already stores once per document, sharing
+# them saves time but no bytes
+REPORTLAB_SHARED_KINDS = ('image',)
+
+
+def make_asset_name(kind, *key):
+    '''
+    Returns the form name for an asset of kind (for example 'svg') identified by key
+    '''
+    return 'pdfgen_%s_%s' % (kind, hashlib.sha1(repr(key)).hexdigest()[:16])
+
+
+class SharedAssets(object):
+    '''
+    The images and drawings that are stored once in a document as form XObjects
+    and drawn by reference, with how often each was drawn.
+    '''
+
+    def __init__(self):
+        # name -> [kind, size in bytes, number of times drawn, form name]
+        self.assets = {}
+
+    def draw(self, canv, name, kind, define, size=None, bbox=FORM_BBOX):
+        '''
+        Draws the form name at the origin. The first time, the form is defined by
+        calling define with the canvas. size is the number of bytes the asset
+        takes, or define returns it; by default it is the size of the form's
+        content.
+        '''
+        if name not in self.assets:
+            if not canv.hasForm(name):
+                canv.beginForm(name, *bbox)
+                size = define(canv) or size
+                if size is None:
+                    size = sum(len(i) for i in canv._code)
+                canv.endForm()
+            self.assets[name] = [kind, size or 0, 0, name]
+
+        self.assets[name][2] += 1
+        canv.doForm(self.assets[name][3])
+
+    def draw_image(self, canv, name, image, mask='auto', size=0):
+        '''
+        Draws the ImageReader image in the unit square. ReportLab stores an
+        image once per document, but it identifies the image by a digest of the
+        decoded data on every draw; after the first time this refers to the
+        image XObject by name.
+        '''
+        if name not in self.assets:
+            canv.drawImage(image, 0, 0, 1, 1, mask=mask)
+            self.assets[name] = ['image', size, 1, canv._formsinuse[-1]]
+            return
+
+        self.assets[name][2] += 1
+        canv.doForm(self.assets[name][3])
+
+    def get_report(self):
+        '''
+        Returns a dict per kind with the number of unique assets, the number of
+        times they were drawn and the bytes saved compared to drawing every
+        occurrence without SharedAssets. Nothing is saved for the kinds in
+        REPORTLAB_SHARED_KINDS.
+        '''
+        report = {}
+        for kind, size, uses, form_name in self.assets.values():
+            kind_report = report.setdefault(kind, {'unique': 0, 'uses': 0, 'bytes_saved': 0})
+            kind_report['unique'] += 1
+            kind_report['uses'] += uses
+            if kind not in REPORTLAB_SHARED_KINDS:
+                kind_report['bytes_saved'] += size * (uses - 1)
+        return report
+
+    def bytes_saved(self):
+        return sum(i['bytes_saved'] for i in self.get_report().values())
+
+    def log_report(self, canv=None):
+        for kind, kind_report in sorted(self.get_report().items()):
+            logger.info('Shared %(unique)d %(kind)s asset(s) %(uses)d times, saved %(bytes_saved)d bytes',
+                        dict(kind_report, kind=kind))
+
+
+def get_shared_assets(canv):
+    '''
+    Returns the SharedAssets of a canvas. Canvases with before_save functions
+    (see pdfgen.pagenumbers.PageCanvas) log the report when they are saved.
+    '''
+    assets = getattr(canv, 'shared_assets', None)
+    if assets is None:
+        assets = canv.shared_assets = SharedAssets()
+        if hasattr(canv, 'before_save'):
+            canv.before_save.append(assets.log_report)
+    return assets
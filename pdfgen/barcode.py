@@ -1,8 +1,179 @@
 from reportlab.platypus.flowables import Flowable
 
+from pdfgen.assets import get_shared_assets, make_asset_name
+from pdfgen.cache import LRUCache
+from pdfgen.files import check_private_dir, ensure_dir
+from pdfgen.timing import timer, PHASE_BARCODE
+
+
+class BarcodeCache(object):
+    '''
+    Cache for rendered barcodes, so the same barcode doesn't need two ghostscript
+    calls every time it is drawn.
+
+    * max_entries is the size of the in-memory LRU tier
+    * directory enables the on-disk tier when it is given, it must be private
+      to the current user, see check_private_dir
+
+    Values are tuples (width, height, png_data), where width and height are the
+    unscaled bounding box reported by ghostscript.
+    '''
+
+    def __init__(self, max_entries=1024, directory=None):
+        if directory is not None:
+            ensure_dir(directory, 0700)
+            check_private_dir(directory)
+
+        self.memory = LRUCache(max_entries)
+        self.directory = directory
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    def make_key(self, library, type, data, scale, resolution_factor):
+        import hashlib
+        import os
+
+        try:
+            mtime = os.path.getmtime(library)
+        except OSError:
+            mtime = None
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        raw_key = '\0'.join(str(i) for i in (library, mtime, type, scale, resolution_factor))
+        return hashlib.sha1(raw_key + '\0' + data).hexdigest()
+
+    def _disk_path(self, key):
+        import os
+
+        return os.path.join(self.directory, key[:2], key + '.png')
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.directory is None:
+            return value
+
+        import os
+
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            self.disk_misses += 1
+            return None
+
+        fh = open(path, 'rb')
+        try:
+            header = fh.readline()
+            png_data = fh.read()
+        finally:
+            fh.close()
+
+        try:
+            pw, ph = (float(i) for i in header.split())
+        except ValueError:
+            self.disk_misses += 1
+            return None
+
+        self.disk_hits += 1
+        value = (pw, ph, png_data)
+        self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+
+        if self.directory is None:
+            return
+
+        import os
+        import tempfile
+
+        path = self._disk_path(key)
+        directory = os.path.dirname(path)
+        ensure_dir(directory, 0700)
+
+        # write to a temporary file first and rename it, so readers never see
+        # a partially written entry
+        pw, ph, png_data = value
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        fh = os.fdopen(fd, 'wb')
+        try:
+            fh.write('%r %r\n' % (pw, ph))
+            fh.write(png_data)
+        finally:
+            fh.close()
+        os.rename(temp_path, path)
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update({
+            'disk_hits': self.disk_hits,
+            'disk_misses': self.disk_misses,
+        })
+        return stats
+
+
+# barcode.ps types that can be drawn with the vector engine, mapped to the
+# names of the ReportLab barcode widgets
+VECTOR_TYPES = {
+    'datamatrix': 'ECC200DataMatrix',
+    'qrcode': 'QR',
+    'code128': 'Code128',
+    'ean13': 'EAN13',
+    'ean8': 'EAN8',
+    'upca': 'UPCA',
+    'code39': 'Standard39',
+    'interleaved2of5': 'I2of5',
+}
+
+# the name of the barcode library asset, see pdfgen.loaders
+BARCODE_LIBRARY = 'common/pdf_img/barcode.ps'
+
+ENGINE_GHOSTSCRIPT = 'ghostscript'
+ENGINE_VECTOR = 'vector'
+
+def make_vector_drawing(type, data):
+    '''
+    Returns a ReportLab Drawing of the barcode, or None when the type isn't
+    supported by the vector engine or ReportLab can't encode the data.
+    '''
+    name = VECTOR_TYPES.get(type, None)
+    if name is None:
+        return None
+
+    try:
+        from reportlab.graphics.barcode import createBarcodeDrawing
+        return createBarcodeDrawing(name, value=data)
+    except (ImportError, KeyError, ValueError, AttributeError, UnicodeEncodeError):
+        # the widgets reject invalid values with an AttributeError, and data
+        # that isn't ASCII with a UnicodeEncodeError
+        return None
+
+
+_barcode_cache = None
+
+def get_barcode_cache():
+    '''
+    Returns the process-wide barcode cache, configured with the settings
+    PDFGEN_BARCODE_CACHE_SIZE (0 disables the cache) and PDFGEN_BARCODE_CACHE_DIR.
+    '''
+    global _barcode_cache
+
+    if _barcode_cache is None:
+        from django.conf import settings
+
+        size = getattr(settings, 'PDFGEN_BARCODE_CACHE_SIZE', 1024)
+        if not size:
+            return None
+        _barcode_cache = BarcodeCache(size, getattr(settings, 'PDFGEN_BARCODE_CACHE_DIR', None))
+    return _barcode_cache
+
 
 class Barcode(Flowable):
-    def __init__(self, library, width, height, data, scale=1, type='datamatrix', align='left'):
+    def __init__(self, library, width, height, data, scale=1, type='datamatrix', align='left', pool=None, engine=ENGINE_GHOSTSCRIPT):
         '''
         Creates a Barcode Flowable
         
@@ -11,6 +182,10 @@ class Barcode(Flowable):
         * scale allows you to resize the barcode (default 1)
         * type is the type of the barcode (default 'datamatrix'). 
           Other types can be found in media/common/pdf_img/barcode.ps
+        * pool is the GhostscriptPool to render with (default: the pool for the
+          library when PDFGEN_GS_POOL_SIZE is set, otherwise run gs for every barcode)
+        * engine is either 'ghostscript' (default) or 'vector'. The vector engine draws
+          the types in VECTOR_TYPES as paths, other types fall back to ghostscript.
         '''
         
         Flowable.__init__(self)
@@ -24,9 +199,23 @@ class Barcode(Flowable):
         self.hAlign = 'CENTER'
         self.library = library
         self.align = align
-        
+        self.pool = pool
+        self.engine = engine
     
-    def draw(self):
+    @timer(PHASE_BARCODE)
+    def render(self):
+        '''
+        Renders the barcode with ghostscript.
+
+        Returns a tuple (width, height, png_data) with the unscaled bounding box,
+        or None when the barcode couldn't be rendered.
+        '''
+        from pdfgen.ghostscript import get_ghostscript_pool
+
+        pool = self.pool or get_ghostscript_pool(self.library)
+        if pool is not None:
+            return pool.render(self.type, self.data, self.scale, self.resolution_factor)
+
         import subprocess
         import tempfile
         import os
@@ -46,29 +235,28 @@ class Barcode(Flowable):
         res = 72 * self.resolution_factor * self.scale # DPI resolution
         type = self.type
         
+        try:
+            bbox_proc = subprocess.Popen(['gs',
+                                          '-sDEVICE=bbox',
+                                          '-sBARCODEDATA=%(data)s' % locals(),
+                                          '-dBARCODETYPE=/%(type)s' % locals(),
+                                          '-q',
+                                          '-dNOPAUSE',
+                                          '-dBATCH',
+                                          '-dSAFER',
+                                          '-r%(res)d' % locals(),
+                                          barcode_path],
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          )
         
-        bbox_proc = subprocess.Popen(['gs', 
-                                      '-sDEVICE=bbox',
-                                      '-sBARCODEDATA=%(data)s' % locals(),
-                                      '-dBARCODETYPE=/%(type)s' % locals(),
-                                      '-q',
-                                      '-dNOPAUSE',
-                                      '-dBATCH',
-                                      '-dSAFER',
-                                      '-r%(res)d' % locals(),
-                                      barcode_path],
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE,
-                                      )
+            raw_bbox = bbox_proc.communicate()
+            if len(raw_bbox[0]) or not len(raw_bbox[1]):
+                return None
         
-        raw_bbox = bbox_proc.communicate()
-        if not len(raw_bbox[0]) and len(raw_bbox[1]):
             bbox = (float(i) for i in raw_bbox[1].splitlines()[1].split()[3:])
             pw, ph = bbox
             
-            bbox_w = pw * self.scale
-            bbox_h = ph * self.scale
-            
             temp_w = pw * self.scale * self.resolution_factor
             temp_h = ph * self.scale * self.resolution_factor
             
@@ -85,23 +273,99 @@ class Barcode(Flowable):
                                       '-r%(res)d' % locals(),
                                       barcode_path])
             
-            if os.path.exists(temp_png):
-                if self.align == 'left':
-                    x = 0
-                elif self.align == 'center':
-                    x = (self.width - bbox_w) / 2.0
-                else:
-                    x = self.width - bbox_w
-                y = self.height - bbox_h
-                if y < 0:
-                    y = 0
-                self.canv.drawImage(temp_png, x, y, width=bbox_w, height=bbox_h if bbox_h < self.height else self.height)
-                os.unlink(temp_png)
+            if not os.path.exists(temp_png):
+                return None
                 
-            else:
-                self.canv.line(0, 0, self.width, self.height)
+            fh = open(temp_png, 'rb')
+            png_data = fh.read()
+            fh.close()
+            os.unlink(temp_png)
+
+            return pw, ph, png_data
+        finally:
+            placeholder.close()
+
+    def get_position(self, bbox_w, bbox_h):
+        if self.align == 'left':
+            x = 0
+        elif self.align == 'center':
+            x = (self.width - bbox_w) / 2.0
         else:
+            x = self.width - bbox_w
+        y = self.height - bbox_h
+        if y < 0:
+            y = 0
+        return x, y
+
+    def draw_vector(self, drawing):
+        '''
+        Draws the drawing with self.scale, scaled down to fit in the flowable
+        when it is larger
+        '''
+        from reportlab.graphics import renderPDF
+
+        scale = self.scale
+        if drawing.width * scale > self.width > 0:
+            scale = float(self.width) / drawing.width
+        if drawing.height * scale > self.height > 0:
+            scale = float(self.height) / drawing.height
+
+        bbox_w = drawing.width * scale
+        bbox_h = drawing.height * scale
+        x, y = self.get_position(bbox_w, bbox_h)
+
+        self.canv.saveState()
+        self.canv.translate(x, y)
+        self.canv.scale(scale, scale)
+        renderPDF.draw(drawing, self.canv, 0, 0)
+        self.canv.restoreState()
+
+    def get_asset_name(self):
+        return make_asset_name('barcode', self.engine, self.library, self.type, self.data, self.scale,
+                               self.resolution_factor, self.width, self.height, self.align)
+
+    def draw(self):
+        '''
+        Draws the barcode. Every unique barcode is drawn once per document in a
+        form XObject, other occurrences refer to it.
+        '''
+        get_shared_assets(self.canv).draw(self.canv, self.get_asset_name(), 'barcode',
+                                          lambda canv: self.draw_barcode())
+
+    def draw_barcode(self):
+        '''
+        Draws the barcode on the canvas, returns the size of the PNG image for
+        barcodes rendered with ghostscript.
+        '''
+        from cStringIO import StringIO
+        from reportlab.lib.utils import ImageReader
+
+        if self.engine == ENGINE_VECTOR:
+            drawing = make_vector_drawing(self.type, self.data)
+            if drawing is not None:
+                self.draw_vector(drawing)
+                return None
+
+        cache = get_barcode_cache()
+
+        rendered = None
+        if cache is not None:
+            key = cache.make_key(self.library, self.type, self.data, self.scale, self.resolution_factor)
+            rendered = cache.get(key)
+
+        if rendered is None:
+            rendered = self.render()
+            if rendered is not None and cache is not None:
+                cache.set(key, rendered)
+
+        if rendered is None:
             self.canv.line(0, 0, self.width, self.height)
-        
-        placeholder.close()
+            return None
+
+        pw, ph, png_data = rendered
 
+        bbox_w = pw * self.scale
+        bbox_h = ph * self.scale
+        x, y = self.get_position(bbox_w, bbox_h)
+        self.canv.drawImage(ImageReader(StringIO(png_data)), x, y, width=bbox_w, height=bbox_h if bbox_h < self.height else self.height)
+        return len(png_data)
@@ -0,0 +1,499 @@
+'''
+Benchmark suite for the parsers and the build pipeline, run it with the
+pdfgen_benchmark management command.
+
+Synthetic CLTR and XML documents of several kinds and sizes are rendered in a
+temporary MEDIA_ROOT and template directory, with a stub gs on the PATH so
+barcodes are rendered without ghostscript.
+'''
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+KIND_PARAGRAPHS = 'paragraphs'
+KIND_TABLES = 'tables'
+KIND_GRAPHICS = 'graphics'
+KIND_BARCODES = 'barcodes'
+KINDS = (KIND_PARAGRAPHS, KIND_TABLES, KIND_GRAPHICS, KIND_BARCODES)
+# CLTR documents for the tokenizer benchmarks, with paragraphs, table cells
+# and [[[block]]] blocks
+KIND_BLOCKS = 'blocks'
+
+FORMATS = ('cltr', 'xml')
+
+# the sizes of the documents of every kind when no sizes are given, barcodes
+# run gs (the stub) twice for every unique barcode
+DEFAULT_SIZES = {
+    KIND_PARAGRAPHS: (10, 100, 1000),
+    KIND_TABLES: (10, 100, 1000),
+    KIND_GRAPHICS: (10, 100, 500),
+    KIND_BARCODES: (1, 10, 50),
+}
+
+SVG = '''<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100" viewBox="0 0 100 100">
+  <rect x="5" y="5" width="90" height="90" fill="#336699" stroke="#000000" stroke-width="2"/>
+  <circle cx="50" cy="50" r="30" fill="#ffcc00"/>
+  <polygon points="20,80 50,20 80,80" fill="none" stroke="#ffffff" stroke-width="3"/>
+</svg>
+'''
+
+GS_STUB = '''#!%(python)s
+# stub of ghostscript for the pdfgen benchmarks, it reports a fixed bounding box
+# and writes a fixed PNG instead of rendering the barcode
+import sys
+
+PNG = %(png)r
+
+args = sys.argv[1:]
+if '-sDEVICE=bbox' in args:
+    sys.stderr.write('%%%%BoundingBox: 0 0 72 72\\n%%%%HiResBoundingBox: 0.0 0.0 72.0 72.0\\n')
+else:
+    for arg in args:
+        if arg.startswith('-sOutputFile='):
+            fh = open(arg[len('-sOutputFile='):], 'wb')
+            fh.write(PNG)
+            fh.close()
+'''
+
+
+def make_png(width, height):
+    '''
+    Returns the data of a grayscale PNG image with a gradient
+    '''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    rows = ''.join('\0' + ''.join(chr((x + y) * 255 // (width + height)) for x in xrange(width)) for y in xrange(height))
+    return ''.join(['\x89PNG\r\n\x1a\n',
+                    chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)),
+                    chunk('IDAT', zlib.compress(rows)),
+                    chunk('IEND', '')])
+
+
+def make_cltr_document(kind, size):
+    '''
+    Generates a CLTR document of kind with size paragraphs, table rows,
+    graphics, barcodes or blocks
+    '''
+    parts = ["~D[A4;cm;2,2,2,2]{{ title }}\n$bold = Normal + {'font-family': 'Helvetica-Bold'}"]
+
+    if kind == KIND_PARAGRAPHS:
+        for i in xrange(size):
+            parts.append('Paragraph %d with some <b>bold</b> and <i>italic</i> text, long enough '
+                         'to be wrapped over a few lines by the layout of the frame.' % i)
+    elif kind == KIND_TABLES:
+        parts.append('~L[1;0]\n~T[4|4|4|4]<\n~T$0,0:-1,-1$border-bottom$0.5$#000000\n~T$0,0:-1,0$background$#cccccc')
+        rows = ['[$bold Label$|$bold Amount$|$bold Date$|$bold Note$]']
+        for i in xrange(size):
+            rows.append('[Label %d|%d.50|2013-01-%02d|Note with \\| an escaped pipe]' % (i, i, i % 28 + 1))
+        parts.append('\n'.join(rows))
+    elif kind == KIND_GRAPHICS:
+        parts.append('~V[icon;0.5;2;2;bench/icon.svg]\n~I[logo;2;2;bench/logo.png]')
+        for i in xrange(size):
+            parts.append('Graphic %d' % i)
+            parts.append('~V[icon]' if i % 2 else '~I[logo]')
+    elif kind == KIND_BARCODES:
+        for i in xrange(size):
+            parts.append('~C[code%d;datamatrix;1;3;3;PDFGEN-%06d]' % (i, i))
+            parts.append('~C[code%d]' % i)
+    elif kind == KIND_BLOCKS:
+        for i in xrange(size):
+            parts.append('Paragraph %d with some <b>bold</b> text,\nspread over two lines.' % i)
+            parts.append('[Label %d|Value|$bold 12.50$]\n[Escaped \\| pipe|Value|Other]' % i)
+            parts.append('[[[block\nBlock %d\n\nwith an empty line]]]' % i)
+    else:
+        raise ValueError('Unknown document kind %r' % kind)
+
+    return '\n\n'.join(parts)
+
+
+def make_xml_document(kind, size):
+    '''
+    Generates an XML document, see make_cltr_document
+    '''
+    parts = ['<doc format="A4" margin="2cm,2cm,2cm,2cm" title="{{ title }}">',
+             '<style name="bold" base="Normal" font-family="Helvetica-Bold"/>']
+
+    if kind == KIND_PARAGRAPHS:
+        for i in xrange(size):
+            parts.append('<p>Paragraph %d with some <b>bold</b> and <i>italic</i> text, long enough '
+                         'to be wrapped over a few lines by the layout of the frame.</p>' % i)
+    elif kind == KIND_TABLES:
+        parts.append('<table cols="4cm,4cm,4cm,4cm" large="1" repeat-rows="1">')
+        parts.append('<tstyle area="0,0:-1,-1" border-bottom="0.5pt,#000000"/>')
+        parts.append('<tstyle area="0,0:-1,0" background="#cccccc"/>')
+        parts.append('<tr><td><div style="bold"><p>Label</p></div></td><td><p>Amount</p></td><td><p>Date</p></td><td><p>Note</p></td></tr>')
+        for i in xrange(size):
+            parts.append('<tr><td><p>Label %d</p></td><td><p>%d.50</p></td><td><p>2013-01-%02d</p></td><td><p>Note</p></td></tr>' % (i, i, i % 28 + 1))
+        parts.append('</table>')
+    elif kind == KIND_GRAPHICS:
+        for i in xrange(size):
+            parts.append('<p>Graphic %d</p>' % i)
+            if i % 2:
+                parts.append('<vector src="bench/icon.svg" width="2cm" height="2cm" scale="0.5"/>')
+            else:
+                parts.append('<img src="bench/logo.png" width="2cm" height="2cm"/>')
+    elif kind == KIND_BARCODES:
+        for i in xrange(size):
+            parts.append('<barcode type="datamatrix" value="PDFGEN-%06d" width="3cm" height="3cm"/>' % i)
+    else:
+        raise ValueError('Unknown document kind %r' % kind)
+
+    parts.append('</doc>')
+    return '\n'.join(parts)
+
+
+def make_document(format, kind, size):
+    if format == 'xml':
+        return make_xml_document(kind, size)
+    return make_cltr_document(kind, size)
+
+
+def make_mixed_document(format, index):
+    '''
+    Generates a document with paragraphs in a TrueType font, a footer with page
+    numbers, SVG graphics, images, and barcodes rendered with ghostscript and as
+    vectors. Documents with a different index have a different content and
+    number of pages.
+    '''
+    paragraphs = ['Paragraph %d of document %d, with text in the TrueType font that is long '
+                  'enough to be wrapped over a few lines.' % (i, index) for i in xrange(10 + 10 * index)]
+
+    if format == 'xml':
+        parts = ['<doc format="A4" margin="2cm,2cm,2cm,2cm" title="Mixed %d">' % index,
+                 '<font name="BenchVera" src="bench/vera"/>',
+                 '<style name="vera" base="Normal" font-family="BenchVera"/>',
+                 '<footer align="right">Document %d, page {page} of {pages}</footer>' % index,
+                 '<div style="vera">']
+        parts += ['<p>%s</p>' % i for i in paragraphs]
+        parts += ['</div>',
+                  '<vector src="bench/icon.svg" width="2cm" height="2cm" scale="0.5"/>',
+                  '<img src="bench/logo.png" width="2cm" height="2cm"/>',
+                  '<barcode type="datamatrix" value="MIXED-%d" width="3cm" height="3cm"/>' % index,
+                  '<barcode type="qrcode" engine="vector" value="MIXED-%d" width="3cm" height="3cm"/>' % index,
+                  '</doc>']
+        return '\n'.join(parts)
+
+    parts = ["~D[A4;cm;2,2,2,2]Mixed %d\n~F[BenchVera;bench/vera]\n$vera = Normal + {'font-family': 'BenchVera'}\n$vera" % index,
+             '~H[bottom;right]Document %d, page {page} of {pages}' % index]
+    parts += paragraphs
+    parts += ['~V[icon;0.5;2;2;bench/icon.svg]\n~I[logo;2;2;bench/logo.png]\n'
+              '~C[code;datamatrix;1;3;3;MIXED-%d]\n~C[qr;qrcode@vector;1;3;3;MIXED-%d]' % (index, index),
+              '~V[icon]', '~I[logo]', '~C[code]', '~C[qr]']
+    return '\n\n'.join(parts)
+
+
+def make_mixed_documents(count):
+    '''
+    Returns a list of count (format, document) tuples of every format, see
+    make_mixed_document
+    '''
+    return [(FORMATS[i % len(FORMATS)], make_mixed_document(FORMATS[i % len(FORMATS)], i)) for i in xrange(count)]
+
+
+def read_font(name):
+    '''
+    Returns the data of a font that is distributed with ReportLab
+    '''
+    import reportlab
+
+    fh = open(os.path.join(os.path.dirname(reportlab.__file__), 'fonts', name), 'rb')
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+class BenchmarkEnvironment(object):
+    '''
+    A temporary MEDIA_ROOT with the SVG, image and barcode library used by the
+    documents, a template directory and a stub gs. Use it as a context manager,
+    it overrides the settings and PATH while it is active.
+    '''
+
+    def __init__(self):
+        self.root = None
+        self.settings_override = None
+        self.old_path = None
+
+    def write(self, path, data):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fh = open(path, 'wb')
+        fh.write(data)
+        fh.close()
+        return path
+
+    def add_template(self, format, kind, size):
+        '''
+        Writes the document as a template, returns the template name
+        '''
+        template_name = 'bench/%s-%d.%s' % (kind, size, format)
+        self.write(os.path.join('templates', template_name), make_document(format, kind, size))
+        return template_name
+
+    def __enter__(self):
+        from django.test.utils import override_settings
+
+        self.root = tempfile.mkdtemp(prefix='pdfgen-benchmark-')
+        self.write('media/bench/icon.svg', SVG)
+        self.write('media/bench/logo.png', make_png(64, 64))
+        self.write('media/common/pdf_img/barcode.ps', '% stub barcode library\n')
+        self.write('media/bench/vera.ttf', read_font('Vera.ttf'))
+        gs = self.write('bin/gs', GS_STUB % {'python': sys.executable, 'png': make_png(72, 72)})
+        os.chmod(gs, 0755)
+
+        self.old_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = os.path.dirname(gs) + os.pathsep + self.old_path
+
+        self.settings_override = override_settings(MEDIA_ROOT=os.path.join(self.root, 'media') + os.sep,
+                                                   TEMPLATE_DIRS=(os.path.join(self.root, 'templates'),),
+                                                   # the stub only implements the command line interface
+                                                   PDFGEN_GS_POOL_SIZE=0)
+        self.settings_override.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.settings_override.disable()
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def clear_caches():
+    '''
+    Empties the in-process caches, so every run renders from scratch
+    '''
+    from pdfgen.styles import get_style_cache
+    from pdfgen.svg import get_svg_cache
+    from pdfgen.images import get_image_cache
+    from pdfgen.barcode import get_barcode_cache
+    from pdfgen.paragraphs import get_paragraph_cache, clear_word_widths
+
+    for cache in (get_style_cache(), get_svg_cache(), get_image_cache(), get_barcode_cache(), get_paragraph_cache()):
+        if cache is not None:
+            cache.clear()
+    clear_word_widths()
+
+
+def best_of(repeat, func):
+    '''
+    Calls func repeat times, returns a dict with the fastest time of every
+    function func returns timings for
+    '''
+    best = {}
+    for i in xrange(repeat):
+        for name, seconds in func():
+            if name not in best or seconds < best[name]:
+                best[name] = seconds
+    return best
+
+
+def time_call(name, func, *args):
+    '''
+    Calls func with args, returns its timing for best_of
+    '''
+    start = time.time()
+    func(*args)
+    return [(name, time.time() - start)]
+
+
+def time_split_ignore(buffer):
+    from pdfgen.parser import split_ignore
+
+    return time_call('split_ignore', split_ignore, buffer, '\n\n', '[[[block', ']]]')
+
+
+def time_parser(format, buffer, cold=False):
+    from pdfgen.shortcuts import get_parser
+
+    if cold:
+        clear_caches()
+    parser = get_parser('benchmark.' + format)
+    start = time.time()
+    parts = parser.parse_parts(buffer)
+    parsed = time.time()
+    parser.merge_parts(parts)
+    return [('parse_parts', parsed - start), ('merge_parts', time.time() - parsed)]
+
+
+def time_shortcuts(template_name, cold=False):
+    from django.template.context import Context
+    from pdfgen.shortcuts import render_to_pdf_data, render_to_pdf_download, multiple_contexts_to_pdf_data
+
+    context = {'title': 'Benchmark'}
+    timings = []
+
+    if cold:
+        clear_caches()
+    start = time.time()
+    render_to_pdf_data(template_name, context)
+    timings.append(('render_to_pdf_data', time.time() - start))
+
+    if cold:
+        clear_caches()
+    start = time.time()
+    render_to_pdf_download(template_name, context)
+    timings.append(('render_to_pdf_download', time.time() - start))
+
+    if cold:
+        clear_caches()
+    start = time.time()
+    multiple_contexts_to_pdf_data(template_name, [dict(context, title='Part %d' % i) for i in xrange(3)], Context())
+    timings.append(('multiple_contexts_to_pdf_data', time.time() - start))
+
+    return timings
+
+
+def render_document(format, buffer):
+    '''
+    Renders the document without the creation date and random document id, so
+    the output only depends on the document
+    '''
+    from pdfgen.shortcuts import get_parser
+
+    parser = get_parser('benchmark.' + format)
+    parser.invariant = 1
+    return parser.parse(buffer)
+
+
+def render_concurrently(documents, threads, repeat=2):
+    '''
+    Renders every (format, document) tuple repeat times with a pool of threads,
+    and once more serially. Returns the indexes of the documents whose
+    concurrent output differs from their serial output, an empty list when
+    concurrent rendering is correct. The caches are emptied before both runs.
+    '''
+    from multiprocessing.pool import ThreadPool
+
+    jobs = [i for j in xrange(repeat) for i in xrange(len(documents))]
+
+    clear_caches()
+    pool = ThreadPool(threads)
+    try:
+        outputs = pool.map(lambda i: render_document(*documents[i]), jobs, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    clear_caches()
+    serial = [render_document(format, buffer) for format, buffer in documents]
+
+    return sorted(set(i for i, output in zip(jobs, outputs) if output != serial[i]))
+
+
+def run_suite(sizes, kinds=KINDS, formats=FORMATS, repeat=3, cold=False, report=None):
+    '''
+    Runs the benchmarks, returns a list of result dicts with the keys format,
+    kind, size, function, bytes and seconds (the fastest of repeat runs).
+    report is called with every result as soon as it is measured. When sizes
+    is None, every kind is run with its DEFAULT_SIZES.
+    '''
+    from django.template.loader import render_to_string
+
+    results = []
+    with BenchmarkEnvironment() as environment:
+        for format in formats:
+            for kind in kinds:
+                for size in (sizes or DEFAULT_SIZES[kind]):
+                    template_name = environment.add_template(format, kind, size)
+                    buffer = render_to_string(template_name, {'title': 'Benchmark'})
+
+                    best = {}
+                    if format == 'cltr':
+                        best.update(best_of(repeat, lambda: time_split_ignore(buffer)))
+                    best.update(best_of(repeat, lambda: time_parser(format, buffer, cold)))
+                    best.update(best_of(repeat, lambda: time_shortcuts(template_name, cold)))
+
+                    for function in ('split_ignore', 'parse_parts', 'merge_parts', 'render_to_pdf_data',
+                                     'render_to_pdf_download', 'multiple_contexts_to_pdf_data'):
+                        if function not in best:
+                            continue
+                        result = {
+                            'format': format,
+                            'kind': kind,
+                            'size': size,
+                            'function': function,
+                            'bytes': len(buffer),
+                            'seconds': best[function],
+                        }
+                        results.append(result)
+                        if report is not None:
+                            report(result)
+    return results
+
+
+def get_environment_info():
+    '''
+    Returns the versions and revision the results were measured with
+    '''
+    import platform
+    import subprocess
+    import reportlab
+    import django
+    import pdfgen
+
+    try:
+        revision = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(pdfgen.__file__)),
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        revision = None
+
+    return {
+        'revision': revision,
+        'pdfgen': pdfgen.__version__,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'reportlab': reportlab.Version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def result_key(result):
+    return '%(format)s/%(kind)s/%(size)d/%(function)s' % result
+
+
+def save_results(path, results, cold=False):
+    '''
+    Writes the results to path as JSON, together with get_environment_info
+    '''
+    import json
+
+    data = {
+        'environment': get_environment_info(),
+        'cold': cold,
+        'results': results,
+    }
+    fh = open(path, 'w')
+    json.dump(data, fh, indent=2, sort_keys=True)
+    fh.close()
+
+
+def load_results(path):
+    import json
+
+    fh = open(path)
+    try:
+        return json.load(fh)
+    finally:
+        fh.close()
+
+
+def compare_results(old, new):
+    '''
+    Returns a list of (key, old seconds, new seconds, ratio) for the results in
+    both old and new, ratio is new / old
+    '''
+    old_seconds = dict((result_key(i), i['seconds']) for i in old['results'])
+    comparison = []
+    for result in new['results']:
+        key = result_key(result)
+        if key in old_seconds:
+            ratio = result['seconds'] / old_seconds[key] if old_seconds[key] else None
+            comparison.append((key, old_seconds[key], result['seconds'], ratio))
+    return comparison
@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A small thread-safe LRU cache
+
+    * max_size is the limit for the cache (number of entries, or the total
+      of the sizes returned by sizeof when it is given)
+    * sizeof is an optional function that returns the size of a value
+    '''
+
+    def __init__(self, max_size=128, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _size_of(self, value):
+        if self.sizeof is None:
+            return 1
+        return self.sizeof(value)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self.hits += 1
+                value = self._data.pop(key)
+                self._data[key] = value
+                return value
+            self.misses += 1
+            return default
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        size = self._size_of(value)
+        if size > self.max_size:
+            # never store values that would flush the entire cache
+            return
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self.size -= self._size_of(self._data.pop(key))
+            self._data[key] = value
+            self.size += size
+            while self.size > self.max_size and self._data:
+                old_key, old_value = self._data.popitem(last=False)
+                self.size -= self._size_of(old_value)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._data),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
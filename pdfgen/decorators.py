@@ -6,10 +6,10 @@ from django.http import HttpResponse
 
 from functools import wraps
 
-from pdfgen.parser import Parser
 from pdfgen.shortcuts import render_to_pdf_download, multiple_templates_to_pdf_download
+from pdfgen.timing import collect_timings, format_server_timing
 
-def pdf_download(default_template_name, default_file_name=None, default_context=None):
+def pdf_download(default_template_name, default_file_name=None, default_context=None, streaming=False, background=False, cache_timeout=None, server_timing=False):
     """
     Based on templatable_view from Jonathan Slenders
     
@@ -19,6 +19,19 @@ def pdf_download(default_template_name, default_file_name=None, default_context=
     - Render the template. Use the default template if none was passed to the view.
     - Convert the template to PDF and return as download.
 
+    With streaming=True the PDF is written to a temporary file and streamed
+    to the client, instead of being buffered in memory.
+
+    With background=True the PDF is queued as a job for the pdfgen_worker
+    command, and the view returns 202 with the job URL in the Location header.
+    The context must be picklable, context processors are not applied.
+
+    With cache_timeout the rendered PDF is cached and served with an ETag,
+    conditional requests get a 304 without building the PDF again.
+
+    With server_timing=True the response gets a Server-Timing header with the
+    time spent in every phase of rendering the template and building the PDF.
+
     The decorated view should return either:
     - a context dictionary; or
     - a tuple (template_name, context dictionary); or
@@ -68,10 +81,22 @@ def pdf_download(default_template_name, default_file_name=None, default_context=
                 # otherwise, just return the HttpResponseRedirect or whatever the view returned
                 return view_result
             
-            if isinstance(template_name, list):
-                response = multiple_templates_to_pdf_download(template_name, context, context_instance=RequestContext(request), filename=file_name)
-            else:
-                response = render_to_pdf_download(template_name, context, context_instance=RequestContext(request), filename=file_name)
+            with collect_timings() as timings:
+                if background:
+                    from django.core.urlresolvers import reverse
+                    from pdfgen import jobs
+                
+                    job_id = jobs.submit(template_name, context, file_name, owner=jobs.get_request_owner(request))
+                    response = HttpResponse(status=202)
+                    response['Location'] = reverse('pdfgen_job', args=[job_id])
+                elif isinstance(template_name, list):
+                    response = multiple_templates_to_pdf_download(template_name, context, context_instance=RequestContext(request), filename=file_name, streaming=streaming)
+                else:
+                    response = render_to_pdf_download(template_name, context, context_instance=RequestContext(request), filename=file_name, streaming=streaming,
+                                                      cache_timeout=cache_timeout, request=request)
+            
+            if server_timing:
+                response['Server-Timing'] = format_server_timing(timings)
             
             return response
             
@@ -0,0 +1,38 @@
+import os
+import stat
+import tempfile
+
+
+def ensure_dir(directory, mode=0777):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, mode)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def check_private_dir(directory):
+    '''
+    Raises an IOError unless directory is a directory (not a symlink) owned by
+    the current user, that other users can't access
+    '''
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise IOError('%s is not a directory' % directory)
+    if hasattr(os, 'getuid') and (info.st_uid != os.getuid() or info.st_mode & 0077):
+        raise IOError('%s must be owned by the current user and not accessible by others' % directory)
+
+
+def get_private_dir(name):
+    '''
+    Returns the directory name in the temporary directory, it is created for the
+    current user only and checked with check_private_dir, because other users
+    can write to the temporary directory too.
+    '''
+    if hasattr(os, 'getuid'):
+        name = '%s-%d' % (name, os.getuid())
+    directory = os.path.join(tempfile.gettempdir(), name)
+    ensure_dir(directory, 0700)
+    check_private_dir(directory)
+    return directory
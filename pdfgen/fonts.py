@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger('pdfgen')
+
+
+class FontRegistry(object):
+    '''
+    Registers fonts with ReportLab once per process.
+
+    Fonts are given as a base name of an asset (see pdfgen.loaders). TrueType
+    fonts are found as <base name>.ttf and are subsetted per document by
+    ReportLab, Type 1 fonts need both <base name>.afm and <base name>.pfb.
+
+    Fonts that fail to load are tried again after retry_interval seconds, by
+    default PDFGEN_FONT_RETRY_INTERVAL (60).
+    '''
+
+    def __init__(self, retry_interval=None):
+        # face name -> True when registered, or the time loading it failed
+        self.fonts = {}
+        self.timings = {}
+        self.errors = {}
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+
+    def get_retry_interval(self):
+        if self.retry_interval is None:
+            from django.conf import settings
+
+            return getattr(settings, 'PDFGEN_FONT_RETRY_INTERVAL', 60)
+        return self.retry_interval
+
+    def is_known(self, face_name):
+        '''
+        Returns True when the font is registered, False when it failed less than
+        the retry interval ago, and None when it should be loaded
+        '''
+        state = self.fonts.get(face_name, None)
+        if state is None or state is True:
+            return state
+        if time.time() - state < self.get_retry_interval():
+            return False
+        return None
+
+    def load(self, base_name, face_name, loader=None):
+        from reportlab.pdfbase import pdfmetrics
+        from pdfgen.loaders import get_asset_loader
+
+        loader = loader or get_asset_loader()
+
+        if base_name.lower().endswith('.ttf'):
+            ttf = base_name
+        else:
+            ttf = base_name + '.ttf'
+
+        if loader.exists(ttf):
+            from reportlab.pdfbase.ttfonts import TTFont
+            pdfmetrics.registerFont(TTFont(face_name, loader.get_local_path(ttf)))
+        else:
+            face = pdfmetrics.EmbeddedType1Face(loader.get_local_path(base_name + '.afm'),
+                                                loader.get_local_path(base_name + '.pfb'))
+
+            pdfmetrics.registerTypeFace(face)
+            font = pdfmetrics.Font(face_name, face_name, 'WinAnsiEncoding')
+            pdfmetrics.registerFont(font)
+
+    def register(self, base_name, face_name, loader=None):
+        '''
+        Registers the font, returns True when it is available.
+        '''
+        known = self.is_known(face_name)
+        if known is not None:
+            return known
+
+        self.lock.acquire()
+        try:
+            known = self.is_known(face_name)
+            if known is not None:
+                return known
+
+            start = time.time()
+            try:
+                self.load(base_name, face_name, loader)
+            except Exception, e:
+                logger.error('Failed to load font %s from %s: %s', face_name, base_name, e)
+                self.errors[face_name] = e
+                self.fonts[face_name] = time.time()
+            else:
+                self.errors.pop(face_name, None)
+                self.fonts[face_name] = True
+            self.timings[face_name] = time.time() - start
+            logger.debug('Loaded font %s in %.3fs', face_name, self.timings[face_name])
+
+            return self.fonts[face_name] is True
+        finally:
+            self.lock.release()
+
+    def preload(self, fonts=None):
+        '''
+        Registers the fonts in PDFGEN_FONTS, a list of (face name, base name) tuples.
+        '''
+        if fonts is None:
+            from django.conf import settings
+            fonts = getattr(settings, 'PDFGEN_FONTS', ())
+
+        for face_name, base_name in fonts:
+            self.register(base_name, face_name)
+
+
+font_registry = FontRegistry()
+
+def import_pdf_font(base_name, face_name, loader=None):
+    return font_registry.register(base_name, face_name, loader)
+
+def preload_fonts(fonts=None):
+    font_registry.preload(fonts)
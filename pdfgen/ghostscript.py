@@ -0,0 +1,334 @@
+import os
+import re
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+
+# Every job runs the preloaded library twice inside a save/restore: once on a
+# fresh bbox device to measure the barcode, and once on a fresh pngalpha device
+# sized to that bounding box. The results are reported on stdout.
+JOB_TEMPLATE = '''
+/pdfgen_save save def
+{
+    userdict begin
+    /BARCODEDATA %(data)s def
+    /BARCODETYPE /%(type)s def
+    (bbox) finddevice copydevice setdevice
+    /showpage { } def
+    pdfgen_library
+    currentdevice getdeviceprops
+    counttomark 2 idiv dup dict begin { def } repeat pop
+    /PageBoundingBox load end
+    aload pop /pdfgen_h exch def /pdfgen_w exch def pop pop
+    userdict /showpage undef
+    mark
+    /OutputFile %(output)s
+    /HWResolution [%(res)d %(res)d]
+    /HWSize [pdfgen_w %(factor)s mul cvi pdfgen_h %(factor)s mul cvi]
+    (pngalpha) finddevice copydevice putdeviceprops setdevice
+    pdfgen_library
+    nulldevice
+    (PDFGEN-BBOX ) print
+    pdfgen_w 32 string cvs print ( ) print
+    pdfgen_h 32 string cvs print (\\n) print
+} stopped { (PDFGEN-ERROR\\n) print } if
+clear cleardictstack
+pdfgen_save restore
+(PDFGEN-DONE\\n) print flush
+'''
+
+# barcode types are pasted into the job as PostScript names
+TYPE_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+def ps_string(value):
+    '''
+    Encodes value as a PostScript string literal
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    chars = []
+    for c in value:
+        if c in '()\\':
+            chars.append('\\' + c)
+        elif ' ' <= c <= '~':
+            chars.append(c)
+        else:
+            chars.append('\\%03o' % ord(c))
+    return '(%s)' % ''.join(chars)
+
+
+_libraries = {}
+
+def read_library(library):
+    '''
+    Returns the contents of the barcode library, it is read once per process
+    and again when the file changes
+    '''
+    mtime = os.path.getmtime(library)
+    cached = _libraries.get(library, None)
+    if cached is None or cached[0] != mtime:
+        fh = open(library, 'rb')
+        cached = _libraries[library] = (mtime, fh.read())
+        fh.close()
+    return cached[1]
+
+
+class GhostscriptError(Exception):
+    pass
+
+
+class GhostscriptWorker(object):
+    '''
+    A long-lived ghostscript interpreter with the barcode library preloaded.
+    Jobs are written to its stdin, the results are read from its stdout.
+
+    * timeout is the number of seconds to wait for a job before the worker is
+      killed (default: wait forever)
+    '''
+
+    def __init__(self, library, timeout=None):
+        self.library = library
+        self.timeout = timeout
+        self.jobs = 0
+        self.buffer = ''
+        self.directory = tempfile.mkdtemp(prefix='pdfgen-gs-')
+        self.process = subprocess.Popen(['gs',
+                                         '-q',
+                                         '-dNOPAUSE',
+                                         '-dSAFER',
+                                         '--permit-file-write=%s' % os.path.join(self.directory, '*'),
+                                         '-sDEVICE=nullpage',
+                                         '-'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        )
+
+        library_data = read_library(library)
+
+        # wrap the library in a procedure, so it's only scanned once
+        self.process.stdin.write('/pdfgen_library {\n')
+        self.process.stdin.write(library_data)
+        self.process.stdin.write('\n} def\n')
+        self.process.stdin.flush()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def readline(self, deadline):
+        '''
+        Reads a line from the worker's stdout, kills the worker when it doesn't
+        arrive before deadline
+        '''
+        fd = self.process.stdout.fileno()
+        while '\n' not in self.buffer:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.kill()
+                    raise GhostscriptError('ghostscript worker timed out')
+                if not select.select([fd], [], [], remaining)[0]:
+                    continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise GhostscriptError('ghostscript worker died')
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line + '\n'
+
+    def render(self, type, data, scale, resolution_factor):
+        '''
+        Renders a barcode, returns a tuple (width, height, png_data) or None
+        when ghostscript couldn't render the barcode.
+        '''
+        if not TYPE_RE.match(type):
+            return None
+
+        output = os.path.join(self.directory, 'job-%d.png' % self.jobs)
+        self.jobs += 1
+
+        job = JOB_TEMPLATE % {
+            'data': ps_string(data),
+            'type': type,
+            'output': ps_string(output),
+            'res': 72 * resolution_factor * scale,
+            'factor': repr(float(scale * resolution_factor)),
+        }
+
+        try:
+            self.process.stdin.write(job)
+            self.process.stdin.flush()
+        except IOError, e:
+            raise GhostscriptError('ghostscript worker died: %s' % e)
+
+        deadline = None
+        if self.timeout:
+            deadline = time.time() + self.timeout
+
+        bbox = None
+        failed = False
+        while True:
+            line = self.readline(deadline)
+            if line.startswith('PDFGEN-BBOX '):
+                bbox = tuple(float(i) for i in line.split()[1:3])
+            elif line.startswith('PDFGEN-ERROR'):
+                failed = True
+            elif line.startswith('PDFGEN-DONE'):
+                break
+
+        if failed or bbox is None:
+            # the device may have written a partial image before the error
+            if os.path.exists(output):
+                os.unlink(output)
+            return None
+        if not os.path.exists(output):
+            return None
+
+        fh = open(output, 'rb')
+        png_data = fh.read()
+        fh.close()
+        os.unlink(output)
+
+        return bbox + (png_data,)
+
+    def kill(self):
+        try:
+            if self.is_alive():
+                self.process.kill()
+                self.process.wait()
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            if self.is_alive():
+                self.process.stdin.close()
+                self.process.wait()
+        except (IOError, OSError):
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class GhostscriptPool(object):
+    '''
+    A pool of GhostscriptWorkers for one barcode library
+
+    * size is the number of workers
+    * max_jobs is the number of jobs after which a worker is recycled
+    * timeout is the number of seconds after which a worker that didn't finish
+      its job is killed and replaced
+    '''
+
+    def __init__(self, library, size=2, max_jobs=1000, timeout=None):
+        self.library = library
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.workers = []
+        self.condition = threading.Condition()
+        # the number of workers, idle or in use
+        self.started = 0
+
+    def acquire(self):
+        '''
+        Returns an idle worker, or starts a new one when fewer than size are
+        started. Otherwise it waits for a worker to be released.
+        '''
+        self.condition.acquire()
+        try:
+            while not self.workers and self.started >= self.size:
+                self.condition.wait()
+            if self.workers:
+                return self.workers.pop()
+            self.started += 1
+        finally:
+            self.condition.release()
+
+        try:
+            return GhostscriptWorker(self.library, timeout=self.timeout)
+        except Exception:
+            self.forget()
+            raise
+
+    def forget(self):
+        '''
+        Frees the slot of a worker that was closed or failed to start, it is
+        replaced the next time a worker is acquired
+        '''
+        self.condition.acquire()
+        try:
+            self.started -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def release(self, worker, discard=False):
+        if discard or not worker.is_alive() or worker.jobs >= self.max_jobs:
+            worker.close()
+            self.forget()
+            return
+
+        self.condition.acquire()
+        try:
+            self.workers.append(worker)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def render(self, type, data, scale, resolution_factor):
+        worker = self.acquire()
+        try:
+            result = worker.render(type, data, scale, resolution_factor)
+        except GhostscriptError:
+            self.release(worker, discard=True)
+            return None
+        self.release(worker)
+        return result
+
+    def close(self):
+        '''
+        Closes the idle workers
+        '''
+        self.condition.acquire()
+        try:
+            workers = self.workers
+            self.workers = []
+            self.started -= len(workers)
+        finally:
+            self.condition.release()
+        for worker in workers:
+            worker.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_ghostscript_pool(library):
+    '''
+    Returns the process-wide GhostscriptPool for library, or None when the pool
+    is disabled. The pool is configured with the settings PDFGEN_GS_POOL_SIZE
+    (0 disables the pool, this is the default), PDFGEN_GS_POOL_MAX_JOBS and
+    PDFGEN_GS_TIMEOUT (seconds per barcode, default 30).
+    '''
+    from django.conf import settings
+
+    size = getattr(settings, 'PDFGEN_GS_POOL_SIZE', 0)
+    if not size:
+        return None
+
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(library, None)
+        if pool is None:
+            pool = GhostscriptPool(library, size,
+                                   getattr(settings, 'PDFGEN_GS_POOL_MAX_JOBS', 1000),
+                                   getattr(settings, 'PDFGEN_GS_TIMEOUT', 30))
+            _pools[library] = pool
+        return pool
+    finally:
+        _pools_lock.release()
@@ -0,0 +1,107 @@
+import copy
+from cStringIO import StringIO
+
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Image
+
+from pdfgen.cache import LRUCache
+from pdfgen.assets import get_shared_assets, make_asset_name
+from pdfgen.loaders import local_loader
+
+
+class SharedImage(Image):
+    '''
+    An Image flowable that draws an already loaded ImageReader, instead of
+    reading and decoding the file again.
+
+    Images with a form_name are drawn through the document's SharedAssets, so
+    ReportLab doesn't digest the decoded image for every occurrence. size is
+    the number of bytes of the image file.
+    '''
+
+    def __init__(self, reader, width=None, height=None, kind='direct', mask='auto', hAlign='CENTER', form_name=None, size=None):
+        self.form_name = form_name
+        self.size = size
+        # Image.__init__ treats file-like objects as not lazy and only creates
+        # an ImageReader when _img isn't set, so the reader is used as it is
+        self._img = reader
+        Image.__init__(self, reader.fp, width, height, kind=kind, mask=mask, lazy=0, hAlign=hAlign)
+        self.filename = reader.fileName
+
+    def draw(self):
+        if self.form_name is None:
+            return Image.draw(self)
+
+        canv = self.canv
+        canv.saveState()
+        canv.translate(getattr(self, '_offs_x', 0), getattr(self, '_offs_y', 0))
+        canv.scale(self.drawWidth, self.drawHeight)
+        get_shared_assets(canv).draw_image(canv, self.form_name, self._img, self._mask, self.size)
+        canv.restoreState()
+
+
+class CachedImage(object):
+    '''
+    The raw bytes of an image file together with its decoded ImageReader.
+    The raw bytes are a string or a read-only mmap, see AssetLoader.read.
+
+    JPEG files are passed through to the PDF, but ReportLab identifies every
+    image by a digest of its decoded data, so JPEG files are decoded as well.
+    '''
+
+    def __init__(self, path, raw_data):
+        self.path = path
+        self.raw_data = raw_data
+        self.reader = ImageReader(StringIO(raw_data))
+        self.reader.fileName = path
+        # decode once, every copy of the reader shares the decoded data
+        self.reader.getRGBData()
+
+    def size(self):
+        return len(self.raw_data) + len(getattr(self.reader, '_data', None) or '')
+
+    def get_reader(self):
+        # every user gets its own file handle, the decoded data is shared
+        reader = copy.copy(self.reader)
+        reader.fp = StringIO(self.raw_data)
+        return reader
+
+
+_image_cache = None
+
+def get_image_cache():
+    '''
+    Returns the process-wide image cache. Its size in bytes is set with
+    PDFGEN_IMAGE_CACHE_BYTES (0 disables the cache).
+    '''
+    global _image_cache
+
+    if _image_cache is None:
+        from django.conf import settings
+
+        size = getattr(settings, 'PDFGEN_IMAGE_CACHE_BYTES', 32 * 1024 * 1024)
+        if not size:
+            return None
+        _image_cache = LRUCache(size, sizeof=lambda image: image.size())
+    return _image_cache
+
+
+def load_image(path, width=None, height=None, loader=None):
+    '''
+    Returns an Image flowable for the file at path, the name of the asset in
+    loader or a local path when loader isn't given. The decoded image is cached
+    on the asset and its mtime, so it's only read and decoded once.
+    '''
+    loader = loader or local_loader
+    cache = get_image_cache()
+    if cache is None:
+        return Image(loader.get_local_path(path), width=width, height=height)
+
+    key = (loader.get_key(path), loader.get_modified_time(path))
+    image = cache.get(key)
+    if image is None:
+        image = CachedImage(key[0], loader.read(path))
+        cache.set(key, image)
+
+    return SharedImage(image.get_reader(), width=width, height=height,
+                       form_name=make_asset_name('image', *key), size=len(image.raw_data))
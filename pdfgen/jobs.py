@@ -0,0 +1,457 @@
+import cPickle as pickle
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+from pdfgen.files import ensure_dir, get_private_dir
+
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+STATUSES = (STATUS_PENDING, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED)
+
+# the jobs are signed with SECRET_KEY and this salt, they are only unpickled
+# when the signature is valid
+SIGNING_SALT = 'pdfgen.jobs'
+
+
+class Job(object):
+    '''
+    A PDF that should be rendered in the background
+
+    * template_name is a template name or a list of template names
+    * context must be picklable, RequestContext instances are not
+    * owner identifies who may download the result, see get_request_owner
+    '''
+
+    owner = None
+
+    def __init__(self, template_name, context, filename=None, language=None, id=None, owner=None):
+        self.id = id or uuid.uuid4().hex
+        self.template_name = template_name
+        self.context = context
+        self.filename = filename or 'document.pdf'
+        self.language = language
+        self.owner = owner
+
+    def run(self, output):
+        from django.utils import translation
+        from pdfgen.shortcuts import render_to_pdf_data, multiple_templates_to_pdf_data
+
+        old_lang = translation.get_language()
+        if self.language:
+            translation.activate(self.language)
+        try:
+            if isinstance(self.template_name, (list, tuple)):
+                multiple_templates_to_pdf_data(self.template_name, self.context, output=output)
+            else:
+                render_to_pdf_data(self.template_name, self.context, output=output)
+        finally:
+            translation.activate(old_lang)
+
+
+def dump_job(job):
+    '''
+    Returns the job pickled and signed, see load_job
+    '''
+    from django.core.signing import Signer
+
+    return Signer(salt=SIGNING_SALT).sign(pickle.dumps(job, pickle.HIGHEST_PROTOCOL).encode('base64').replace('\n', ''))
+
+
+def load_job(data):
+    '''
+    Returns the job in data, raises django.core.signing.BadSignature when it
+    wasn't signed with this SECRET_KEY
+    '''
+    from django.core.signing import Signer
+
+    return pickle.loads(Signer(salt=SIGNING_SALT).unsign(str(data).strip()).decode('base64'))
+
+
+def get_spool_dir():
+    '''
+    Returns PDFGEN_JOB_SPOOL_DIR, by default a directory in the temporary
+    directory that only the current user can access. Don't use a directory in
+    MEDIA_ROOT, it is served to everyone.
+    '''
+    directory = getattr(settings, 'PDFGEN_JOB_SPOOL_DIR', None)
+    if directory is None:
+        directory = get_private_dir('pdfgen-jobs')
+    return directory
+
+
+def get_expiry():
+    '''
+    Returns the number of seconds finished jobs and their results are kept,
+    PDFGEN_JOB_EXPIRY (default one day)
+    '''
+    return getattr(settings, 'PDFGEN_JOB_EXPIRY', 24 * 60 * 60)
+
+
+def get_timeout():
+    '''
+    Returns the number of seconds a job may run before it is failed, see
+    fail_stale, PDFGEN_JOB_TIMEOUT (default one hour)
+    '''
+    return getattr(settings, 'PDFGEN_JOB_TIMEOUT', 60 * 60)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class FileSystemJobBackend(object):
+    '''
+    Stores jobs in a spool directory with a subdirectory per status. Jobs are
+    claimed by renaming them from pending to running, which is atomic.
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = directory or get_spool_dir()
+        for status in STATUSES:
+            ensure_dir(os.path.join(self.directory, status), 0700)
+
+    def get_path(self, status, job_id, extension='.job'):
+        return os.path.join(self.directory, status, job_id + extension)
+
+    def submit(self, job):
+        temp_path = self.get_path(STATUS_PENDING, job.id, '.tmp')
+        fh = open(temp_path, 'wb')
+        try:
+            fh.write(dump_job(job))
+        finally:
+            fh.close()
+        os.rename(temp_path, self.get_path(STATUS_PENDING, job.id))
+        return job.id
+
+    def get_status(self, job_id):
+        for status in STATUSES:
+            if os.path.exists(self.get_path(status, job_id)):
+                return status
+        return None
+
+    def get_job(self, job_id):
+        # jobs only move forward through STATUSES, so a job renamed while
+        # looking for it is found in the next directory
+        for status in STATUSES:
+            try:
+                fh = open(self.get_path(status, job_id), 'rb')
+            except IOError:
+                continue
+            try:
+                return load_job(fh.read())
+            finally:
+                fh.close()
+        return None
+
+    def get_pending(self):
+        directory = os.path.join(self.directory, STATUS_PENDING)
+        names = [i for i in os.listdir(directory) if i.endswith('.job')]
+        names.sort(key=lambda i: os.path.getmtime(os.path.join(directory, i)))
+        return [i[:-4] for i in names]
+
+    def claim(self, job_id):
+        try:
+            os.rename(self.get_path(STATUS_PENDING, job_id), self.get_path(STATUS_RUNNING, job_id))
+        except OSError:
+            return False
+        # the modification time is when the job started, see fail_stale
+        os.utime(self.get_path(STATUS_RUNNING, job_id), None)
+        return True
+
+    def get_output_path(self, job_id):
+        return self.get_path(STATUS_DONE, job_id, '.pdf')
+
+    def finish(self, job_id):
+        try:
+            os.rename(self.get_path(STATUS_RUNNING, job_id), self.get_path(STATUS_DONE, job_id))
+        except OSError:
+            # the job timed out, see fail_stale
+            return
+        # the modification time is when the job finished, see cleanup
+        os.utime(self.get_path(STATUS_DONE, job_id), None)
+
+    def fail(self, job_id, error):
+        if not os.path.exists(self.get_path(STATUS_RUNNING, job_id)):
+            return
+        fh = open(self.get_path(STATUS_FAILED, job_id, '.error'), 'wb')
+        fh.write(error)
+        fh.close()
+        try:
+            os.rename(self.get_path(STATUS_RUNNING, job_id), self.get_path(STATUS_FAILED, job_id))
+        except OSError:
+            return
+        os.utime(self.get_path(STATUS_FAILED, job_id), None)
+
+    def fail_stale(self, timeout):
+        '''
+        Fails the jobs that started more than timeout seconds ago, their worker
+        died or hangs
+        '''
+        cutoff = time.time() - timeout
+        failed = 0
+        directory = os.path.join(self.directory, STATUS_RUNNING)
+        for name in os.listdir(directory):
+            if not name.endswith('.job'):
+                continue
+            try:
+                stale = os.path.getmtime(os.path.join(directory, name)) < cutoff
+            except OSError:
+                continue
+            if stale:
+                self.fail(name[:-4], 'The job did not finish within %d seconds' % timeout)
+                failed += 1
+        return failed
+
+    def cleanup(self, max_age):
+        '''
+        Removes the jobs that finished more than max_age seconds ago, with
+        their results
+        '''
+        cutoff = time.time() - max_age
+        removed = 0
+        for status in (STATUS_DONE, STATUS_FAILED):
+            directory = os.path.join(self.directory, status)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    expired = os.path.getmtime(path) < cutoff
+                except OSError:
+                    continue
+                if not expired:
+                    continue
+                if name.endswith('.job'):
+                    removed += 1
+                    for extension in ('.pdf', '.error'):
+                        remove(self.get_path(status, name[:-4], extension))
+                remove(path)
+        return removed
+
+    def get_error(self, job_id):
+        path = self.get_path(STATUS_FAILED, job_id, '.error')
+        if not os.path.exists(path):
+            return None
+        fh = open(path, 'rb')
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+
+class DatabaseJobBackend(object):
+    '''
+    Stores jobs with the PdfJob model, the results are written to the spool directory.
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = os.path.join(directory or get_spool_dir(), STATUS_DONE)
+        ensure_dir(self.directory, 0700)
+
+    def submit(self, job):
+        from pdfgen.models import PdfJob
+
+        PdfJob.objects.create(id=job.id, status=STATUS_PENDING, data=dump_job(job))
+        return job.id
+
+    def get_status(self, job_id):
+        from pdfgen.models import PdfJob
+
+        try:
+            return PdfJob.objects.get(pk=job_id).status
+        except PdfJob.DoesNotExist:
+            return None
+
+    def get_job(self, job_id):
+        from pdfgen.models import PdfJob
+
+        try:
+            return load_job(PdfJob.objects.get(pk=job_id).data)
+        except PdfJob.DoesNotExist:
+            return None
+
+    def get_pending(self):
+        from pdfgen.models import PdfJob
+
+        return list(PdfJob.objects.filter(status=STATUS_PENDING).order_by('created').values_list('id', flat=True))
+
+    def claim(self, job_id):
+        import datetime
+        from pdfgen.models import PdfJob
+
+        # update() doesn't set the auto_now field modified, it is set here and
+        # below because fail_stale and cleanup use it
+        return PdfJob.objects.filter(pk=job_id, status=STATUS_PENDING).update(status=STATUS_RUNNING,
+                                                                             modified=datetime.datetime.now()) == 1
+
+    def get_output_path(self, job_id):
+        return os.path.join(self.directory, job_id + '.pdf')
+
+    def finish(self, job_id):
+        import datetime
+        from pdfgen.models import PdfJob
+
+        # jobs that timed out stay failed, see fail_stale
+        PdfJob.objects.filter(pk=job_id, status=STATUS_RUNNING).update(status=STATUS_DONE,
+                                                                      modified=datetime.datetime.now())
+
+    def fail(self, job_id, error):
+        import datetime
+        from pdfgen.models import PdfJob
+
+        PdfJob.objects.filter(pk=job_id, status=STATUS_RUNNING).update(status=STATUS_FAILED, error=error,
+                                                                      modified=datetime.datetime.now())
+
+    def fail_stale(self, timeout):
+        '''
+        Fails the jobs that started more than timeout seconds ago, their worker
+        died or hangs
+        '''
+        import datetime
+        from pdfgen.models import PdfJob
+
+        now = datetime.datetime.now()
+        stale = PdfJob.objects.filter(status=STATUS_RUNNING, modified__lt=now - datetime.timedelta(seconds=timeout))
+        return stale.update(status=STATUS_FAILED, error='The job did not finish within %d seconds' % timeout,
+                            modified=now)
+
+    def get_error(self, job_id):
+        from pdfgen.models import PdfJob
+
+        try:
+            return PdfJob.objects.get(pk=job_id).error
+        except PdfJob.DoesNotExist:
+            return None
+
+    def cleanup(self, max_age):
+        '''
+        Deletes the jobs that finished more than max_age seconds ago, with
+        their results
+        '''
+        import datetime
+        from pdfgen.models import PdfJob
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+        expired = PdfJob.objects.filter(status__in=(STATUS_DONE, STATUS_FAILED), modified__lt=cutoff)
+        job_ids = list(expired.values_list('id', flat=True))
+        for job_id in job_ids:
+            remove(self.get_output_path(job_id))
+        PdfJob.objects.filter(pk__in=job_ids).delete()
+        return len(job_ids)
+
+
+def get_job_backend():
+    '''
+    Returns an instance of the backend in PDFGEN_JOB_BACKEND
+    (default: pdfgen.jobs.FileSystemJobBackend)
+    '''
+    from django.utils.importlib import import_module
+
+    path = getattr(settings, 'PDFGEN_JOB_BACKEND', 'pdfgen.jobs.FileSystemJobBackend')
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)()
+
+
+def get_request_owner(request):
+    '''
+    Returns the owner of the jobs submitted with request: the authenticated
+    user, or else the session. Returns None without the auth and session
+    middleware, those jobs are only protected by their random id.
+    '''
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return 'user:%s' % user.pk
+
+    session = getattr(request, 'session', None)
+    if session is not None:
+        if not session.session_key:
+            session.save()
+        return 'session:%s' % session.session_key
+    return None
+
+
+def can_access(request, job):
+    return job.owner is None or job.owner == get_request_owner(request)
+
+
+def submit(template_name, context, filename=None, language=None, owner=None):
+    '''
+    Queues a PDF to be rendered by the pdfgen_worker command, returns the job id.
+    owner identifies who may download it, see get_request_owner.
+    '''
+    from django.utils import translation
+
+    job = Job(template_name, context, filename, language or translation.get_language(), owner=owner)
+    return get_job_backend().submit(job)
+
+
+def get_status(job_id):
+    return get_job_backend().get_status(job_id)
+
+
+def get_result(job_id):
+    '''
+    Returns an open file with the rendered PDF, or None when the job isn't done
+    '''
+    backend = get_job_backend()
+    if backend.get_status(job_id) != STATUS_DONE:
+        return None
+    return open(backend.get_output_path(job_id), 'rb')
+
+
+def cleanup(max_age=None):
+    '''
+    Removes the finished jobs and results that are older than max_age seconds,
+    by default PDFGEN_JOB_EXPIRY. Returns the number of removed jobs.
+    '''
+    if max_age is None:
+        max_age = get_expiry()
+    return get_job_backend().cleanup(max_age)
+
+
+def fail_stale(timeout=None):
+    '''
+    Fails the jobs that have been running for more than timeout seconds, by
+    default PDFGEN_JOB_TIMEOUT. Returns the number of failed jobs.
+    '''
+    if timeout is None:
+        timeout = get_timeout()
+    return get_job_backend().fail_stale(timeout)
+
+
+def run_job(job_id):
+    '''
+    Claims and renders a pending job, returns False if another worker claimed it
+    '''
+    import traceback
+
+    backend = get_job_backend()
+    if not backend.claim(job_id):
+        return False
+
+    output_path = backend.get_output_path(job_id)
+    temp_path = output_path + '.tmp'
+    try:
+        job = backend.get_job(job_id)
+        fh = open(temp_path, 'wb')
+        try:
+            job.run(fh)
+        finally:
+            fh.close()
+        os.rename(temp_path, output_path)
+    except Exception:
+        backend.fail(job_id, traceback.format_exc())
+    else:
+        backend.finish(job_id)
+    finally:
+        # the partial output of a failed job
+        remove(temp_path)
+    return True
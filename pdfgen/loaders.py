@@ -0,0 +1,324 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from pdfgen.files import check_private_dir, ensure_dir, get_private_dir
+
+logger = logging.getLogger('pdfgen')
+
+
+class AssetLoader(object):
+    '''
+    Loads the SVG files, images, fonts and barcode library of documents. Assets
+    are identified by a name, for example 'img/logo.svg'.
+
+    Subclasses implement get_key, exists, get_modified_time, read and
+    get_local_path, and can override prefetch to load assets in advance.
+    '''
+
+    def get_key(self, name):
+        '''
+        Returns a string that identifies the asset in the process-wide caches
+        '''
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def get_modified_time(self, name):
+        '''
+        Returns the modification time of the asset as a timestamp
+        '''
+        raise NotImplementedError
+
+    def read(self, name):
+        '''
+        Returns the data of the asset, as a string or as a read-only mmap of
+        the file. Both support len(), slicing and the buffer interface.
+        '''
+        raise NotImplementedError
+
+    def get_local_path(self, name):
+        '''
+        Returns the path of a local file with the data of the asset, for the
+        libraries that only read files (fonts and ghostscript)
+        '''
+        raise NotImplementedError
+
+    def prefetch(self, names):
+        '''
+        Loads the assets in names before they are used, names is an iterable
+        that isn't consumed by loaders that don't prefetch.
+        '''
+        pass
+
+
+class FileSystemLoader(AssetLoader):
+    '''
+    Loads assets from the local file system. Names are appended to root, like
+    MEDIA_ROOT + name, root is given a trailing separator when it has none.
+    Absolute names, like the paths of system fonts, are used as they are.
+
+    Files of mmap_threshold bytes or more are mapped instead of read, so
+    processes that cache the same file share its pages. The threshold defaults
+    to PDFGEN_MMAP_THRESHOLD (1MB, 0 disables mmap).
+    '''
+
+    def __init__(self, root='', mmap_threshold=None):
+        if root and not root.endswith(('/', os.sep)):
+            root += os.sep
+        self.root = root
+        self.mmap_threshold = mmap_threshold
+
+    def get_path(self, name):
+        if os.path.isabs(name):
+            return name
+        return self.root + name
+
+    def get_key(self, name):
+        return self.get_path(name)
+
+    def exists(self, name):
+        return os.path.exists(self.get_path(name))
+
+    def get_modified_time(self, name):
+        return os.path.getmtime(self.get_path(name))
+
+    def get_mmap_threshold(self):
+        if self.mmap_threshold is None:
+            from django.conf import settings
+
+            return getattr(settings, 'PDFGEN_MMAP_THRESHOLD', 1024 * 1024)
+        return self.mmap_threshold
+
+    def read(self, name):
+        import mmap
+
+        fh = open(self.get_path(name), 'rb')
+        try:
+            threshold = self.get_mmap_threshold()
+            if threshold and os.fstat(fh.fileno()).st_size >= threshold:
+                return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return fh.read()
+        finally:
+            fh.close()
+
+    def get_local_path(self, name):
+        return self.get_path(name)
+
+
+# loads local files by their full path
+local_loader = FileSystemLoader()
+
+
+class StorageLoader(AssetLoader):
+    '''
+    Loads assets from a django.core.files.storage backend (default_storage when
+    storage isn't given), through a local read-through cache.
+
+    * cache_dir is the directory of the cache, by default PDFGEN_ASSET_CACHE_DIR
+      or a directory in the temporary directory. It must be owned by the
+      current user and not be accessible by others, because the fonts and
+      barcode library in it are trusted.
+    * max_age is the number of seconds the modification time of an asset is
+      trusted before the storage is asked again, by default
+      PDFGEN_ASSET_CACHE_MAX_AGE (60)
+    * threads is the number of assets prefetched at the same time, by default
+      PDFGEN_ASSET_PREFETCH_THREADS (4)
+    '''
+
+    def __init__(self, storage=None, cache_dir=None, max_age=None, threads=None):
+        from django.conf import settings
+
+        if storage is None:
+            from django.core.files.storage import default_storage
+            storage = default_storage
+        if cache_dir is None:
+            cache_dir = getattr(settings, 'PDFGEN_ASSET_CACHE_DIR', None)
+        if cache_dir is None:
+            cache_dir = get_private_dir('pdfgen-assets')
+        else:
+            ensure_dir(cache_dir, 0700)
+            check_private_dir(cache_dir)
+        if max_age is None:
+            max_age = getattr(settings, 'PDFGEN_ASSET_CACHE_MAX_AGE', 60)
+        if threads is None:
+            threads = getattr(settings, 'PDFGEN_ASSET_PREFETCH_THREADS', 4)
+
+        self.storage = storage
+        self.storage_id = self.get_storage_id(storage)
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.threads = threads
+        # name -> (time checked, modification time)
+        self.modified_times = {}
+
+    def get_storage_id(self, storage):
+        '''
+        Returns a string that identifies the storage: its class and location,
+        so storages of the same class don't share cached assets
+        '''
+        storage_class = storage.__class__
+        parts = ['%s.%s' % (storage_class.__module__, storage_class.__name__)]
+        for attr in ('bucket_name', 'location'):
+            value = getattr(storage, attr, None)
+            if value:
+                parts.append(unicode(value))
+        return u':'.join(parts)
+
+    def get_key(self, name):
+        return u'%s:%s' % (self.storage_id, name)
+
+    def get_cache_path(self, name):
+        digest = hashlib.sha1(self.get_key(name).encode('utf-8')).hexdigest()
+        # keep the file name, fonts are recognized by their extension
+        return os.path.join(self.cache_dir, digest[:2], '%s-%s' % (digest, os.path.basename(name)))
+
+    def exists(self, name):
+        return name in self.modified_times or self.storage.exists(name)
+
+    def get_modified_time(self, name):
+        now = time.time()
+        checked = self.modified_times.get(name, None)
+        if checked is not None and now - checked[0] < self.max_age:
+            return checked[1]
+
+        try:
+            mtime = time.mktime(self.storage.modified_time(name).timetuple())
+        except NotImplementedError:
+            # the cached copy is used until the process ends
+            mtime = 0
+        self.modified_times[name] = (now, mtime)
+        return mtime
+
+    def fetch(self, name, path):
+        import shutil
+        import tempfile
+
+        directory = os.path.dirname(path)
+        ensure_dir(directory, 0700)
+
+        # write to a temporary file first and rename it, so readers never see
+        # a partially written file
+        source = self.storage.open(name, 'rb')
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        fh = os.fdopen(fd, 'wb')
+        try:
+            shutil.copyfileobj(source, fh)
+        finally:
+            fh.close()
+            source.close()
+        os.rename(temp_path, path)
+        logger.debug('Fetched asset %s', name)
+
+    def is_cached(self, name, mtime=None):
+        path = self.get_cache_path(name)
+        if mtime is None:
+            mtime = self.get_modified_time(name)
+        return os.path.exists(path) and os.path.getmtime(path) == mtime
+
+    def get_local_path(self, name):
+        mtime = self.get_modified_time(name)
+        path = self.get_cache_path(name)
+        if not self.is_cached(name, mtime):
+            self.fetch(name, path)
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def read(self, name):
+        return local_loader.read(self.get_local_path(name))
+
+    def prefetch(self, names):
+        '''
+        Fetches the assets that aren't cached yet, self.threads at a time.
+        Assets that fail are skipped, the error is raised when they are used.
+        '''
+        import Queue
+
+        def prefetch_one(name):
+            try:
+                self.get_local_path(name)
+            except Exception, e:
+                logger.warning('Failed to prefetch asset %s: %s', name, e)
+
+        def is_cached(name):
+            try:
+                return self.is_cached(name)
+            except Exception:
+                return False
+
+        missing = [i for i in sorted(set(names)) if not is_cached(i)]
+        if len(missing) < 2:
+            for name in missing:
+                prefetch_one(name)
+            return
+
+        start = time.time()
+        queue = Queue.Queue()
+        for name in missing:
+            queue.put(name)
+
+        def work():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                prefetch_one(name)
+
+        threads = [threading.Thread(target=work) for i in range(min(self.threads, len(missing)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.debug('Prefetched %d asset(s) in %.3fs', len(missing), time.time() - start)
+
+
+def import_class(path):
+    from django.utils.importlib import import_module
+
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+def get_asset_loader():
+    '''
+    Returns the process-wide AssetLoader, configured with the settings
+
+    * PDFGEN_ASSET_LOADER, the import path of an AssetLoader class that is
+      created without arguments
+    * PDFGEN_ASSET_STORAGE, the import path of a storage class, assets are
+      loaded from it with a StorageLoader
+
+    By default assets are files in MEDIA_ROOT.
+    '''
+    from django.conf import settings
+
+    loader_path = getattr(settings, 'PDFGEN_ASSET_LOADER', None)
+    storage_path = getattr(settings, 'PDFGEN_ASSET_STORAGE', None)
+    key = (loader_path, storage_path, settings.MEDIA_ROOT)
+
+    loader = _loaders.get(key, None)
+    if loader is not None:
+        return loader
+
+    _loaders_lock.acquire()
+    try:
+        loader = _loaders.get(key, None)
+        if loader is None:
+            if loader_path:
+                loader = import_class(loader_path)()
+            elif storage_path:
+                from django.core.files.storage import get_storage_class
+                loader = StorageLoader(get_storage_class(storage_path)())
+            else:
+                loader = FileSystemLoader(settings.MEDIA_ROOT)
+            _loaders[key] = loader
+        return loader
+    finally:
+        _loaders_lock.release()
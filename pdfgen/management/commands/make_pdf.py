@@ -1,28 +1,240 @@
 from django.conf import settings
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import NoArgsCommand, CommandError
 
 from optparse import make_option
 import codecs
+import glob
+import os
+import time
+
+# the extensions of sources found in directories
+SOURCE_EXTENSIONS = ('.cltr', '.xml')
+
+# name of the file with the digests of the sources, in every output directory
+MANIFEST_NAME = '.make_pdf.json'
+
+
+def is_xml(source_file, buffer):
+    '''
+    XML sources end with .xml or start with a tag, all others are CLTR
+    '''
+    return source_file.lower().endswith('.xml') or buffer.lstrip()[:1] == '<'
+
+
+def get_digest(buffer):
+    import hashlib
+    import pdfgen
+
+    return hashlib.sha1(pdfgen.__version__ + '\0' + buffer.encode('utf-8')).hexdigest()
+
+
+def find_sources(patterns, output_dir=None):
+    '''
+    Returns a list of (source file, target file) for the files, glob patterns
+    and directories in patterns. Directories are searched recursively for
+    SOURCE_EXTENSIONS files.
+
+    The target is <source>.pdf next to the source, or in output_dir. Sources
+    found in a directory keep their path relative to that directory.
+    '''
+    sources = []
+    seen = set()
+
+    def add(source_file, relative_name):
+        source_file = os.path.normpath(source_file)
+        if source_file in seen:
+            return
+        seen.add(source_file)
+        if output_dir is None:
+            target_file = source_file + '.pdf'
+        else:
+            target_file = os.path.join(output_dir, relative_name + '.pdf')
+        sources.append((source_file, target_file))
+
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise CommandError('No sources match "%s"' % pattern)
+
+        for path in matches:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if os.path.splitext(name)[1].lower() in SOURCE_EXTENSIONS:
+                            source_file = os.path.join(root, name)
+                            add(source_file, os.path.relpath(source_file, path))
+            elif os.path.isfile(path):
+                add(path, os.path.basename(path))
+            else:
+                raise CommandError('Source "%s" does not exist' % path)
+
+    return sources
+
+
+def read_manifest(directory):
+    import json
+
+    try:
+        fh = open(os.path.join(directory, MANIFEST_NAME))
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(fh)
+        except ValueError:
+            return {}
+    finally:
+        fh.close()
+
+
+def write_manifest(directory, manifest):
+    import json
+
+    fh = open(os.path.join(directory, MANIFEST_NAME), 'w')
+    json.dump(manifest, fh, indent=2, sort_keys=True)
+    fh.close()
+
+
+def make_pdf(task):
+    '''
+    Renders one source file, this runs in the worker processes.
+
+    task is a tuple (source file, target file, known digest), returns a tuple
+    (source file, target file, status, seconds, digest or error message) where
+    status is 'built', 'skipped' or 'failed'
+    '''
+    source_file, target_file, known_digest = task
+    start = time.time()
+
+    try:
+        fh = codecs.open(source_file, 'rt', 'utf-8')
+        buffer = fh.read()
+        fh.close()
+
+        digest = get_digest(buffer)
+        if digest == known_digest and os.path.exists(target_file):
+            return source_file, target_file, 'skipped', time.time() - start, digest
+
+        from pdfgen.shortcuts import get_parser
+
+        target_dir = os.path.dirname(target_file)
+        if target_dir and not os.path.isdir(target_dir):
+            try:
+                os.makedirs(target_dir)
+            except OSError:
+                if not os.path.isdir(target_dir):
+                    raise
+
+        # build next to the target and rename, so a failed build doesn't leave
+        # a broken document behind
+        temp_file = target_file + '.tmp%d' % os.getpid()
+        output = open(temp_file, 'wb')
+        try:
+            parser = get_parser(source_file, output, xml=is_xml(source_file, buffer))
+            parser.parse(buffer)
+        finally:
+            output.close()
+        try:
+            os.rename(temp_file, target_file)
+        except OSError:
+            # Windows doesn't replace existing files
+            os.remove(target_file)
+            os.rename(temp_file, target_file)
+
+        return source_file, target_file, 'built', time.time() - start, digest
+    except Exception, e:
+        if 'temp_file' in locals() and os.path.exists(temp_file):
+            os.remove(temp_file)
+        return source_file, target_file, 'failed', time.time() - start, u'%s: %s' % (e.__class__.__name__, e)
+
 
 class Command(NoArgsCommand):
     help = u'Generate pdf'
     option_list = NoArgsCommand.option_list + (
-        make_option('--source', dest='source', action='store', default=None, help='The source file in the City Live Template for ReportLab (CLTR) language.'),
+        make_option('--source', dest='source', action='append', default=[], help='The source file in the City Live Template for ReportLab (CLTR) language, or an XML source file. '
+                                                                               'Can be a glob pattern or a directory, and can be given more than once.'),
+        make_option('--output-dir', dest='output_dir', action='store', default=None, help='Write the documents to this directory instead of next to the sources.'),
+        make_option('--jobs', dest='jobs', action='store', type='int', default=1, help='Number of processes that render documents.'),
+        make_option('--force', dest='force', action='store_true', default=False, help='Also render the sources that did not change since the last run.'),
     )
 
     def handle_noargs(self, **options):
-        source_file = options['source']
+        if not options['source']:
+            raise CommandError('Give at least one --source')
 
-        print(u'Reading file "%s"...' % source_file)
+        sources = find_sources(options['source'], options['output_dir'])
 
-        fh = codecs.open(source_file, 'rt', 'utf-8')
-        buffer = fh.read()
-        fh.close()
-        
-        from pdfgen.parser import Parser
-        p = Parser()
-        output = p.parse(buffer)
-        
-        fh = open(source_file + '.pdf', 'wb')
-        fh.write(output)
-        fh.close()
+        manifests = {}
+        tasks = []
+        for source_file, target_file in sources:
+            target_dir = os.path.dirname(target_file) or '.'
+            if target_dir not in manifests:
+                manifests[target_dir] = read_manifest(target_dir)
+            known_digest = None if options['force'] else manifests[target_dir].get(os.path.basename(target_file))
+            tasks.append((source_file, target_file, known_digest))
+
+        print(u'Rendering %d file(s)...' % len(tasks))
+
+        start = time.time()
+        if options['jobs'] > 1 and len(tasks) > 1:
+            from multiprocessing import Pool
+            from django.db import connection
+
+            # don't share the database connection with the worker processes
+            connection.close()
+            pool = Pool(options['jobs'])
+            try:
+                results = []
+                for result in pool.imap_unordered(make_pdf, tasks):
+                    self.report(result)
+                    results.append(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = []
+            for task in tasks:
+                result = make_pdf(task)
+                self.report(result)
+                results.append(result)
+        elapsed = time.time() - start
+
+        changed = set()
+        for source_file, target_file, status, seconds, info in results:
+            if status == 'failed':
+                continue
+            target_dir = os.path.dirname(target_file) or '.'
+            manifest = manifests[target_dir]
+            if manifest.get(os.path.basename(target_file)) != info:
+                manifest[os.path.basename(target_file)] = info
+                changed.add(target_dir)
+        for target_dir in changed:
+            write_manifest(target_dir, manifests[target_dir])
+
+        self.summarize(results, elapsed)
+
+        failed = [i for i in results if i[2] == 'failed']
+        if failed:
+            raise CommandError('%d of %d file(s) failed' % (len(failed), len(results)))
+
+    def report(self, result):
+        source_file, target_file, status, seconds, info = result
+        if status == 'failed':
+            print(u'%-8s %8.3fs  %s: %s' % (status, seconds, source_file, info))
+        else:
+            print(u'%-8s %8.3fs  %s -> %s' % (status, seconds, source_file, target_file))
+
+    def summarize(self, results, elapsed):
+        counts = {}
+        for result in results:
+            counts[result[2]] = counts.get(result[2], 0) + 1
+        built = sorted((i for i in results if i[2] == 'built'), key=lambda i: i[3], reverse=True)
+
+        print(u'')
+        print(u'Built %d, skipped %d, failed %d file(s) in %.3f seconds' % (counts.get('built', 0), counts.get('skipped', 0), counts.get('failed', 0), elapsed))
+        if built:
+            total = sum(i[3] for i in built)
+            print(u'Render time: total %.3fs, mean %.3fs, slowest:' % (total, total / len(built)))
+            for source_file, target_file, status, seconds, info in built[:10]:
+                print(u'  %8.3fs  %s' % (seconds, source_file))
@@ -0,0 +1,86 @@
+from django.core.management.base import NoArgsCommand, CommandError
+
+from optparse import make_option
+import time
+
+
+class Command(NoArgsCommand):
+    help = u'Benchmark the CLTR tokenizer on synthetic documents of growing size, or with --suite the parsers and the build pipeline'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', action='store', default=None, help='Comma separated numbers of blocks in the generated documents (default: 1000,10000,100000, with --suite a few small sizes per kind).'),
+        make_option('--repeat', dest='repeat', action='store', type='int', default=3, help='Number of runs, the fastest one is reported.'),
+        make_option('--suite', dest='suite', action='store_true', default=False, help='Run the benchmark suite of pdfgen.benchmark on CLTR and XML documents, the sizes are the numbers of paragraphs, table rows, graphics or barcodes.'),
+        make_option('--kinds', dest='kinds', action='store', default=None, help='Comma separated kinds of documents for --suite (default: all of paragraphs,tables,graphics,barcodes).'),
+        make_option('--formats', dest='formats', action='store', default='cltr,xml', help='Comma separated document formats for --suite.'),
+        make_option('--cold', dest='cold', action='store_true', default=False, help='Empty the in-process caches before every timed call of --suite.'),
+        make_option('--output', dest='output', action='store', default=None, help='Save the results of --suite as JSON to this file.'),
+        make_option('--compare', dest='compare', action='store', default=None, help='Compare the results of --suite with the results saved in this file.'),
+        make_option('--threads', dest='threads', action='store', type='int', default=0, help='Also render several documents concurrently with this many threads, and check the output matches serial rendering.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['suite']:
+            return self.handle_suite(**options)
+
+        from pdfgen import benchmark
+        from pdfgen.parser import split_ignore, tokenize, split_table_cells
+
+        def run_tokenize(buffer):
+            for token in tokenize(buffer):
+                pass
+
+        def run_split_table_cells(buffer):
+            for cell in split_table_cells(buffer):
+                pass
+
+        sizes = [int(i) for i in (options['sizes'] or '1000,10000,100000').split(',')]
+        repeat = options['repeat']
+
+        print(u'%-20s %10s %10s %12s %10s' % ('function', 'blocks', 'bytes', 'seconds', 'MB/s'))
+        for size in sizes:
+            buffer = benchmark.make_cltr_document(benchmark.KIND_BLOCKS, size)
+            megabytes = len(buffer) / 1024.0 / 1024.0
+
+            for name, func in (('split_ignore', lambda b: split_ignore(b, '\n\n', '[[[block', ']]]')),
+                               ('tokenize', run_tokenize),
+                               ('split_table_cells', run_split_table_cells)):
+                seconds = benchmark.best_of(repeat, lambda: benchmark.time_call(name, func, buffer))[name]
+                print(u'%-20s %10d %10d %12.4f %10.1f' % (name, size, len(buffer), seconds, megabytes / seconds if seconds else 0))
+
+        if options['threads']:
+            threads = options['threads']
+            with benchmark.BenchmarkEnvironment():
+                documents = benchmark.make_mixed_documents(threads * 2)
+                start = time.time()
+                different = benchmark.render_concurrently(documents, threads)
+            print(u'Rendered %d documents twice with %d threads and once serially in %.4f seconds' % (len(documents), threads, time.time() - start))
+            if different:
+                raise CommandError('Concurrent output differs from serial output for document(s) %s' % ', '.join(str(i) for i in different))
+
+    def handle_suite(self, **options):
+        from pdfgen import benchmark
+
+        sizes = [int(i) for i in options['sizes'].split(',')] if options['sizes'] else None
+        kinds = options['kinds'].split(',') if options['kinds'] else benchmark.KINDS
+        formats = options['formats'].split(',')
+
+        for kind in kinds:
+            if kind not in benchmark.KINDS:
+                raise CommandError('Unknown kind of document: %s' % kind)
+
+        def report(result):
+            print(u'%-6s %-12s %8d %-32s %12.4f' % (result['format'], result['kind'], result['size'], result['function'], result['seconds']))
+
+        print(u'%-6s %-12s %8s %-32s %12s' % ('format', 'kind', 'size', 'function', 'seconds'))
+        results = benchmark.run_suite(sizes, kinds, formats, options['repeat'], options['cold'], report)
+
+        if options['output']:
+            benchmark.save_results(options['output'], results, options['cold'])
+
+        if options['compare']:
+            old = benchmark.load_results(options['compare'])
+            print(u'')
+            print(u'Compared with %s (revision %s)' % (options['compare'], old['environment'].get('revision')))
+            print(u'%-60s %10s %10s %8s' % ('benchmark', 'old', 'new', 'ratio'))
+            for key, old_seconds, new_seconds, ratio in benchmark.compare_results(old, {'results': results}):
+                print(u'%-60s %10.4f %10.4f %8s' % (key, old_seconds, new_seconds, '%.2f' % ratio if ratio is not None else '-'))
@@ -0,0 +1,59 @@
+from django.core.management.base import NoArgsCommand
+
+from optparse import make_option
+import time
+
+# seconds between the removals of expired jobs and the checks for stale ones
+CLEANUP_INTERVAL = 60
+
+
+def run_job(job_id):
+    from pdfgen.jobs import run_job
+    return job_id, run_job(job_id)
+
+
+class Command(NoArgsCommand):
+    help = u'Render the queued background PDF jobs'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', dest='processes', action='store', type='int', default=2, help='Number of worker processes.'),
+        make_option('--interval', dest='interval', action='store', type='float', default=1.0, help='Seconds between polls for new jobs.'),
+        make_option('--once', dest='once', action='store_true', default=False, help='Render the pending jobs and exit.'),
+    )
+
+    def handle_noargs(self, **options):
+        from multiprocessing import Pool
+        from django.db import connection
+        from pdfgen.jobs import cleanup, fail_stale, get_job_backend
+
+        backend = get_job_backend()
+        last_cleanup = 0
+
+        # don't share the database connection with the worker processes
+        connection.close()
+        pool = Pool(options['processes'])
+
+        try:
+            while True:
+                if time.time() - last_cleanup >= CLEANUP_INTERVAL:
+                    last_cleanup = time.time()
+                    removed = cleanup()
+                    if removed:
+                        print(u'Removed %d expired job(s)' % removed)
+                    failed = fail_stale()
+                    if failed:
+                        print(u'Failed %d job(s) that ran longer than the timeout' % failed)
+
+                job_ids = backend.get_pending()
+                connection.close()
+
+                for job_id, claimed in pool.imap(run_job, job_ids):
+                    if claimed:
+                        print(u'Rendered job %s' % job_id)
+
+                if options['once']:
+                    break
+                if not job_ids:
+                    time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
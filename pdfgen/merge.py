@@ -0,0 +1,192 @@
+import hashlib
+import logging
+from cStringIO import StringIO
+
+logger = logging.getLogger('pdfgen')
+
+
+def get_pdf_library():
+    '''
+    Returns the PdfFileReader and PdfFileWriter classes of PyPDF2, or of pyPdf
+    when PyPDF2 isn't installed.
+    '''
+    try:
+        from PyPDF2 import PdfFileReader, PdfFileWriter
+    except ImportError:
+        try:
+            from pyPdf import PdfFileReader, PdfFileWriter
+        except ImportError:
+            raise ImportError('Concatenating PDF documents requires PyPDF2 or pyPdf')
+    return PdfFileReader, PdfFileWriter
+
+
+def object_digest(obj, depth=0):
+    '''
+    Returns a digest of a PDF object, including the objects it refers to
+    and the data of streams.
+    '''
+    if depth > 32:
+        return 'too-deep'
+    if hasattr(obj, 'getObject'):
+        obj = obj.getObject()
+
+    if isinstance(obj, dict):
+        items = sorted((k, object_digest(v, depth + 1)) for k, v in obj.items() if k not in ('/Length', '/Parent'))
+        data = getattr(obj, '_data', None) or ''
+        return hashlib.sha1(repr(items) + hashlib.sha1(data).hexdigest()).hexdigest()
+    if isinstance(obj, list):
+        return hashlib.sha1(repr([object_digest(i, depth + 1) for i in obj])).hexdigest()
+    return repr(obj)
+
+
+def object_size(obj, depth=0):
+    '''
+    Returns the number of bytes of stream data in a PDF object and the objects
+    it refers to, which is about what a duplicate of it adds to a document.
+    '''
+    if depth > 32:
+        return 0
+    if hasattr(obj, 'getObject'):
+        obj = obj.getObject()
+
+    if isinstance(obj, dict):
+        size = len(getattr(obj, '_data', None) or '')
+        return size + sum(object_size(v, depth + 1) for k, v in obj.items() if k != '/Parent')
+    if isinstance(obj, list):
+        return sum(object_size(i, depth + 1) for i in obj)
+    return 0
+
+
+class ResourceDeduplicator(object):
+    '''
+    Points the font and XObject resources of pages to the first identical
+    object that was seen, so it is only written once. bytes_saved is the stream
+    data of the objects that are no longer written.
+    '''
+
+    resource_types = ('/Font', '/XObject')
+
+    def __init__(self):
+        self.objects = {}
+        self.digests = {}
+        self.duplicates = 0
+        self.bytes_saved = 0
+        self.replaced = set()
+
+    def get_key(self, reference):
+        return (id(reference.pdf), reference.idnum, reference.generation)
+
+    def get_digest(self, reference):
+        key = self.get_key(reference)
+        if key not in self.digests:
+            self.digests[key] = object_digest(reference)
+        return self.digests[key]
+
+    def deduplicate(self, page):
+        resources = page.get('/Resources')
+        if resources is None:
+            return
+        resources = resources.getObject()
+
+        for resource_type in self.resource_types:
+            entries = resources.get(resource_type)
+            if entries is None:
+                continue
+            entries = entries.getObject()
+
+            for name, reference in entries.items():
+                if not hasattr(reference, 'idnum'):
+                    # only indirect objects can be shared
+                    continue
+                digest = self.get_digest(reference)
+                if digest in self.objects:
+                    original = self.objects[digest]
+                    key = self.get_key(reference)
+                    if key != self.get_key(original) and key not in self.replaced:
+                        self.replaced.add(key)
+                        self.duplicates += 1
+                        self.bytes_saved += object_size(reference)
+                    entries[name] = original
+                else:
+                    self.objects[digest] = reference
+
+
+def read_forms(data):
+    '''
+    Returns the form XObjects the first page of a PDF document uses, by their
+    resource name
+    '''
+    PdfFileReader, PdfFileWriter = get_pdf_library()
+
+    page = PdfFileReader(StringIO(data)).getPage(0)
+    xobjects = page['/Resources']['/XObject']
+    return dict(xobjects.items())
+
+
+def replace_forms(page, forms):
+    '''
+    Points the XObject resources of a page to the objects in forms, a dict of
+    resource names and form XObjects
+    '''
+    resources = page.get('/Resources')
+    if resources is None:
+        return
+    entries = resources.getObject().get('/XObject')
+    if entries is None:
+        return
+    entries = entries.getObject()
+
+    for name in entries.keys():
+        if name in forms:
+            entries[name] = forms[name]
+
+
+def get_document_info(reader):
+    '''
+    Returns the text entries of the document information of a PDF document,
+    like its title and author
+    '''
+    info = reader.getDocumentInfo() or {}
+    return dict((key, value) for key, value in info.items() if isinstance(value, unicode))
+
+
+def concatenate_pdfs(segments, output=None, deduplicate=True, forms=None):
+    '''
+    Concatenates the pages of the PDF documents in segments, in order.
+
+    Segments are either document data or file-like objects. With deduplicate,
+    identical fonts and images of the segments are written once. forms is a list
+    with a dict for every segment, its form XObjects are replaced with the
+    forms in the dict, see replace_forms. The document information, like the
+    title, is copied from the first segment. Returns the data of the concatenated
+    document, or output when a file-like object is given to write the document to.
+    '''
+    PdfFileReader, PdfFileWriter = get_pdf_library()
+
+    writer = PdfFileWriter()
+    deduplicator = ResourceDeduplicator()
+    for index, segment in enumerate(segments):
+        if isinstance(segment, str):
+            segment = StringIO(segment)
+        reader = PdfFileReader(segment)
+        # pyPdf can't write document information
+        if index == 0 and hasattr(writer, 'addMetadata'):
+            writer.addMetadata(get_document_info(reader))
+        for i in xrange(reader.getNumPages()):
+            page = reader.getPage(i)
+            if forms:
+                replace_forms(page, forms[index])
+            if deduplicate:
+                deduplicator.deduplicate(page)
+            writer.addPage(page)
+
+    if deduplicate:
+        logger.info('Shared %d duplicate resource(s), saved %d bytes', deduplicator.duplicates, deduplicator.bytes_saved)
+
+    if output is not None:
+        writer.write(output)
+        return output
+
+    buffer = StringIO()
+    writer.write(buffer)
+    return buffer.getvalue()
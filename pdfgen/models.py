@@ -0,0 +1,13 @@
+from django.db import models
+
+
+class PdfJob(models.Model):
+    '''
+    A background PDF job, used by pdfgen.jobs.DatabaseJobBackend
+    '''
+    id = models.CharField(max_length=32, primary_key=True)
+    status = models.CharField(max_length=16, db_index=True)
+    data = models.TextField()
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
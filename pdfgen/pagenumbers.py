@@ -0,0 +1,199 @@
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus.doctemplate import ActionFlowable
+
+
+# fields in headers and footers
+PAGE_FIELD = '{page}'
+PAGES_FIELD = '{pages}'
+
+POSITION_TOP = 'top'
+POSITION_BOTTOM = 'bottom'
+
+
+class PageCanvas(Canvas):
+    '''
+    A canvas that calls the functions in before_save with itself just before
+    the document is saved, when the number of pages is known.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        Canvas.__init__(self, *args, **kwargs)
+        self.before_save = []
+
+    def save(self):
+        for func in self.before_save:
+            func(self)
+        Canvas.save(self)
+
+
+class PageLayout(object):
+    '''
+    The size and margins of a page, kept for the running texts that are drawn
+    when the document is saved
+    '''
+
+    def __init__(self, doc):
+        self.width, self.height = doc.pagesize
+        self.left_margin = doc.leftMargin
+        self.right_margin = doc.rightMargin
+        self.top_margin = doc.topMargin
+        self.bottom_margin = doc.bottomMargin
+
+
+class RunningText(object):
+    '''
+    A line of text in the top or bottom margin of every page, with the fields
+    {page} for the page number and {pages} for the number of pages.
+
+    Lines with {pages} are form XObjects that are only drawn when the document
+    is saved, so the document is built once and the line is aligned with the
+    actual number of pages.
+    '''
+
+    def __init__(self, text, position=POSITION_BOTTOM, align='center', font_name='Helvetica', font_size=9):
+        self.text = text
+        self.position = position
+        self.align = align.lower()
+        self.font_name = font_name
+        self.font_size = font_size
+
+    def needs_total(self):
+        return PAGES_FIELD in self.text
+
+    def is_numbered(self):
+        return PAGE_FIELD in self.text or PAGES_FIELD in self.text
+
+    def draw(self, canvas, layout, page, pages=None):
+        line = self.text.replace(PAGE_FIELD, str(page))
+        if pages is not None:
+            line = line.replace(PAGES_FIELD, str(pages))
+        width = canvas.stringWidth(line, self.font_name, self.font_size)
+
+        if self.align == 'left':
+            x = layout.left_margin
+        elif self.align == 'right':
+            x = layout.width - layout.right_margin - width
+        else:
+            x = layout.left_margin + (layout.width - layout.left_margin - layout.right_margin - width) / 2.0
+
+        # in the middle of the margin
+        if self.position == POSITION_TOP:
+            y = layout.height - layout.top_margin / 2.0 - self.font_size / 3.0
+        else:
+            y = layout.bottom_margin / 2.0 - self.font_size / 3.0
+
+        canvas.saveState()
+        canvas.setFont(self.font_name, self.font_size)
+        canvas.drawString(x, y, line)
+        canvas.restoreState()
+
+
+class SegmentStart(ActionFlowable):
+    '''
+    Starts a segment of a document, for example one context of
+    multiple_contexts_to_pdf_data. The running texts of the segment are drawn
+    on the pages from the one this flowable is placed on, until the next
+    segment starts.
+    '''
+
+    def __init__(self, texts):
+        ActionFlowable.__init__(self)
+        self.texts = texts
+
+    def apply(self, doc):
+        doc.running_texts = self.texts
+
+    def identity(self, maxLen=None):
+        return 'SegmentStart: %d running text(s)' % len(self.texts)
+
+
+class PageDecorator(object):
+    '''
+    Draws the headers and footers of a document at the end of every page, it
+    is installed as the afterPage function of a SimpleDocTemplate. The documents
+    must be built with a PageCanvas.
+
+    The running texts belong to the segment they were added in, see
+    start_segment, so the documents of several parsers can be built as one.
+
+    Documents that are a segment of a larger document set defer_numbers, so
+    all their page numbers are drawn in forms that can be replaced when the
+    segments are concatenated, see render_forms.
+    '''
+
+    defer_numbers = False
+
+    def __init__(self):
+        self.texts = []
+        # (form name, running text, page layout, page number) of the lines
+        # that are drawn when the document is saved
+        self.deferred = []
+        self.pages = 0
+        # whether page numbers were drawn
+        self.numbered = False
+
+    def start_segment(self):
+        '''
+        Returns the SegmentStart flowable of a new segment, the texts that are
+        added after this belong to it
+        '''
+        self.texts = []
+        return SegmentStart(self.texts)
+
+    def add(self, text):
+        self.texts.append(text)
+
+    def install(self, doc):
+        def after_page():
+            self(doc.canv, doc)
+        doc.afterPage = after_page
+
+    def __call__(self, canvas, doc):
+        self.pages = max(self.pages, canvas.getPageNumber())
+        texts = getattr(doc, 'running_texts', None)
+        if not texts:
+            return
+
+        page = canvas.getPageNumber()
+        layout = PageLayout(doc)
+        for text in texts:
+            self.numbered = self.numbered or text.is_numbered()
+            if not text.needs_total() and not (self.defer_numbers and text.is_numbered()):
+                text.draw(canvas, layout, page)
+                continue
+
+            if self.finish not in canvas.before_save:
+                canvas.before_save.append(self.finish)
+            name = 'pdfgen_running_%d' % len(self.deferred)
+            canvas.doForm(name)
+            self.deferred.append((name, text, layout, page))
+
+    def finish(self, canvas):
+        '''
+        Draws the lines with the number of pages in the forms the pages refer to
+        '''
+        for name, text, layout, page in self.deferred:
+            canvas.beginForm(name, upperx=layout.width, uppery=layout.height)
+            text.draw(canvas, layout, page, self.pages)
+            canvas.endForm()
+
+
+def render_forms(lines):
+    '''
+    Renders running texts into the forms of a one-page document and returns
+    the document data. lines are tuples (form name, running text, page layout,
+    page number, number of pages).
+    '''
+    from cStringIO import StringIO
+
+    buffer = StringIO()
+    canvas = Canvas(buffer)
+    for name, text, layout, page, pages in lines:
+        canvas.beginForm(name, upperx=layout.width, uppery=layout.height)
+        text.draw(canvas, layout, page, pages)
+        canvas.endForm()
+        # forms are only written when a page uses them
+        canvas.doForm(name)
+    canvas.showPage()
+    canvas.save()
+    return buffer.getvalue()
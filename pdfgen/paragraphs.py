@@ -0,0 +1,107 @@
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import Paragraph
+
+from pdfgen.cache import LRUCache
+
+
+# style attributes that don't change how the markup is parsed
+IGNORED_STYLE_ATTRIBUTES = ('name', 'parent')
+
+
+_paragraph_cache = None
+
+def get_paragraph_cache():
+    '''
+    Returns the process-wide cache of parsed paragraph markup, the number of
+    entries is set with PDFGEN_PARAGRAPH_CACHE_SIZE (0 disables the cache).
+    '''
+    global _paragraph_cache
+
+    if _paragraph_cache is None:
+        from django.conf import settings
+
+        size = getattr(settings, 'PDFGEN_PARAGRAPH_CACHE_SIZE', 4096)
+        if not size:
+            return None
+        _paragraph_cache = LRUCache(size)
+    return _paragraph_cache
+
+
+def get_style_key(style):
+    return tuple(sorted(i for i in style.__dict__.items() if i[0] not in IGNORED_STYLE_ATTRIBUTES))
+
+
+def make_paragraph(text, style):
+    '''
+    Returns Paragraph(text, style). ReportLab's markup parser only runs the
+    first time a text is used with a style, after that the paragraph gets a copy
+    of the cached fragments.
+    '''
+    cache = get_paragraph_cache()
+    if cache is None:
+        return Paragraph(text, style)
+
+    try:
+        key = (text, get_style_key(style))
+        parsed = cache.get(key)
+    except TypeError:
+        # the style has an unhashable attribute
+        return Paragraph(text, style)
+
+    if parsed is None:
+        paragraph = Paragraph(text, style)
+        # <para> markup can change the style
+        parsed_style = paragraph.style if paragraph.style is not style else None
+        cache.set(key, (parsed_style, [f.clone() for f in paragraph.frags], paragraph.bulletText))
+        return paragraph
+
+    parsed_style, frags, bullet_text = parsed
+    return Paragraph(text, parsed_style or style, bulletText=bullet_text, frags=[f.clone() for f in frags])
+
+
+_word_widths = {}
+_word_widths_size = None
+
+def cached_string_width(text, fontName, fontSize, encoding='utf8'):
+    '''
+    stringWidth with a cache of the widths per font and size. Every font and
+    size keeps up to PDFGEN_WORD_WIDTH_CACHE_SIZE widths (default 10000, 0
+    disables the cache).
+    '''
+    global _word_widths_size
+
+    try:
+        widths = _word_widths[fontName, fontSize]
+    except KeyError:
+        if _word_widths_size is None:
+            from django.conf import settings
+
+            _word_widths_size = getattr(settings, 'PDFGEN_WORD_WIDTH_CACHE_SIZE', 10000)
+        if not _word_widths_size:
+            return stringWidth(text, fontName, fontSize, encoding)
+        widths = _word_widths.setdefault((fontName, fontSize), {})
+
+    key = (text, encoding)
+    try:
+        return widths[key]
+    except KeyError:
+        pass
+
+    width = stringWidth(text, fontName, fontSize, encoding)
+    if len(widths) >= _word_widths_size:
+        widths.clear()
+    widths[key] = width
+    return width
+
+
+def clear_word_widths():
+    _word_widths.clear()
+
+
+def patch_string_width():
+    '''
+    Makes ReportLab's paragraphs measure words with cached_string_width
+    '''
+    from reportlab.platypus import paragraph
+
+    paragraph.stringWidth = cached_string_width
@@ -1,51 +1,45 @@
-from django.conf import settings
-
 from cStringIO import StringIO
-from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus.doctemplate import SimpleDocTemplate
-from reportlab.platypus import Paragraph, Table, Spacer, Image, PageBreak
-from reportlab.lib.units import cm, inch, mm, toLength
+from reportlab.platypus import Spacer, PageBreak
+from reportlab.lib.units import cm, mm, toLength
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import pagesizes
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_RIGHT, TA_CENTER, TA_LEFT
-from reportlab.lib.styles import ParagraphStyle
-from svglib.svglib import svg2rlg
-import codecs
-import os
+import itertools
+import re
 from reportlab.pdfgen.canvas import Canvas
-from reportlab.platypus.frames import Frame
-from reportlab.platypus.figures import DrawingFigure
-from reportlab.platypus.flowables import Flowable, XBox
 
-from pdfgen.barcode import Barcode
+from pdfgen.barcode import Barcode, ENGINE_GHOSTSCRIPT, BARCODE_LIBRARY
+from pdfgen.svg import load_svg
+from pdfgen.images import load_image
+from pdfgen.fonts import import_pdf_font
+from pdfgen.loaders import FileSystemLoader, get_asset_loader
+from pdfgen.tables import make_tables
+from pdfgen.timing import timer, record, PHASE_PARSE, PHASE_BUILD
+from pdfgen.streaming import FlowableStream
+from pdfgen.paragraphs import make_paragraph, patch_string_width
+from pdfgen.pagenumbers import PageCanvas, PageDecorator, RunningText, POSITION_TOP, POSITION_BOTTOM
+from pdfgen.styles import LayeredStyleSheet, compile_paragraph_style, compile_xml_style, compile_table_style, compile_xml_table_style, define_style
 
-CSS_DICT = {
-    'padding-left': 'LEFTPADDING',
-    'padding-right': 'RIGHTPADDING',
-    'padding-top': 'TOPPADDING',
-    'padding-bottom': 'BOTTOMPADDING',
-    'border-left': 'LINEBEFORE',
-    'border-right': 'LINEAFTER',
-    'border-top': 'LINEABOVE',
-    'border-bottom': 'LINEBELOW',
-    'text-align': 'alignment',
-    'font-family': 'fontName',
-    'font-size': 'fontSize',
-    'color': 'textColor',
-    'left': TA_LEFT,
-    'right': TA_RIGHT,
-    'center': TA_CENTER,
-}
 
 def _new_draw(self):
     self.canv.setLineWidth(0.2*mm)
     self.drawPara(self.debug)
-    
+
+_patched = False
+
 def patch_reportlab():
-    setattr(Paragraph, 'draw', _new_draw)
+    '''
+    Patches ReportLab's paragraphs, this is done once by the first parser
+    '''
+    global _patched
 
-patch_reportlab()
+    if _patched:
+        return
+    from reportlab.platypus import Paragraph
+
+    setattr(Paragraph, 'draw', _new_draw)
+    patch_string_width()
+    _patched = True
 
 def debug_print(text):
     pass
@@ -53,65 +47,143 @@ def debug_print(text):
 #        print(text)
 
 def split_ignore(haystack, needle, ignore_start=None, ignore_end=None):
+    """
+    Splits haystack on needle, except for the needles between ignore_start and
+    ignore_end. The ignore markers are removed from the parts.
+    """
     parts = []
     ignore_start = ignore_start or '<![CDATA['
     ignore_end = ignore_end or ']]>'
-    haystack_len, needle_len, ignore_start_len, ignore_end_len = len(haystack), len(needle), len(ignore_start), len(ignore_end)
-    ignore = False
-    i = 0
-    pi = -1
-    unignored = False
-    while i < haystack_len:
-        unignored = False
-        if ignore and i+ignore_end_len <= haystack_len and haystack[i:i+ignore_end_len] == ignore_end:
-            ignore = False
-            unignored = True
-        if not ignore and i+needle_len <= haystack_len and haystack[i:i+needle_len] == needle:
-            part = haystack[pi+1:i].replace(ignore_start, '').replace(ignore_end, '')
-            i += needle_len-1
-            pi = i
-            parts.append(part)
-        if not ignore and not unignored and i+ignore_start_len <= haystack_len and haystack[i:i+ignore_start_len] == ignore_start:
-            ignore = True
-        i += 1
-    parts.append(haystack[pi+1:].replace(ignore_start, '').replace(ignore_end, ''))
+    needle_len, ignore_start_len, ignore_end_len = len(needle), len(ignore_start), len(ignore_end)
+    
+    part_start = 0
+    pos = 0
+    next_ignore = haystack.find(ignore_start)
+    while True:
+        next_needle = haystack.find(needle, pos)
+        if next_needle == -1:
+            break
+        if next_ignore != -1 and next_ignore < next_needle:
+            # skip the ignored block, the rest of the haystack if it isn't closed
+            ignore_stop = haystack.find(ignore_end, next_ignore + ignore_start_len)
+            if ignore_stop == -1:
+                break
+            pos = ignore_stop + ignore_end_len
+            next_ignore = haystack.find(ignore_start, pos)
+            continue
+        parts.append(haystack[part_start:next_needle].replace(ignore_start, '').replace(ignore_end, ''))
+        pos = part_start = next_needle + needle_len
+        if next_ignore != -1 and next_ignore < pos:
+            next_ignore = haystack.find(ignore_start, pos)
+    parts.append(haystack[part_start:].replace(ignore_start, '').replace(ignore_end, ''))
     return parts
 
 
+# CLTR tokens, one for every line and one at the end of every block
+TOKEN_COMMENT = '#'
+TOKEN_STYLE = '$'
+TOKEN_DIRECTIVE = '~'
+TOKEN_TABLE = '['
+TOKEN_TEXT = ''
+TOKEN_BLOCK_END = None
+
+LINE_TOKENS = {
+    '#': TOKEN_COMMENT,
+    '$': TOKEN_STYLE,
+    '~': TOKEN_DIRECTIVE,
+    '[': TOKEN_TABLE,
+}
+
+def tokenize(buffer):
+    """
+    Generates (token, line) tuples for a CLTR document. Blocks are separated by
+    empty lines, except within [[[block ... ]]].
+    """
+    for block in split_ignore(buffer, '\n\n', '[[[block', ']]]'):
+        for line in block.split('\n'):
+            yield LINE_TOKENS.get(line[:1], TOKEN_TEXT), line
+        yield TOKEN_BLOCK_END, None
+
+# the SVG files and images a CLTR document defines, see Parser.find_assets
+CLTR_ASSET_RE = re.compile(r'~([VI])\[([^\]]*)\]')
+
+# the SVG files and images of an XML document, see XmlParser.find_assets
+XML_ASSET_RE = re.compile(r'<(?:vector|img)\s[^>]*?\bsrc\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+TABLE_DELIMITER_RE = re.compile(r'(?<!\\)[\[|\]]')
+
+def split_table_cells(raw_table_data):
+    """
+    Generates (cell_content, end_of_row) tuples for CLTR table rows
+    like [cell|cell|cell]. Escaped delimiters are part of the cell.
+    """
+    cue = 0
+    for match in TABLE_DELIMITER_RE.finditer(raw_table_data):
+        i = match.start()
+        if match.group() == '[':
+            cue = i+1
+        else:
+            yield raw_table_data[cue:i], match.group() == ']'
+            cue = i+1
+
+
 class Parser(object):
     styles = None
     out_buffer = None
     doc = None
     unit = cm
     parts = None
-    parts_buffer_dict = {}
+    parts_buffer_dict = None
     parts_buffer = None
-    fonts = {}
     
-    style_stack = []
-    svg_dict = {}
-    img_dict = {}
+    style_stack = None
+    svg_dict = None
+    img_dict = None
+    stream_output = False
+    page_decorator = None
+    loader = None
+    # 1 leaves the creation date and random document id out of the document
+    invariant = None
+    
+    def __init__(self, out_buffer=None):
+        '''
+        * out_buffer is an optional file-like object the document is written to.
+          When it is given, merge_parts returns it instead of the document data.
+        
+        All parsing state belongs to the instance, so separate parsers can be
+        used concurrently. A single parser is not thread-safe.
+        '''
+        patch_reportlab()
+        self.parts_buffer_dict = {}
+        self.style_stack = []
+        self.svg_dict = {}
+        self.img_dict = {}
+        self.page_decorator = PageDecorator()
+        if out_buffer is not None:
+            self.out_buffer = out_buffer
+            self.stream_output = True
     
     def import_pdf_font(self, base_name, face_name):
-        import os
-        import reportlab
-        from reportlab.pdfbase import pdfmetrics
-        
-        if self.fonts.get(face_name, None) is None:
-            afm = os.path.join(settings.MEDIA_ROOT, base_name + '.afm')
-            pfb = os.path.join(settings.MEDIA_ROOT, base_name + '.pfb')
-        
-            try:
-                face = pdfmetrics.EmbeddedType1Face(afm, pfb)
-        
-                pdfmetrics.registerTypeFace(face)
-                font = pdfmetrics.Font(face_name, face_name, 'WinAnsiEncoding')
-                pdfmetrics.registerFont(font)
-            except:
-                pass
-        else:
-            self.fonts[face_name] = True
-
+        import_pdf_font(base_name, face_name, self.loader)
+    
+    def get_loader(self):
+        '''
+        Returns the AssetLoader of the SVG files, images and barcode library,
+        by default the process-wide loader (see get_asset_loader)
+        '''
+        return self.loader or get_asset_loader()
+    
+    def find_assets(self, buffer):
+        '''
+        Returns a generator of the names of the SVG files and images the
+        document in buffer defines
+        '''
+        for match in CLTR_ASSET_RE.finditer(buffer):
+            info = match.group(2).split(';')
+            if match.group(1) == 'V' and len(info) >= 5:
+                yield info[4]
+            elif match.group(1) == 'I' and len(info) >= 4:
+                yield info[3]
     
     def reset_table(self):
         self.table_data = []
@@ -119,6 +191,9 @@ class Parser(object):
         self.table_cols = []
         self.table_styles = []
         self.table_align = 'CENTER'
+        self.table_large = None
+        self.table_repeat_rows = 0
+        self.table_chunk_rows = 0
         
     
     def append_to_parts(self, item):
@@ -129,160 +204,36 @@ class Parser(object):
             self.parts.append(item)
             debug_print('Added part to root parts')
         
+    @timer(PHASE_PARSE)
     def parse_parts(self, buffer):
         # prepare ReportLab
-        self.styles = getSampleStyleSheet()
+        self.styles = LayeredStyleSheet()
         self.style_stack.append(self.styles['Normal'])
         if self.out_buffer is None:
             self.out_buffer = StringIO()
-        self.parts = []
+        self.parts = [self.page_decorator.start_segment()]
+        loader = self.get_loader()
+        loader.prefetch(self.find_assets(buffer))
         
         # prepare for parsing
-        i = 0
-        buffer_len = len(buffer)
         mode = 0 # 0 = normal, 1 = table row, 2 = insert object
         new_line = True
         new_para = True
-        cue = 0
-        content = ''
-        raw_table_data = ''
+        content = []
+        raw_table_data = []
         self.reset_table()
         obj = None
         
         style_stack = self.style_stack
         
-        paragraphs = split_ignore(buffer, '\n\n', '[[[block', ']]]')
-        
-        for p in paragraphs:
-            lines = p.split('\n')
-            content = ''
-            for line in lines:
-                c = line[:1]
-                if c == '#':
-                    debug_print( '[comment]')
-                elif c == '$':
-                    self.parse_paragraph_style(line[1:])
-                elif c == '~':
-                    debug_print( '[document element %s]' % line[1])
-                    elem = line[1]
-                    endpos = line.find(']', 2)
-                    if elem == 'D':
-                        self.handle_document_properties(line[3:endpos], line[endpos+1:])
-                    elif elem == 'T':
-                        if line[2] == '$':
-                            # table style
-                            raw_style = line[3:]
-                            style = self.parse_table_style(raw_style)
-                            self.table_styles.append(style)
-                        else:
-                            self.table_cols = list(float(n) * self.unit for n in line[3:endpos].split('|'))
-                            align = line[endpos+1:endpos+2]
-                            if align == '<': self.table_align = 'LEFT'
-                            elif align == '>': self.table_align = 'RIGHT'
-                    elif elem == 'B':
-                        self.append_to_parts(PageBreak())
-                    elif elem == 'S':
-                        self.append_to_parts(Spacer(1, toLength(line[2:])))
-                    elif elem == 'V':
-                        svg_info_raw = line[3:endpos]
-                        svg_info = svg_info_raw.split(';')[:7]
-                        if len(svg_info) == 1:
-                            mode = 2
-                            obj = self.svg_dict[svg_info[0]]
-                        else:
-                            if len(svg_info) == 7:
-                                svg_name, svg_scale, svg_w, svg_h, svg_path, svg_find, svg_replace = svg_info
-                            else:
-                                svg_name, svg_scale, svg_w, svg_h, svg_path = svg_info
-                            
-                            
-                            svg_file = open(settings.MEDIA_ROOT + svg_path, 'rb')
-                            svg_data = svg_file.read()
-                            svg_file.close()
-                            
-                            if len(svg_info) == 7:
-                                svg_data = svg_data.replace(svg_find, svg_replace)
-                            
-                            import xml.dom.minidom
-                            svg = xml.dom.minidom.parseString(svg_data).documentElement
-                            from svglib.svglib import SvgRenderer
-                            
-                            svgRenderer = SvgRenderer()
-                            svgRenderer.render(svg)
-                            svg_obj = svgRenderer.finish()
-                            
-                            #svg_obj = svg2rlg(settings.MEDIA_ROOT + svg_path)
-                            svg_obj.scale(float(svg_scale), float(svg_scale))
-                            svg_obj.asDrawing(float(svg_w) * self.unit, float(svg_h) * self.unit)
-                            self.svg_dict[svg_name] = svg_obj
-                    elif elem == 'I':
-                        img_info_raw = line[3:endpos]
-                        img_info = img_info_raw.split(';')[:4]
-                        if len(img_info) == 1:
-                            mode = 2
-                            obj = self.img_dict[img_info[0]]
-                        else:
-                            img_name, img_w, img_h, img_path = img_info
-                            img_obj = Image(settings.MEDIA_ROOT + img_path, width=self.unit*float(img_w), height=self.unit*float(img_h))
-                            align = line[endpos+1:endpos+2]
-                            if align == '<': img_obj.hAlign = 'LEFT'
-                            elif align == '>': img_obj.hAlign = 'RIGHT'
-                            self.img_dict[img_name] = img_obj
-                    elif elem == 'C':
-                        barcode_info_raw = line[3:endpos]
-                        barcode_info = barcode_info_raw.split(';')[:6]
-                        if len(barcode_info) == 1:
-                            mode = 2
-                            obj = self.img_dict[barcode_info[0]]
-                        else:
-                            barcode_name, barcode_type, barcode_scale, barcode_w, barcode_h, barcode_data = barcode_info
-                            barcode_obj = Barcode(library=os.path.join(settings.MEDIA_ROOT, 'common', 'pdf_img', 'barcode.ps'),
-                                                  width=self.unit * float(barcode_w), 
-                                                  height=self.unit * float(barcode_h), 
-                                                  data=barcode_data, 
-                                                  scale=float(barcode_scale), 
-                                                  type=barcode_type)
-                            align = line[endpos+1:endpos+2]
-                            if align == '<': barcode_obj.hAlign = 'LEFT'
-                            elif align == '>': barcode_obj.hAlign = 'RIGHT'
-                            self.img_dict[barcode_name] = barcode_obj
-                    elif elem == 'F':
-                        font_info_raw = line[3:endpos]
-                        font_info = font_info_raw.split(';')[:2]
-                        self.import_pdf_font(font_info[1], font_info[0])
-                    elif elem == 'P':
-                        if '[' in line:
-                            self.parts_buffer = line[3:endpos]
-                            self.parts_buffer_dict[self.parts_buffer] = []
-                        else:
-                            self.parts_buffer = None
-                elif c == '[':
-                    mode = 1
-                    raw_table_data += line + '\n'
-                elif c == '\n':
-                    pass
-                else:
-                    if mode == 0:
-                        content += line + '\n'
-                    elif mode == 1:
-                        raw_table_data += line + '\n'
+        for token, line in tokenize(buffer):
+            if token is TOKEN_BLOCK_END:
+                if mode == 0:
+                    if content:
+                        self.append_to_parts(make_paragraph('\n'.join(content) + '\n', self.style_stack[-1] if len(self.style_stack) > 0 else self.styles['Normal']))
             
-            if mode == 0:
-                if content != '':
-                    self.append_to_parts(Paragraph(content, self.style_stack[-1] if len(self.style_stack) > 0 else self.styles['Normal']))
-                content = ''
-            
-            if mode == 1:
-                td = raw_table_data
-                td_len = len(td)
-                i = 0
-                while i < td_len:
-                    c = td[i]
-                    c_1 = td[i-1:i]
-                    if c == '[' and c_1 != '\\':
-                        cue = i+1
-                    if (c == '|' or c == ']') and c_1 != '\\':
-                        cell_content = td[cue:i]
+                if mode == 1:
+                    for cell_content, end_of_row in split_table_cells('\n'.join(raw_table_data)):
                         pop_after_cell = False
                         if cell_content[:1] == '$':
                             if ' ' in cell_content:
@@ -304,36 +255,154 @@ class Parser(object):
                         elif cell_content[:2] == '~P':
                             self.table_row.append(self.parts_buffer_dict[cell_content[2:]])
                         else:
-                            self.table_row.append(Paragraph(cell_content, self.style_stack[-1] if len(self.style_stack) > 0 else self.styles['Normal']))
-                        
+                            self.table_row.append(make_paragraph(cell_content, self.style_stack[-1] if len(self.style_stack) > 0 else self.styles['Normal']))
+                    
                         if pop_after_cell:
                             self.parse_paragraph_style('')
-                        
-                        cue = i+1
-                        if c == ']':
+                    
+                        if end_of_row:
                             self.table_data.append(self.table_row)
                             self.table_row = []
-                        
-                    i += 1
-                if len(self.table_data) > 0:
-                    self.append_to_parts(Table(self.table_data, self.table_cols, hAlign=self.table_align, style=self.table_styles))
-                self.reset_table()
-                raw_table_data = ''
+                    
+                    if len(self.table_data) > 0:
+                        for table_obj in make_tables(self.table_data, self.table_cols, self.table_align, self.table_styles,
+                                                     self.table_large, self.table_repeat_rows, self.table_chunk_rows):
+                            self.append_to_parts(table_obj)
+                    self.reset_table()
+                    raw_table_data = []
             
-            if mode == 2:
-                if obj is not None:
-                    self.append_to_parts(obj)
-                    obj = None
+                if mode == 2:
+                    if obj is not None:
+                        self.append_to_parts(obj)
+                        obj = None
             
-            mode = 0
-        
-        
+                mode = 0
+                content = []
+                continue
+            
+            if token == TOKEN_COMMENT:
+                debug_print( '[comment]')
+            elif token == TOKEN_STYLE:
+                self.parse_paragraph_style(line[1:])
+            elif token == TOKEN_DIRECTIVE:
+                debug_print( '[document element %s]' % line[1])
+                elem = line[1]
+                endpos = line.find(']', 2)
+                if elem == 'D':
+                    self.handle_document_properties(line[3:endpos], line[endpos+1:])
+                elif elem == 'T':
+                    if line[2] == '$':
+                        # table style
+                        raw_style = line[3:]
+                        style = self.parse_table_style(raw_style)
+                        self.table_styles.append(style)
+                    else:
+                        self.table_cols = list(float(n) * self.unit for n in line[3:endpos].split('|'))
+                        align = line[endpos+1:endpos+2]
+                        if align == '<': self.table_align = 'LEFT'
+                        elif align == '>': self.table_align = 'RIGHT'
+                elif elem == 'L':
+                    # large table mode for the next table: ~L[repeated header rows;rows per chunk]
+                    large_info = line[3:endpos].split(';')
+                    self.table_large = True
+                    self.table_repeat_rows = int(large_info[0] or 0)
+                    if len(large_info) > 1:
+                        self.table_chunk_rows = int(large_info[1] or 0)
+                elif elem == 'B':
+                    self.append_to_parts(PageBreak())
+                elif elem == 'S':
+                    self.append_to_parts(Spacer(1, toLength(line[2:])))
+                elif elem == 'V':
+                    svg_info_raw = line[3:endpos]
+                    svg_info = svg_info_raw.split(';')[:7]
+                    if len(svg_info) == 1:
+                        mode = 2
+                        obj = self.svg_dict[svg_info[0]]
+                    else:
+                        if len(svg_info) == 7:
+                            svg_name, svg_scale, svg_w, svg_h, svg_path, svg_find, svg_replace = svg_info
+                        else:
+                            svg_name, svg_scale, svg_w, svg_h, svg_path = svg_info
+                            svg_find = svg_replace = None
+                        
+                        svg_obj = load_svg(svg_path, float(svg_scale),
+                                           float(svg_w) * self.unit, float(svg_h) * self.unit,
+                                           svg_find, svg_replace, loader)
+                        self.svg_dict[svg_name] = svg_obj
+                elif elem == 'I':
+                    img_info_raw = line[3:endpos]
+                    img_info = img_info_raw.split(';')[:4]
+                    if len(img_info) == 1:
+                        mode = 2
+                        obj = self.img_dict[img_info[0]]
+                    else:
+                        img_name, img_w, img_h, img_path = img_info
+                        img_obj = load_image(img_path, width=self.unit*float(img_w), height=self.unit*float(img_h), loader=loader)
+                        align = line[endpos+1:endpos+2]
+                        if align == '<': img_obj.hAlign = 'LEFT'
+                        elif align == '>': img_obj.hAlign = 'RIGHT'
+                        self.img_dict[img_name] = img_obj
+                elif elem == 'C':
+                    barcode_info_raw = line[3:endpos]
+                    barcode_info = barcode_info_raw.split(';')[:6]
+                    if len(barcode_info) == 1:
+                        mode = 2
+                        obj = self.img_dict[barcode_info[0]]
+                    else:
+                        barcode_name, barcode_type, barcode_scale, barcode_w, barcode_h, barcode_data = barcode_info
+                        # the type can be suffixed with the engine, for example qrcode@vector
+                        if '@' in barcode_type:
+                            barcode_type, barcode_engine = barcode_type.split('@', 1)
+                        else:
+                            barcode_engine = ENGINE_GHOSTSCRIPT
+                        barcode_obj = Barcode(library=loader.get_local_path(BARCODE_LIBRARY),
+                                              width=self.unit * float(barcode_w), 
+                                              height=self.unit * float(barcode_h), 
+                                              data=barcode_data, 
+                                              scale=float(barcode_scale), 
+                                              type=barcode_type,
+                                              engine=barcode_engine)
+                        align = line[endpos+1:endpos+2]
+                        if align == '<': barcode_obj.hAlign = 'LEFT'
+                        elif align == '>': barcode_obj.hAlign = 'RIGHT'
+                        self.img_dict[barcode_name] = barcode_obj
+                elif elem == 'F':
+                    font_info_raw = line[3:endpos]
+                    font_info = font_info_raw.split(';')[:2]
+                    self.import_pdf_font(font_info[1], font_info[0])
+                elif elem == 'H':
+                    # header or footer: ~H[top|bottom;align;font;size]text with {page} and {pages}
+                    header_info = line[3:endpos].split(';')
+                    header_info += [''] * (4 - len(header_info))
+                    position, align, font_name, font_size = header_info[:4]
+                    self.page_decorator.add(RunningText(line[endpos+1:],
+                                                        position=position or POSITION_BOTTOM,
+                                                        align=align or 'center',
+                                                        font_name=font_name or 'Helvetica',
+                                                        font_size=toLength(font_size) if font_size else 9))
+                elif elem == 'P':
+                    if '[' in line:
+                        self.parts_buffer = line[3:endpos]
+                        self.parts_buffer_dict[self.parts_buffer] = []
+                    else:
+                        self.parts_buffer = None
+            elif token == TOKEN_TABLE:
+                mode = 1
+                raw_table_data.append(line)
+            else:
+                if mode == 0:
+                    content.append(line)
+                elif mode == 1:
+                    raw_table_data.append(line)
         
         return self.parts
         
+    @timer(PHASE_BUILD)
     def merge_parts(self, parts):
         if self.doc is not None:
-            self.doc.build(parts)
+            self.doc.build(parts, canvasmaker=PageCanvas)
+            if self.stream_output:
+                return self.out_buffer
             output_data = self.out_buffer.getvalue()
             self.out_buffer.close()
             
@@ -369,69 +438,18 @@ class Parser(object):
                                      leftMargin=leftMargin*unit,
                                      rightMargin=rightMargin*unit,
                                      bottomMargin=bottomMargin*unit,
+                                     invariant=self.invariant,
                                      canvasmaker=make_canvas)
+        self.page_decorator.install(self.doc)
         
     def parse_table_style(self, raw_style):
-        parts = raw_style.split('$')
-        topleft, bottomright = (list(int(q) for q in p.split(',')) for p in parts[0].split(':'))
-        top = topleft[0]
-        left = topleft[-1]
-        bottom = bottomright[0]
-        right = bottomright[-1]
-        cells = [(top, left), (bottom, right)]
-        desc = CSS_DICT.get(parts[1], parts[1].upper())
-        params = parts[2:]
-        
-        for i in xrange(len(params)):
-            param = params[i]
-            if param[0] == '#':
-                params[i] = colors.HexColor(eval('0x' + param[1:]))
-            elif param[-1] == 'u' :
-                params[i] = float(param[:-1])*self.unit
-            else:
-                try:
-                    floatval = float(param)
-                    params[i] = floatval
-                except ValueError:
-                    params[i] = param.upper()
-        
-        style = [desc] + cells + params
-        return style
+        return compile_table_style(raw_style, self.unit)
     
     def parse_paragraph_style(self, raw_style):
         if '=' in raw_style:
             # define
-            name, definition = (i.strip() for i in raw_style.split('=', 1))
-            if '+' in definition:
-                source_name, definition = (i.strip() for i in definition.split('+', 1))
-            else:
-                source_name = None
-            
-            def_dict = eval(definition)
-            new_dict = {}
-            for k in def_dict.keys():
-                v = def_dict[k]
-                nk = CSS_DICT.get(k, k)
-                # translate v
-                v = CSS_DICT.get(v, v)
-                if nk == 'fontSize' or nk == 'leading': v = toLength(v)
-                elif nk == 'color': v = colors.HexColor(eval('0x' + v[1:]))
-                new_dict[nk] = v
-                
-            if not new_dict.has_key('leading') and new_dict.has_key('fontSize'):
-                new_dict['leading'] = new_dict['fontSize'] + 2.0
-                
-            if source_name is not None:
-                source_dict = self.styles[source_name].__dict__.copy()
-                source_dict.update(new_dict)
-                new_dict = source_dict
-            
-            new_dict.update({'name': name})
-            
-            if self.styles.has_key(name):
-                self.styles[name].__dict__.update(new_dict)
-            else:
-                self.styles.add(ParagraphStyle(**new_dict))
+            name, source_name, new_dict = compile_paragraph_style(raw_style)
+            define_style(self.styles, self.style_stack, name, source_name, new_dict)
                 
         else:
             name = raw_style.strip()
@@ -443,29 +461,39 @@ class Parser(object):
 
 
 
-try:
-    from lxml import etree
-except ImportError:
+etree = None
+
+def get_etree():
+    '''
+    Returns the ElementTree implementation, lxml when it is installed
+    '''
+    global etree
+
+    if etree is not None:
+        return etree
+
     try:
-        # Python 2.5
-        import xml.etree.cElementTree as etree
+        from lxml import etree as module
     except ImportError:
         try:
             # Python 2.5
-            import xml.etree.ElementTree as etree
+            import xml.etree.cElementTree as module
         except ImportError:
             try:
-                # normal cElementTree install
-                import cElementTree as etree
+                # Python 2.5
+                import xml.etree.ElementTree as module
             except ImportError:
                 try:
-                    # normal ElementTree install
-                    import elementtree.ElementTree as etree
+                    # normal cElementTree install
+                    import cElementTree as module
                 except ImportError:
-                    print("Failed to import ElementTree from any known place")
+                    # normal ElementTree install
+                    import elementtree.ElementTree as module
+    etree = module
+    return etree
 
 def inner_xml(e):
-    return etree.tostring(e)[len(e.tag)+2:-len(e.tag)-3]
+    return get_etree().tostring(e)[len(e.tag)+2:-len(e.tag)-3]
 
 class XmlParser(object):
     document = None
@@ -474,16 +502,30 @@ class XmlParser(object):
     style_stack = None
     media_root = ''
     barcode_library = ''
-    fonts = {}
+    barcode_pool = None
+    stream_output = False
+    page_decorator = None
+    loader = None
+    # 1 leaves the creation date and random document id out of the document
+    invariant = None
     
-    def __init__(self):
-        self.styles = getSampleStyleSheet()
-        self.out_buffer = StringIO()
+    def __init__(self, out_buffer=None):
+        patch_reportlab()
+        self.styles = LayeredStyleSheet()
+        self.page_decorator = PageDecorator()
+        if out_buffer is None:
+            self.out_buffer = StringIO()
+        else:
+            self.out_buffer = out_buffer
+            self.stream_output = True
         self.style_stack = []
         
+    @timer(PHASE_BUILD)
     def merge_parts(self, parts):
         if self.document is not None:
-            self.document.build(parts)
+            self.document.build(parts, canvasmaker=PageCanvas)
+            if self.stream_output:
+                return self.out_buffer
             output_data = self.out_buffer.getvalue()
             self.out_buffer.close()
             
@@ -492,12 +534,101 @@ class XmlParser(object):
             return None
     
     def parse(self, buffer):
-        parts = self.parse_parts(buffer)
-        return self.merge_parts(parts)
+        '''
+        Parses and builds the document incrementally: flowables are created while
+        the document is built and are released once they are drawn, see
+        FlowableStream. buffer is a string or a file-like object, which is read
+        with iterparse.
+        '''
+        parts = FlowableStream(self.iter_parts(buffer))
+        try:
+            return self.merge_parts(parts)
+        finally:
+            # the build time includes the time spent parsing
+            record(PHASE_PARSE, parts.seconds)
     
+    @timer(PHASE_PARSE)
     def parse_parts(self, buffer):
-        xdoc = etree.fromstring(buffer.encode('utf-8'))
-        return list(self.parse_element(xdoc))
+        return list(self.iter_parts(buffer))
+    
+    def iter_parts(self, buffer):
+        '''
+        Returns a generator of the flowables of the document in buffer, a string
+        or a file-like object
+        '''
+        segment_start = self.page_decorator.start_segment()
+        if hasattr(buffer, 'read'):
+            parts = self.iterparse_parts(buffer)
+        else:
+            if isinstance(buffer, unicode):
+                buffer = buffer.encode('utf-8')
+            self.get_loader().prefetch(self.find_assets(buffer))
+            xdoc = get_etree().fromstring(buffer)
+            parts = self.parse_element(xdoc)
+        return itertools.chain([segment_start], parts)
+    
+    def get_loader(self):
+        '''
+        Returns the AssetLoader of the SVG files, images and barcode library,
+        by default the files in media_root
+        '''
+        return self.loader or FileSystemLoader(self.media_root)
+    
+    def find_assets(self, buffer):
+        '''
+        Returns a generator of the names of the SVG files and images in the
+        document in buffer
+        '''
+        from xml.sax.saxutils import unescape
+        
+        for match in XML_ASSET_RE.finditer(buffer):
+            yield unescape(match.group(1) or match.group(2) or '', {'&quot;': '"', '&apos;': "'"})
+    
+    def is_container(self, e):
+        # the document element, divs and unknown elements only contain other elements
+        return e.tag in ('doc', 'div') or not hasattr(self, e.tag)
+    
+    def start_container(self, e):
+        if e.tag == 'doc':
+            self.make_document(e)
+        elif e.tag == 'div':
+            self.push_style(e)
+    
+    def end_container(self, e):
+        if e.tag == 'div':
+            self.pop_style(e)
+    
+    def iterparse_parts(self, source):
+        '''
+        Parses the file-like object source with iterparse. The children of the
+        document element and of the containers in it are parsed as soon as they
+        end, and are removed from the tree after that, so the document isn't kept
+        in memory.
+        '''
+        # elements that are open, with whether their children are parsed as
+        # soon as they end
+        stack = []
+        for event, e in get_etree().iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                streamed = (not stack or stack[-1][1]) and self.is_container(e)
+                if streamed:
+                    self.start_container(e)
+                stack.append((e, streamed))
+                continue
+            
+            e, streamed = stack.pop()
+            if streamed:
+                self.end_container(e)
+            elif not stack or stack[-1][1]:
+                for i in self.parse_element(e):
+                    yield i
+            else:
+                # this element is parsed together with its parent
+                continue
+            
+            if stack:
+                e.clear()
+                stack[-1][0].remove(e)
         
     def parse_element(self, e):
         method = getattr(self, e.tag, self.parse_children)
@@ -509,7 +640,7 @@ class XmlParser(object):
             for i in self.parse_element(c):
                 yield i
         
-    def doc(self, e):
+    def make_document(self, e):
         format = e.get('format', 'A4')
         raw_margins = e.get('margin', '2cm, 2cm, 2cm, 2cm')
         title = e.get('title')
@@ -535,46 +666,40 @@ class XmlParser(object):
                                               leftMargin=leftMargin,
                                               rightMargin=rightMargin,
                                               bottomMargin=bottomMargin,
-                                              canvasmaker=make_canvas)
+                                              invariant=self.invariant,
+                                     canvasmaker=make_canvas)
+            self.page_decorator.install(self.document)
+    
+    def doc(self, e):
+        self.make_document(e)
         
         for i in self.parse_children(e):
             yield i
     
     def style(self, e):
-        name = e.get('name')
-        source_name = e.get('base', None)
-        def_dict = dict(e.attrib)
-        
-        del def_dict['name']
-        if 'base' in def_dict:
-            del def_dict['base']
-        
-        new_dict = {}
-        for k in def_dict.keys():
-            v = def_dict[k]
-            nk = CSS_DICT.get(k, k)
-            # translate v
-            v = CSS_DICT.get(v, v)
-            if nk == 'fontSize' or nk == 'leading': v = toLength(v)
-            elif nk == 'color': v = colors.HexColor(eval('0x' + v[1:]))
-            new_dict[nk] = v
-            
-        if not new_dict.has_key('leading') and new_dict.has_key('fontSize'):
-            new_dict['leading'] = new_dict['fontSize'] + 2.0
-            
-        if source_name is not None:
-            source_dict = self.styles[source_name].__dict__.copy()
-            source_dict.update(new_dict)
-            new_dict = source_dict
+        name, source_name, new_dict = compile_xml_style(e.attrib)
+        define_style(self.styles, self.style_stack, name, source_name, new_dict)
         
-        new_dict.update({'name': name})
+        # make this function an empty generator
+        if False:
+            yield
+    
+    def running_text(self, e, position):
+        self.page_decorator.add(RunningText(e.text or '',
+                                            position=position,
+                                            align=e.get('align', 'center'),
+                                            font_name=e.get('font-family', 'Helvetica'),
+                                            font_size=toLength(e.get('font-size', '9pt'))))
+    
+    def header(self, e):
+        self.running_text(e, POSITION_TOP)
         
-        if self.styles.has_key(name):
-            self.styles[name].__dict__.update(new_dict)
-        else:
-            self.styles.add(ParagraphStyle(**new_dict))
+        if False:
+            yield
+    
+    def footer(self, e):
+        self.running_text(e, POSITION_BOTTOM)
         
-        # make this function an empty generator
         if False:
             yield
     
@@ -586,74 +711,33 @@ class XmlParser(object):
         if False:
             yield
     
-    def div(self, e):
+    def push_style(self, e):
         style = e.get('style', None)
         
         if style is not None:
             self.style_stack.append(self.styles[style])
-            
-        parts = list(self.parse_children(e))
-        
-        if style is not None:
+    
+    def pop_style(self, e):
+        if e.get('style', None) is not None:
             self.style_stack.pop()
+    
+    def div(self, e):
+        # the children are generated while the style is on the stack
+        self.push_style(e)
         
-        for i in parts:
+        for i in self.parse_children(e):
             yield i
+        
+        self.pop_style(e)
     
     def p(self, e):
         data = inner_xml(e)
-        para = Paragraph(data, self.style_stack[-1] if len(self.style_stack) > 0 else self.styles['Normal'])
+        para = make_paragraph(data, self.style_stack[-1] if len(self.style_stack) > 0 else self.styles['Normal'])
         yield para
     
     def tstyle(self, e):
-        area = e.get('area', '0:-1')
-        
-        topleft, bottomright = (list(int(q) for q in p.split(',')) for p in area.split(':'))
-        top = topleft[0]
-        left = topleft[-1]
-        bottom = bottomright[0]
-        right = bottomright[-1]
-        cells = [(top, left), (bottom, right)]
-        
-        tstyle_dict = dict(e.attrib)
-        if 'area' in tstyle_dict:
-            del tstyle_dict['area']
-        
-        if tstyle_dict.has_key('border'):
-            border = tstyle_dict['border']
-            tstyle_dict.update({'border-left': border,
-                                'border-right': border,
-                                'border-top': border,
-                                'border-bottom': border
-                                })
-            del tstyle_dict['border']
-        
-        if tstyle_dict.has_key('padding'):
-            padding = tstyle_dict['padding']
-            tstyle_dict.update({'padding-left': padding,
-                                'padding-right': padding,
-                                'padding-top': padding,
-                                'padding-bottom': padding
-                                })
-            del tstyle_dict['padding']
-        
-        for key in tstyle_dict.keys():
-            value = tstyle_dict[key]
-            desc = CSS_DICT.get(key, key.upper())
-            params = value.split(',')
-            
-            for i in xrange(len(params)):
-                param = params[i].strip()
-                if param[0] == '#':
-                    params[i] = colors.HexColor(eval('0x' + param[1:]))
-                else:
-                    try:
-                        floatval = toLength(param)
-                        params[i] = floatval
-                    except ValueError:
-                        params[i] = param.upper()
-            
-            yield [desc] + cells + params
+        for style in compile_xml_table_style(e.attrib):
+            yield style
     
     def tr(self, e): 
         for c in e:
@@ -664,6 +748,11 @@ class XmlParser(object):
     def table(self, e):
         cols = [toLength(i.strip()) for i in e.get('cols').split(',')]
         align = e.get('align', 'left').upper()
+        large = e.get('large', None)
+        if large is not None:
+            large = large.lower() in ('1', 'true', 'yes')
+        repeat_rows = int(e.get('repeat-rows', '0'))
+        chunk_rows = int(e.get('chunk-rows', '0'))
         
         tstyles = []
         rows = []
@@ -674,8 +763,8 @@ class XmlParser(object):
             else:
                 rows.append(list(self.parse_element(c)))
         
-        table_obj = Table(rows, cols, hAlign=align, style=tstyles)
-        yield table_obj
+        for table_obj in make_tables(rows, cols, align, tstyles, large, repeat_rows, chunk_rows):
+            yield table_obj
     
     def pagebreak(self, e):
         yield PageBreak()
@@ -693,23 +782,7 @@ class XmlParser(object):
         search = e.get('search', None)
         replace = e.get('replace', None)
         
-        fh = open(self.media_root + path, 'rb')
-        data = fh.read()
-        fh.close()
-        
-        if search is not None:
-            data = data.replace(search, replace)
-        
-        import xml.dom.minidom
-        svg = xml.dom.minidom.parseString(data).documentElement
-        from svglib.svglib import SvgRenderer
-        
-        svgRenderer = SvgRenderer()
-        svgRenderer.render(svg)
-        svg_obj = svgRenderer.finish()
-        
-        svg_obj.scale(scale, scale)
-        svg_obj.asDrawing(width, height)
+        svg_obj = load_svg(path, scale, width, height, search, replace, self.get_loader())
         
         yield svg_obj
     
@@ -719,7 +792,7 @@ class XmlParser(object):
         path = e.get('src')
         align = e.get('align', 'left').upper()
         
-        img_obj = Image(self.media_root + path, width=width, height=height)
+        img_obj = load_image(path, width=width, height=height, loader=self.get_loader())
         img_obj.hAlign = align
         
         yield img_obj
@@ -731,6 +804,10 @@ class XmlParser(object):
         value = e.get('value')
         align = e.get('align', 'left').upper()
         type = e.get('type', 'datamatrix')
+        engine = e.get('engine', ENGINE_GHOSTSCRIPT)
+        
+        if not self.barcode_library:
+            self.barcode_library = self.get_loader().get_local_path(BARCODE_LIBRARY)
         
         barcode_obj = Barcode(library=self.barcode_library,
                               width=width, 
@@ -738,29 +815,13 @@ class XmlParser(object):
                               data=value, 
                               scale=scale, 
                               type=type,
-                              align=align.lower())
+                              align=align.lower(),
+                              pool=self.barcode_pool,
+                              engine=engine)
         
         barcode_obj.hAlign = align
         
         yield barcode_obj
     
     def import_pdf_font(self, base_name, face_name):
-        import os
-        import reportlab
-        from reportlab.pdfbase import pdfmetrics
-        
-        if self.fonts.get(face_name, None) is None:
-            afm = os.path.join(settings.MEDIA_ROOT, base_name + '.afm')
-            pfb = os.path.join(settings.MEDIA_ROOT, base_name + '.pfb')
-        
-            try:
-                face = pdfmetrics.EmbeddedType1Face(afm, pfb)
-        
-                pdfmetrics.registerTypeFace(face)
-                font = pdfmetrics.Font(face_name, face_name, 'WinAnsiEncoding')
-                pdfmetrics.registerFont(font)
-            except:
-                pass
-        else:
-            self.fonts[face_name] = True
-    
+        import_pdf_font(base_name, face_name, self.loader)
@@ -0,0 +1,59 @@
+import logging
+import time
+
+logger = logging.getLogger('pdfgen')
+
+
+def warmup(fonts=None, svgs=None, images=None):
+    '''
+    Loads what every document needs into the process-wide caches: the parsers
+    with the ReportLab patches, the fonts in PDFGEN_FONTS, the base stylesheet,
+    the barcode library and the SVG files and images in PDFGEN_WARMUP_SVGS and
+    PDFGEN_WARMUP_IMAGES (asset names, see pdfgen.loaders).
+
+    Call it before a pre-forking server forks its workers, they share the
+    loaded data copy-on-write instead of each loading it on the first request.
+    '''
+    from django.conf import settings
+
+    start = time.time()
+
+    from pdfgen.parser import patch_reportlab, get_etree
+    from pdfgen.styles import get_base_stylesheet
+    from pdfgen.fonts import preload_fonts
+    from pdfgen.loaders import get_asset_loader
+    from pdfgen.barcode import BARCODE_LIBRARY
+
+    loader = get_asset_loader()
+    if svgs is None:
+        svgs = getattr(settings, 'PDFGEN_WARMUP_SVGS', ())
+    if images is None:
+        images = getattr(settings, 'PDFGEN_WARMUP_IMAGES', ())
+    loader.prefetch(list(svgs) + list(images) + [BARCODE_LIBRARY])
+
+    patch_reportlab()
+    get_etree()
+    preload_fonts(fonts)
+    get_base_stylesheet()
+
+    if loader.exists(BARCODE_LIBRARY):
+        from pdfgen.ghostscript import read_library
+        read_library(loader.get_local_path(BARCODE_LIBRARY))
+    try:
+        # the widgets of the vector barcode engine
+        from reportlab.graphics.barcode import getCodes
+        getCodes()
+    except ImportError:
+        pass
+
+    if svgs:
+        from pdfgen.svg import get_drawing
+        for path in svgs:
+            get_drawing(path, loader=loader)
+
+    if images:
+        from pdfgen.images import load_image
+        for path in images:
+            load_image(path, loader=loader)
+
+    logger.info('Warmed up pdfgen with %d SVG file(s) and %d image(s) in %.3fs', len(svgs), len(images), time.time() - start)
@@ -1,39 +1,160 @@
-from pdfgen.parser import Parser, XmlParser
 from django.template.context import Context
 from django.template.loader import render_to_string
 from django.http import HttpResponse
-from reportlab.platypus.flowables import PageBreak
 from django.utils import translation
 from django.conf import settings
-
-def get_parser(template_name):
-    import os
-
-    if template_name[-4:] == '.xml':
-        parser = XmlParser()
+from tempfile import SpooledTemporaryFile
+import os
+import threading
+from pdfgen.timing import timed, PHASE_TEMPLATE
+
+def get_parser(template_name, output=None, xml=None):
+    '''
+    Returns an XmlParser for templates ending with .xml and a Parser for the
+    others, unless xml is given
+    '''
+    from pdfgen.parser import Parser, XmlParser
+    from pdfgen.loaders import get_asset_loader
+
+    if xml is None:
+        xml = template_name[-4:] == '.xml'
+
+    if xml:
+        parser = XmlParser(output)
         parser.media_root = settings.MEDIA_ROOT
-        parser.barcode_library = os.path.join(settings.MEDIA_ROOT, 'common', 'pdf_img', 'barcode.ps')
-        return parser
     else:
-        return Parser()
+        parser = Parser(output)
+    parser.loader = get_asset_loader()
+    return parser
+
+def render_template(template_name, context, context_instance):
+    with timed(PHASE_TEMPLATE):
+        return render_to_string(template_name, context, context_instance)
+
+class SpooledOutput(SpooledTemporaryFile):
+    # ReportLab uses the name of file-like outputs, which is None while the
+    # file is kept in memory
+    @property
+    def name(self):
+        return getattr(self._file, 'name', None) or '<spooled>'
+
+def make_spooled_output():
+    '''
+    Returns a temporary file for a PDF document, it is kept in memory up to
+    PDFGEN_SPOOL_MAX_SIZE bytes (default 5MB) and spooled to disk after that.
+    '''
+    return SpooledOutput(max_size=getattr(settings, 'PDFGEN_SPOOL_MAX_SIZE', 5 * 1024 * 1024))
+
+def make_pdf_response(filename, output=None):
+    '''
+    Returns the response for a PDF download. When output is a file-like object,
+    the response streams its contents instead of holding a copy of the document.
+    '''
+    if output is None:
+        response = HttpResponse(mimetype='application/pdf')
+    else:
+        from django.http import StreamingHttpResponse
+        from wsgiref.util import FileWrapper
+
+        output.seek(0)
+        response = StreamingHttpResponse(FileWrapper(output), content_type='application/pdf')
+    response['Content-Disposition'] = u'attachment; filename=%s' % (filename or u'document.pdf')
+    return response
+
+def get_pdf_cache():
+    '''
+    Returns the Django cache backend for rendered PDFs, PDFGEN_CACHE_BACKEND
+    (default: 'default')
+    '''
+    from django.core.cache import get_cache
+
+    return get_cache(getattr(settings, 'PDFGEN_CACHE_BACKEND', 'default'))
+
+def get_pdf_digest(template_name, input):
+    '''
+    Returns the digest of a rendered template, used as cache key and ETag
+    '''
+    import hashlib
+
+    if isinstance(input, unicode):
+        input = input.encode('utf-8')
+    return hashlib.sha1(template_name.encode('utf-8') + '\0' + input).hexdigest()
+
+def get_cached_pdf(template_name, input, cache_timeout, digest=None):
+    '''
+    Returns the PDF for a rendered template from the cache, and builds and caches
+    it when it isn't cached yet
+    '''
+    cache = get_pdf_cache()
+    key = 'pdfgen:%s' % (digest or get_pdf_digest(template_name, input))
+
+    output = cache.get(key)
+    if output is None:
+        output = get_parser(template_name).parse(input)
+        cache.set(key, output, cache_timeout)
+    return output
 
 
 
-def render_to_pdf_data(template_name, context, context_instance=None):
+def render_to_pdf_data(template_name, context, context_instance=None, output=None, cache_timeout=None):
+    '''
+    Renders the template to a PDF document. Returns the document data, or output
+    when a file-like object is given to write the document to.
+
+    With cache_timeout, the document is cached on the template name and the
+    rendered template, see get_cached_pdf.
+    '''
     context_instance = context_instance or Context()
 
-    input = render_to_string(template_name, context, context_instance)
-    parser = get_parser(template_name)
+    input = render_template(template_name, context, context_instance)
+
+    if cache_timeout is not None:
+        data = get_cached_pdf(template_name, input, cache_timeout)
+        if output is None:
+            return data
+        output.write(data)
+        return output
+
+    parser = get_parser(template_name, output)
 
     return parser.parse(input)
 
-def render_to_pdf_download(template_name, context, context_instance=None, filename=None):
+def render_to_pdf_download(template_name, context, context_instance=None, filename=None, streaming=False, cache_timeout=None, request=None):
+    '''
+    Renders the template to a PDF download.
+
+    With cache_timeout, the document is cached and the response gets an ETag.
+    When request is given and its If-None-Match matches, a 304 response is
+    returned without building the document. Cached documents aren't streamed.
+    '''
     context_instance = context_instance or Context()
 
-    response = HttpResponse(mimetype='application/pdf')
-    response['Content-Disposition'] = u'attachment; filename=%s' % (filename or u'document.pdf')
+    input = render_template(template_name, context, context_instance)
+
+    if cache_timeout is not None:
+        from django.http import HttpResponseNotModified
+        from django.utils.http import parse_etags, quote_etag
 
-    input = render_to_string(template_name, context, context_instance)
+        digest = get_pdf_digest(template_name, input)
+        etag = quote_etag(digest)
+
+        etags = []
+        if request is not None and request.META.get('HTTP_IF_NONE_MATCH'):
+            etags = parse_etags(request.META['HTTP_IF_NONE_MATCH'])
+
+        if '*' in etags or digest in etags:
+            response = HttpResponseNotModified()
+        else:
+            response = make_pdf_response(filename)
+            response.write(get_cached_pdf(template_name, input, cache_timeout, digest))
+        response['ETag'] = etag
+        return response
+
+    if streaming:
+        parser = get_parser(template_name, make_spooled_output())
+        return make_pdf_response(filename, parser.parse(input))
+
+    response = make_pdf_response(filename)
 
     parser = get_parser(template_name)
     output = parser.parse(input)
@@ -42,37 +163,204 @@ def render_to_pdf_download(template_name, context, context_instance=None, filena
 
     return response
 
-def multiple_templates_to_pdf_download(template_names, context, context_instance=None, filename=None):
+def multiple_templates_to_pdf_data(template_names, context, context_instance=None, output=None):
+    '''
+    Renders every template to its own PDF with its own document settings, and
+    concatenates their pages. Without PyPDF2 or pyPdf the flowables of all templates
+    are built as one document, with the document settings of the last template.
+    '''
+    from reportlab.platypus.flowables import PageBreak
+    from pdfgen.merge import get_pdf_library, concatenate_pdfs
+
     context_instance = context_instance or Context()
 
-    response = HttpResponse(mimetype='application/pdf')
-    response['Content-Disposition'] = u'attachment; filename=%s' % (filename or u'document.pdf')
+    try:
+        get_pdf_library()
+    except ImportError:
+        pass
+    else:
+        segments = [render_to_pdf_data(template_name, context, context_instance) for template_name in template_names]
+        return concatenate_pdfs(segments, output)
 
     all_parts = []
 
     for template_name in template_names:
-        parser = get_parser(template_name)
-        input = render_to_string(template_name, context, context_instance)
+        parser = get_parser(template_name, output)
+        input = render_template(template_name, context, context_instance)
         parts = parser.parse_parts(input)
         all_parts += parts
         all_parts.append(PageBreak())
 
-    output = parser.merge_parts(all_parts)
+    return parser.merge_parts(all_parts)
+
+def multiple_templates_to_pdf_download(template_names, context, context_instance=None, filename=None, streaming=False):
+    if streaming:
+        output = multiple_templates_to_pdf_data(template_names, context, context_instance, make_spooled_output())
+        return make_pdf_response(filename, output)
+
+    response = make_pdf_response(filename)
+
+    output = multiple_templates_to_pdf_data(template_names, context, context_instance)
 
     response.write(output)
 
     return response
 
-def multiple_contexts_to_pdf_data(template_name, contexts, context_instance):
+def get_context_data(context_instance):
+    '''
+    Returns the variables and settings of a context instance as picklable
+    arguments for make_context, so a context instance can be passed to other
+    processes
+    '''
+    if context_instance is None:
+        return None
+
+    variables = {}
+    for d in context_instance.dicts:
+        variables.update(d)
+    return variables, {
+        'autoescape': context_instance.autoescape,
+        'current_app': context_instance.current_app,
+        'use_l10n': context_instance.use_l10n,
+        'use_tz': context_instance.use_tz,
+    }
+
+def make_context(context_data):
+    '''
+    Returns a context instance for the result of get_context_data
+    '''
+    if context_data is None:
+        return Context()
+
+    variables, kwargs = context_data
+    return Context(variables, **kwargs)
+
+def render_segment(args):
+    '''
+    Renders a group of (context, template name) tuples to one PDF segment,
+    this runs in the worker processes of render_segments_in_parallel. args is
+    (contexts_templates, context_data), see get_context_data. Returns the
+    segment, its number of pages and the running texts of its deferred forms.
+    '''
+    contexts_templates, context_data = args
+    output, page_decorator = build_contexts_and_templates(contexts_templates, make_context(context_data),
+                                                          defer_numbers=True)
+    return output, page_decorator.pages, page_decorator.deferred
+
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+def get_render_pool(processes):
+    '''
+    Returns the process pool of render_segments_in_parallel with the given
+    number of processes, it is created once per process and reused. The pools
+    are terminated when the process exits, see close_render_pools.
+    '''
+    key = (os.getpid(), processes)
+    pool = _render_pools.get(key, None)
+    if pool is not None:
+        return pool
+
+    _render_pools_lock.acquire()
+    try:
+        pool = _render_pools.get(key, None)
+        if pool is None:
+            from multiprocessing import Pool
+            from django.db import connection
+
+            if not _render_pools:
+                import atexit
+                atexit.register(close_render_pools)
+
+            # don't share the database connection with the worker processes
+            connection.close()
+            pool = _render_pools[key] = Pool(processes)
+        return pool
+    finally:
+        _render_pools_lock.release()
+
+def close_render_pools():
+    '''
+    Terminates the process pools of render_segments_in_parallel that this
+    process started
+    '''
+    pid = os.getpid()
+
+    _render_pools_lock.acquire()
+    try:
+        pools = [pool for key, pool in _render_pools.items() if key[0] == pid]
+        for key in _render_pools.keys():
+            if key[0] == pid:
+                del _render_pools[key]
+    finally:
+        _render_pools_lock.release()
+
+    for pool in pools:
+        pool.terminate()
+        pool.join()
+
+def render_segments_in_parallel(contexts_templates, processes, group_size=1, output=None, context_instance=None):
+    '''
+    Renders every group of group_size (context, template name) tuples to its own
+    PDF in a pool of processes, and concatenates the pages in their original order.
+
+    Page numbers continue across the segments like in a document that is rendered
+    serially: the segments draw their page numbers in forms, which are replaced
+    with forms showing the actual numbers when the segments are concatenated.
+    The contexts and the variables of context_instance must be picklable.
+    '''
+    from pdfgen.merge import concatenate_pdfs, read_forms
+    from pdfgen.pagenumbers import render_forms
+
+    contexts_templates = list(contexts_templates)
+    groups = [contexts_templates[i:i + group_size] for i in xrange(0, len(contexts_templates), group_size)]
+    context_data = get_context_data(context_instance)
+
+    pool = get_render_pool(processes)
+    results = pool.map(render_segment, [(group, context_data) for group in groups])
+
+    if not any(deferred for segment, pages, deferred in results):
+        return concatenate_pdfs([segment for segment, pages, deferred in results], output)
+
+    total_pages = sum(pages for segment, pages, deferred in results)
+    lines = []
+    names = []
+    page_offset = 0
+    for index, (segment, pages, deferred) in enumerate(results):
+        segment_names = {}
+        for name, text, layout, page in deferred:
+            form_name = 'pdfgen_segment_%d_%s' % (index, name)
+            lines.append((form_name, text, layout, page + page_offset, total_pages))
+            segment_names['/FormXob.' + name] = '/FormXob.' + form_name
+        names.append(segment_names)
+        page_offset += pages
+
+    forms = read_forms(render_forms(lines))
+    forms = [dict((name, forms[form_name]) for name, form_name in segment_names.items())
+             for segment_names in names]
+
+    return concatenate_pdfs([segment for segment, pages, deferred in results], output, forms=forms)
+
+def multiple_contexts_to_pdf_data(template_name, contexts, context_instance, output=None, processes=None, group_size=1):
+    '''
+    Renders the template once for every context into one document. With processes,
+    groups of group_size contexts are rendered in parallel, see render_segments_in_parallel.
+    '''
+    if processes:
+        return render_segments_in_parallel(((context, template_name) for context in contexts), processes, group_size,
+                                           output, context_instance)
+
+    from reportlab.platypus.flowables import PageBreak
+
     all_parts = []
-    parser = get_parser(template_name)
+    parser = get_parser(template_name, output)
 
     old_lang = translation.get_language()
 
     for context in contexts:
         if 'language' in context:
             translation.activate(context['language'])
-        input = render_to_string(template_name, context, context_instance)
+        input = render_template(template_name, context, context_instance)
         parts = parser.parse_parts(input)
         all_parts += parts
         all_parts.append(PageBreak())
@@ -83,41 +371,64 @@ def multiple_contexts_to_pdf_data(template_name, contexts, context_instance):
 
     return output
 
-def multiple_contexts_to_pdf_download(template_name, contexts, context_instance=None, filename=None):
+def multiple_contexts_to_pdf_download(template_name, contexts, context_instance=None, filename=None, streaming=False, processes=None, group_size=1):
     context_instance = context_instance or Context()
 
-    response = HttpResponse(mimetype='application/pdf')
-    response['Content-Disposition'] = u'attachment; filename=%s' % (filename or u'document.pdf')
+    if streaming:
+        output = multiple_contexts_to_pdf_data(template_name, contexts, context_instance, make_spooled_output(), processes, group_size)
+        return make_pdf_response(filename, output)
+
+    response = make_pdf_response(filename)
 
-    output = multiple_contexts_to_pdf_data(template_name, contexts, context_instance)
+    output = multiple_contexts_to_pdf_data(template_name, contexts, context_instance, processes=processes, group_size=group_size)
 
     response.write(output)
 
     return response
 
-def multiple_contexts_and_templates_to_pdf_download(contexts_templates, context_instance=None, filename=None):
-    context_instance = context_instance or Context()
-
-    response = HttpResponse(mimetype='application/pdf')
-    response['Content-Disposition'] = u'attachment; filename=%s' % (filename or u'document.pdf')
+def build_contexts_and_templates(contexts_templates, context_instance, output=None, defer_numbers=False):
+    '''
+    Renders every (context, template name) tuple into one document, returns the
+    document and its PageDecorator. With defer_numbers, all page numbers are
+    drawn in forms, see PageDecorator.
+    '''
+    from reportlab.platypus.flowables import PageBreak
 
     all_parts = []
 
     old_lang = translation.get_language()
 
     for context, template_name in contexts_templates:
-        parser = get_parser(template_name)
+        parser = get_parser(template_name, output)
         if 'language' in context:
             translation.activate(context['language'])
-        input = render_to_string(template_name, context, context_instance)
+        input = render_template(template_name, context, context_instance)
         parts = parser.parse_parts(input)
         all_parts += parts
         all_parts.append(PageBreak())
 
+    parser.page_decorator.defer_numbers = defer_numbers
     output = parser.merge_parts(all_parts)
 
     translation.activate(old_lang)
 
+    return output, parser.page_decorator
+
+def multiple_contexts_and_templates_to_pdf_data(contexts_templates, context_instance=None, output=None, processes=None, group_size=1):
+    if processes:
+        return render_segments_in_parallel(contexts_templates, processes, group_size, output, context_instance)
+
+    return build_contexts_and_templates(contexts_templates, context_instance or Context(), output)[0]
+
+def multiple_contexts_and_templates_to_pdf_download(contexts_templates, context_instance=None, filename=None, streaming=False, processes=None, group_size=1):
+    if streaming:
+        output = multiple_contexts_and_templates_to_pdf_data(contexts_templates, context_instance, make_spooled_output(), processes, group_size)
+        return make_pdf_response(filename, output)
+
+    response = make_pdf_response(filename)
+
+    output = multiple_contexts_and_templates_to_pdf_data(contexts_templates, context_instance, processes=processes, group_size=group_size)
+
     response.write(output)
 
     return response
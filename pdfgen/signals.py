@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# sent after every instrumented phase of building a PDF, see pdfgen.timing.
+# duration is in seconds, memory_peak in bytes or None when tracemalloc isn't tracing.
+phase_finished = Signal(providing_args=['phase', 'duration', 'memory_peak'])
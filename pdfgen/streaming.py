@@ -0,0 +1,53 @@
+import time
+
+
+class FlowableStream(list):
+    '''
+    A list of flowables that is filled from an iterator while ReportLab builds
+    the document, so flowables are only created shortly before they are laid
+    out and can be released as soon as they are drawn.
+
+    ReportLab's build loop checks len(flowables) before handling the next
+    flowable, the list is topped up to lookahead flowables at that moment.
+    Flowables that keep with the next one are always followed by at least one
+    more flowable, so they can be kept together.
+
+    seconds is the time spent in the iterator.
+    '''
+
+    def __init__(self, iterator, lookahead=2):
+        list.__init__(self)
+        self.iterator = iter(iterator)
+        self.lookahead = lookahead
+        self.exhausted = False
+        self.seconds = 0.0
+        self.fill()
+
+    def fill(self):
+        if self.exhausted:
+            return
+
+        start = time.time()
+        try:
+            while list.__len__(self) < self.lookahead or self.keeps_with_next():
+                try:
+                    self.append(self.iterator.next())
+                except StopIteration:
+                    self.exhausted = True
+                    self.iterator = None
+                    break
+        finally:
+            self.seconds += time.time() - start
+
+    def keeps_with_next(self):
+        if not list.__len__(self):
+            return False
+        get_keep_with_next = getattr(self[-1], 'getKeepWithNext', None)
+        return get_keep_with_next is not None and get_keep_with_next()
+
+    def __len__(self):
+        self.fill()
+        return list.__len__(self)
+
+    def __nonzero__(self):
+        return len(self) > 0
@@ -0,0 +1,279 @@
+import copy
+import threading
+
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_RIGHT, TA_CENTER, TA_LEFT
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import toLength
+
+from pdfgen.cache import LRUCache
+
+
+CSS_DICT = {
+    'padding-left': 'LEFTPADDING',
+    'padding-right': 'RIGHTPADDING',
+    'padding-top': 'TOPPADDING',
+    'padding-bottom': 'BOTTOMPADDING',
+    'border-left': 'LINEBEFORE',
+    'border-right': 'LINEAFTER',
+    'border-top': 'LINEABOVE',
+    'border-bottom': 'LINEBELOW',
+    'text-align': 'alignment',
+    'font-family': 'fontName',
+    'font-size': 'fontSize',
+    'color': 'textColor',
+    'left': TA_LEFT,
+    'right': TA_RIGHT,
+    'center': TA_CENTER,
+}
+
+
+_base_stylesheet = None
+_base_stylesheet_lock = threading.Lock()
+
+def get_base_stylesheet():
+    '''
+    Returns the sample stylesheet shared by all parsers, it must not be changed.
+    '''
+    global _base_stylesheet
+
+    if _base_stylesheet is None:
+        _base_stylesheet_lock.acquire()
+        try:
+            if _base_stylesheet is None:
+                _base_stylesheet = getSampleStyleSheet()
+        finally:
+            _base_stylesheet_lock.release()
+    return _base_stylesheet
+
+
+class LayeredStyleSheet(object):
+    '''
+    A stylesheet of a single document on top of the shared base stylesheet.
+    Styles of the base stylesheet are copied before they are changed.
+    '''
+
+    def __init__(self, base=None):
+        self.base = base or get_base_stylesheet()
+        self.styles = {}
+
+    def __getitem__(self, name):
+        if name in self.styles:
+            return self.styles[name]
+        return self.base[name]
+
+    def has_key(self, name):
+        return name in self.styles or self.base.has_key(name)
+
+    __contains__ = has_key
+
+    def add(self, style):
+        self.styles[style.name] = style
+
+    def get_own(self, name):
+        '''
+        Returns a style that can be changed, and the base style it replaces or None
+        '''
+        if name in self.styles:
+            return self.styles[name], None
+        base_style = self.base[name]
+        style = copy.copy(base_style)
+        style.__dict__ = base_style.__dict__.copy()
+        self.styles[name] = style
+        return style, base_style
+
+
+_style_cache = None
+
+def get_style_cache():
+    '''
+    Returns the process-wide cache of compiled styles, the number of entries is
+    set with PDFGEN_STYLE_CACHE_SIZE (0 disables the cache).
+    '''
+    global _style_cache
+
+    if _style_cache is None:
+        from django.conf import settings
+
+        size = getattr(settings, 'PDFGEN_STYLE_CACHE_SIZE', 1024)
+        if not size:
+            return None
+        _style_cache = LRUCache(size)
+    return _style_cache
+
+
+def cached(key, func, *args):
+    cache = get_style_cache()
+    if cache is None:
+        return func(*args)
+
+    value = cache.get(key)
+    if value is None:
+        value = func(*args)
+        cache.set(key, value)
+    return value
+
+
+def compile_style_dict(def_dict):
+    '''
+    Translates a dict with CSS-like style properties to ParagraphStyle arguments
+    '''
+    new_dict = {}
+    for k in def_dict.keys():
+        v = def_dict[k]
+        nk = CSS_DICT.get(k, k)
+        # translate v
+        v = CSS_DICT.get(v, v)
+        if nk == 'fontSize' or nk == 'leading': v = toLength(v)
+        elif nk == 'color': v = colors.HexColor(eval('0x' + v[1:]))
+        new_dict[nk] = v
+
+    if not new_dict.has_key('leading') and new_dict.has_key('fontSize'):
+        new_dict['leading'] = new_dict['fontSize'] + 2.0
+
+    return new_dict
+
+
+def _compile_paragraph_style(raw_style):
+    name, definition = (i.strip() for i in raw_style.split('=', 1))
+    if '+' in definition:
+        source_name, definition = (i.strip() for i in definition.split('+', 1))
+    else:
+        source_name = None
+
+    return name, source_name, compile_style_dict(eval(definition))
+
+def compile_paragraph_style(raw_style):
+    '''
+    Compiles a CLTR style definition like "name = source + {...}", returns a
+    tuple (name, source name, style dict). The style dict must not be changed.
+    '''
+    return cached(('paragraph', raw_style), _compile_paragraph_style, raw_style)
+
+
+def _compile_xml_style(attrib):
+    def_dict = dict(attrib)
+    name = def_dict.pop('name')
+    source_name = def_dict.pop('base', None)
+    return name, source_name, compile_style_dict(def_dict)
+
+def compile_xml_style(attrib):
+    '''
+    Compiles the attributes of a <style> element, see compile_paragraph_style
+    '''
+    items = tuple(sorted(attrib.items()))
+    return cached(('xml', items), _compile_xml_style, items)
+
+
+def define_style(styles, style_stack, name, source_name, new_dict):
+    '''
+    Adds or updates a paragraph style in a LayeredStyleSheet
+    '''
+    if source_name is not None:
+        source_dict = styles[source_name].__dict__.copy()
+        source_dict.update(new_dict)
+        new_dict = source_dict
+    else:
+        new_dict = dict(new_dict)
+
+    new_dict.update({'name': name})
+
+    if styles.has_key(name):
+        style, base_style = styles.get_own(name)
+        if base_style is not None:
+            # the style stack may still refer to the shared style
+            style_stack[:] = [style if i is base_style else i for i in style_stack]
+        style.__dict__.update(new_dict)
+    else:
+        styles.add(ParagraphStyle(**new_dict))
+
+
+def _compile_table_style(raw_style, unit):
+    parts = raw_style.split('$')
+    topleft, bottomright = (list(int(q) for q in p.split(',')) for p in parts[0].split(':'))
+    top = topleft[0]
+    left = topleft[-1]
+    bottom = bottomright[0]
+    right = bottomright[-1]
+    cells = [(top, left), (bottom, right)]
+    desc = CSS_DICT.get(parts[1], parts[1].upper())
+    params = parts[2:]
+
+    for i in xrange(len(params)):
+        param = params[i]
+        if param[0] == '#':
+            params[i] = colors.HexColor(eval('0x' + param[1:]))
+        elif param[-1] == 'u' :
+            params[i] = float(param[:-1])*unit
+        else:
+            try:
+                floatval = float(param)
+                params[i] = floatval
+            except ValueError:
+                params[i] = param.upper()
+
+    return tuple([desc] + cells + params)
+
+def compile_table_style(raw_style, unit):
+    '''
+    Compiles a CLTR table style like "0,0:-1,-1$border-top$0.5$#000000",
+    lengths ending with u are multiplied with unit
+    '''
+    return list(cached(('table', raw_style, unit), _compile_table_style, raw_style, unit))
+
+
+def _compile_xml_table_style(items):
+    tstyle_dict = dict(items)
+    area = tstyle_dict.pop('area', '0:-1')
+
+    topleft, bottomright = (list(int(q) for q in p.split(',')) for p in area.split(':'))
+    top = topleft[0]
+    left = topleft[-1]
+    bottom = bottomright[0]
+    right = bottomright[-1]
+    cells = [(top, left), (bottom, right)]
+
+    if tstyle_dict.has_key('border'):
+        border = tstyle_dict['border']
+        tstyle_dict.update({'border-left': border,
+                            'border-right': border,
+                            'border-top': border,
+                            'border-bottom': border
+                            })
+        del tstyle_dict['border']
+
+    if tstyle_dict.has_key('padding'):
+        padding = tstyle_dict['padding']
+        tstyle_dict.update({'padding-left': padding,
+                            'padding-right': padding,
+                            'padding-top': padding,
+                            'padding-bottom': padding
+                            })
+        del tstyle_dict['padding']
+
+    commands = []
+    for key in tstyle_dict.keys():
+        value = tstyle_dict[key]
+        desc = CSS_DICT.get(key, key.upper())
+        params = value.split(',')
+
+        for i in xrange(len(params)):
+            param = params[i].strip()
+            if param[0] == '#':
+                params[i] = colors.HexColor(eval('0x' + param[1:]))
+            else:
+                try:
+                    floatval = toLength(param)
+                    params[i] = floatval
+                except ValueError:
+                    params[i] = param.upper()
+
+        commands.append(tuple([desc] + cells + params))
+    return tuple(commands)
+
+def compile_xml_table_style(attrib):
+    '''
+    Compiles the attributes of a <tstyle> element to a list of table style commands
+    '''
+    items = tuple(sorted(attrib.items()))
+    return [list(i) for i in cached(('xml_table', items), _compile_xml_table_style, items)]
@@ -0,0 +1,119 @@
+import threading
+
+from reportlab.platypus.flowables import Flowable
+
+from pdfgen.cache import LRUCache
+from pdfgen.loaders import local_loader
+from pdfgen.assets import get_shared_assets, make_asset_name
+from pdfgen.timing import timer, PHASE_SVG
+
+
+_svg_cache = None
+
+def get_svg_cache():
+    '''
+    Returns the process-wide cache of rendered SVG files, the number of entries is
+    set with PDFGEN_SVG_CACHE_SIZE (0 disables the cache).
+    '''
+    global _svg_cache
+
+    if _svg_cache is None:
+        from django.conf import settings
+
+        size = getattr(settings, 'PDFGEN_SVG_CACHE_SIZE', 64)
+        if not size:
+            return None
+        _svg_cache = LRUCache(size)
+    return _svg_cache
+
+
+# the cached drawings share their shapes, and ReportLab sets attributes on the
+# shapes while it renders them
+_render_lock = threading.Lock()
+
+def render_drawing(drawing, canvas):
+    from reportlab.graphics import renderPDF
+
+    _render_lock.acquire()
+    try:
+        renderPDF.draw(drawing, canvas, 0, 0)
+    finally:
+        _render_lock.release()
+
+
+class SharedDrawing(Flowable):
+    '''
+    Draws a Drawing through a form XObject named form_name, so every occurrence
+    of the same drawing in a document refers to one copy.
+    '''
+
+    def __init__(self, drawing, form_name):
+        Flowable.__init__(self)
+        self.drawing = drawing
+        self.form_name = form_name
+        self.hAlign = getattr(drawing, 'hAlign', 'LEFT')
+        self.vAlign = getattr(drawing, 'vAlign', 'BOTTOM')
+
+    def wrap(self, availWidth, availHeight):
+        self.width, self.height = self.drawing.wrap(availWidth, availHeight)
+        return self.width, self.height
+
+    def draw(self):
+        get_shared_assets(self.canv).draw(self.canv, self.form_name, 'svg',
+                                          lambda canv: render_drawing(self.drawing, canv))
+
+
+@timer(PHASE_SVG)
+def render_svg(path, search=None, replace=None, loader=None):
+    '''
+    Reads and renders the SVG file at path to a ReportLab Drawing. path is
+    the name of the asset in loader, or a local path when loader isn't given.
+    '''
+    # slicing makes a string of mapped files, and returns strings as they are
+    svg_data = (loader or local_loader).read(path)[:]
+
+    if search is not None:
+        svg_data = svg_data.replace(search, replace)
+
+    import xml.dom.minidom
+    svg = xml.dom.minidom.parseString(svg_data).documentElement
+    from svglib.svglib import SvgRenderer
+
+    svgRenderer = SvgRenderer()
+    svgRenderer.render(svg)
+    return svgRenderer.finish()
+
+
+def get_drawing(path, search=None, replace=None, loader=None):
+    '''
+    Returns the rendered SVG file at path from the cache, which is keyed on the
+    asset, its mtime and search/replace. The drawing is shared, don't change it.
+    '''
+    cache = get_svg_cache()
+    if cache is None:
+        return render_svg(path, search, replace, loader)
+
+    loader = loader or local_loader
+    key = (loader.get_key(path), loader.get_modified_time(path), search, replace)
+    svg_obj = cache.get(key)
+    if svg_obj is None:
+        svg_obj = render_svg(path, search, replace, loader)
+        cache.set(key, svg_obj)
+    return svg_obj
+
+
+def load_svg(path, scale, width, height, search=None, replace=None, loader=None):
+    '''
+    Returns a SharedDrawing of the SVG file at path, scaled and sized to width x height.
+
+    The rendered SVG is cached, see get_drawing. Every call gets a shallow copy
+    of the cached drawing, so scaling it doesn't change the cached original.
+    '''
+    loader = loader or local_loader
+    svg_obj = get_drawing(path, search, replace, loader).copy()
+
+    svg_obj.scale(scale, scale)
+    svg_obj.asDrawing(width, height)
+
+    mtime = loader.get_modified_time(path)
+    return SharedDrawing(svg_obj, make_asset_name('svg', loader.get_key(path), mtime, search, replace, scale, width, height))
@@ -0,0 +1,69 @@
+from reportlab.platypus import Table
+from reportlab.platypus.tables import LongTable
+
+
+def get_large_table_rows():
+    '''
+    Tables with at least PDFGEN_LARGE_TABLE_ROWS rows are built in large-table
+    mode. The default 0 disables the threshold, so only the tables marked with
+    ~L[...] or large="1" are.
+    '''
+    from django.conf import settings
+
+    return getattr(settings, 'PDFGEN_LARGE_TABLE_ROWS', 0)
+
+
+def clip_style(style, row_count, start, end, offset):
+    '''
+    Clips the rows of a table style command to the rows start up to end, and
+    moves them by offset. Returns None when the command is outside those rows.
+    '''
+    desc, (c0, r0), (c1, r1) = style[0], style[1], style[2]
+    if r0 < 0: r0 += row_count
+    if r1 < 0: r1 += row_count
+
+    r0 = max(r0, start)
+    r1 = min(r1, end - 1)
+    if r0 > r1:
+        return None
+
+    return [desc, (c0, r0 - start + offset), (c1, r1 - start + offset)] + list(style[3:])
+
+
+def make_tables(rows, cols, hAlign, style, large=None, repeat_rows=0, chunk_rows=0):
+    '''
+    Returns a list of table flowables for rows.
+
+    In large-table mode the rows are built as LongTables that repeat the first
+    repeat_rows rows on every page. With chunk_rows the body is split into
+    LongTables of at most chunk_rows rows, each starting with the header rows.
+    Large mode is used when large is True, or when it is None and the table has
+    at least get_large_table_rows() rows, when that is set.
+    '''
+    cols = cols or None
+
+    if large is None:
+        threshold = get_large_table_rows()
+        large = bool(threshold) and len(rows) >= threshold
+
+    if not large:
+        return [Table(rows, cols, hAlign=hAlign, style=style)]
+
+    if not chunk_rows or len(rows) - repeat_rows <= chunk_rows:
+        return [LongTable(rows, cols, hAlign=hAlign, style=style, repeatRows=repeat_rows)]
+
+    row_count = len(rows)
+    header = rows[:repeat_rows]
+    tables = []
+    for start in xrange(repeat_rows, row_count, chunk_rows):
+        end = min(start + chunk_rows, row_count)
+
+        chunk_style = []
+        for command in style:
+            for clipped in (clip_style(command, row_count, 0, repeat_rows, 0),
+                            clip_style(command, row_count, start, end, repeat_rows)):
+                if clipped is not None:
+                    chunk_style.append(clipped)
+
+        tables.append(LongTable(header + rows[start:end], cols, hAlign=hAlign, style=chunk_style, repeatRows=repeat_rows))
+    return tables
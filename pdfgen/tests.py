@@ -0,0 +1,466 @@
+import os
+import re
+from cStringIO import StringIO
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from django.utils import unittest
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'test_templates')
+
+
+def get_page_texts(data):
+    '''
+    Returns the text of every page, including the text in form XObjects
+    '''
+    from pdfgen.merge import get_pdf_library
+
+    PdfFileReader, PdfFileWriter = get_pdf_library()
+    reader = PdfFileReader(StringIO(data))
+    texts = []
+    for i in range(reader.getNumPages()):
+        page = reader.getPage(i)
+        text = page.extractText()
+        for form in page['/Resources'].get('/XObject', {}).values():
+            form = form.getObject()
+            if form.get('/Subtype') == '/Form':
+                text += '\n'.join(re.findall(r'\((.*?)\) Tj', form.getData()))
+        texts.append(text)
+    return texts
+
+
+def has_pdf_library():
+    from pdfgen.merge import get_pdf_library
+
+    try:
+        get_pdf_library()
+    except ImportError:
+        return False
+    return True
+
+
+@unittest.skipUnless(has_pdf_library(), 'PyPDF2 or pyPdf is required to read the pages')
+@override_settings(TEMPLATE_DIRS=(TEMPLATE_DIR,))
+class RunningTextTest(SimpleTestCase):
+
+    def assert_footers(self, data, names):
+        texts = get_page_texts(data)
+        self.assertEqual(len(texts), len(names))
+        for page, (text, name) in enumerate(zip(texts, names)):
+            for other in names:
+                if other != name:
+                    self.assertNotIn('Customer %s' % other, text)
+            self.assertIn('Customer %s page %d of %d' % (name, page + 1, len(names)), text)
+
+    def test_multiple_contexts(self):
+        from pdfgen.shortcuts import multiple_contexts_to_pdf_data
+
+        names = ['alice', 'bob', 'carol']
+        data = multiple_contexts_to_pdf_data('footer.cltr', [{'name': i} for i in names], None)
+        self.assert_footers(data, names)
+
+    def test_multiple_contexts_and_templates(self):
+        from pdfgen.shortcuts import multiple_contexts_and_templates_to_pdf_data
+
+        names = ['alice', 'bob', 'carol']
+        data = multiple_contexts_and_templates_to_pdf_data([({'name': i}, 'footer.cltr') for i in names])
+        self.assert_footers(data, names)
+
+    def test_total_alignment(self):
+        from pdfgen.pagenumbers import PageCanvas, PageDecorator, RunningText
+
+        lines = []
+
+        class RecordingCanvas(PageCanvas):
+            def drawString(self, x, y, text, *args, **kwargs):
+                lines.append((x, text))
+                PageCanvas.drawString(self, x, y, text, *args, **kwargs)
+
+        class Doc(object):
+            pagesize = (500, 800)
+            leftMargin = rightMargin = topMargin = bottomMargin = 50
+
+        canvas = RecordingCanvas(StringIO(), pagesize=Doc.pagesize)
+        doc = Doc()
+        decorator = PageDecorator()
+        decorator.start_segment().apply(doc)
+        decorator.add(RunningText('Page {page} of {pages}', align='right'))
+        for i in range(120):
+            decorator(canvas, doc)
+            canvas.showPage()
+        canvas.save()
+
+        self.assertEqual(len(lines), 120)
+        x, text = lines[0]
+        self.assertEqual(text, 'Page 1 of 120')
+        self.assertAlmostEqual(x + canvas.stringWidth(text, 'Helvetica', 9), 450)
+
+    def test_parallel_page_numbers(self):
+        from pdfgen.shortcuts import multiple_contexts_to_pdf_data, get_render_pool
+
+        names = ['alice', 'bob', 'carol', 'dave', 'erin']
+        contexts = [{'name': i} for i in names]
+        serial = multiple_contexts_to_pdf_data('footer.cltr', contexts, None)
+        parallel = multiple_contexts_to_pdf_data('footer.cltr', contexts, None, processes=2, group_size=2)
+        self.assert_footers(parallel, names)
+        # the total is drawn directly or in a form, which changes the line breaks
+        self.assertEqual([i.split() for i in get_page_texts(parallel)], [i.split() for i in get_page_texts(serial)])
+        self.assertTrue(get_render_pool(2) is get_render_pool(2))
+
+    def test_parallel_context_instance(self):
+        from django.template.context import Context
+        from pdfgen.shortcuts import multiple_contexts_to_pdf_data
+
+        parallel = multiple_contexts_to_pdf_data('footer.cltr', [{}, {}], Context({'name': 'zed'}), processes=2)
+        self.assert_footers(parallel, ['zed', 'zed'])
+
+
+@unittest.skipUnless(has_pdf_library(), 'PyPDF2 or pyPdf is required to read the pages')
+@override_settings(TEMPLATE_DIRS=(TEMPLATE_DIR,))
+class MultipleTemplatesTest(SimpleTestCase):
+
+    def test_page_sizes_and_shared_fonts(self):
+        from pdfgen.merge import get_pdf_library
+        from pdfgen.shortcuts import multiple_templates_to_pdf_data
+
+        data = multiple_templates_to_pdf_data(['footer.cltr', 'letter.xml'], {'name': 'alice'})
+
+        PdfFileReader, PdfFileWriter = get_pdf_library()
+        reader = PdfFileReader(StringIO(data))
+        pages = [reader.getPage(i) for i in range(reader.getNumPages())]
+        self.assertEqual([[round(float(i)) for i in page.mediaBox[2:]] for page in pages],
+                         [[595, 842], [420, 595]])
+
+        fonts = [page['/Resources']['/Font'].getObject() for page in pages]
+        self.assertEqual(fonts[0].raw_get('/F1').idnum, fonts[1].raw_get('/F1').idnum)
+        if hasattr(PdfFileWriter, 'addMetadata'):
+            self.assertEqual(reader.getDocumentInfo().get('/Title'), 'Invoice')
+
+
+class FileSystemLoaderTest(SimpleTestCase):
+
+    def test_root_without_separator(self):
+        from pdfgen.loaders import FileSystemLoader
+
+        self.assertEqual(FileSystemLoader('/srv/media').get_path('common/pdf_img/barcode.ps'),
+                         os.path.join('/srv/media', 'common/pdf_img/barcode.ps'))
+        self.assertEqual(FileSystemLoader('/srv/media/').get_path('img/logo.svg'), '/srv/media/img/logo.svg')
+        self.assertEqual(FileSystemLoader().get_path('/srv/media/img/logo.svg'), '/srv/media/img/logo.svg')
+
+    def test_absolute_name(self):
+        from pdfgen.loaders import FileSystemLoader
+
+        self.assertEqual(FileSystemLoader('/srv/media').get_path('/usr/share/fonts/x.ttf'), '/usr/share/fonts/x.ttf')
+
+
+class StorageLoaderTest(SimpleTestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def test_storages_of_same_class(self):
+        from django.core.files.storage import FileSystemStorage
+        from pdfgen.loaders import StorageLoader
+
+        cache_dir = os.path.join(self.directory, 'cache')
+        loaders = []
+        for name in ('a', 'b'):
+            storage = FileSystemStorage(os.path.join(self.directory, name))
+            storage.save('asset.txt', ContentFile(name))
+            loaders.append(StorageLoader(storage, cache_dir=cache_dir))
+
+        self.assertNotEqual(loaders[0].get_key('asset.txt'), loaders[1].get_key('asset.txt'))
+        self.assertEqual([i.read('asset.txt') for i in loaders], ['a', 'b'])
+
+    def test_public_cache_dir(self):
+        from pdfgen.loaders import StorageLoader
+
+        cache_dir = os.path.join(self.directory, 'cache')
+        os.mkdir(cache_dir)
+        os.chmod(cache_dir, 0777)
+        self.assertRaises(IOError, StorageLoader, cache_dir=cache_dir)
+
+
+class BarcodeCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def test_private_directory(self):
+        import stat
+        from pdfgen.barcode import BarcodeCache
+
+        cache_dir = os.path.join(self.directory, 'barcodes')
+        cache = BarcodeCache(directory=cache_dir)
+        key = cache.make_key('barcode.ps', 'qrcode', 'data', 1, 1)
+        cache.set(key, (10.0, 20.0, 'png'))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(cache._disk_path(key))).st_mode) & 0077, 0)
+        self.assertEqual(BarcodeCache(directory=cache_dir).get(key), (10.0, 20.0, 'png'))
+
+    def test_public_directory(self):
+        from pdfgen.barcode import BarcodeCache
+
+        cache_dir = os.path.join(self.directory, 'barcodes')
+        os.mkdir(cache_dir)
+        os.chmod(cache_dir, 0777)
+        self.assertRaises(IOError, BarcodeCache, directory=cache_dir)
+
+
+class VectorBarcodeTest(SimpleTestCase):
+
+    def test_invalid_data(self):
+        from pdfgen.barcode import make_vector_drawing
+
+        self.assertEqual(make_vector_drawing('ean13', 'abc'), None)
+        self.assertEqual(make_vector_drawing('datamatrix', u'h\xe9llo'), None)
+
+    def test_fits_in_box(self):
+        from reportlab.pdfgen.canvas import Canvas
+        from pdfgen.barcode import Barcode, make_vector_drawing, ENGINE_VECTOR
+
+        scales = []
+
+        class RecordingCanvas(Canvas):
+            def scale(self, x, y):
+                scales.append(x)
+                Canvas.scale(self, x, y)
+
+        barcode = Barcode(None, 50, 50, 'hello', engine=ENGINE_VECTOR)
+        barcode.canv = RecordingCanvas(StringIO())
+        barcode.draw_barcode()
+        self.assertAlmostEqual(make_vector_drawing('datamatrix', 'hello').width * scales[0], 50)
+
+
+class GhostscriptPoolTest(SimpleTestCase):
+
+    def test_failed_start(self):
+        from pdfgen import ghostscript
+
+        class FailingWorker(object):
+            def __init__(self, library, timeout=None):
+                raise OSError('gs not found')
+
+        class Worker(object):
+            jobs = 0
+
+            def __init__(self, library, timeout=None):
+                self.closed = False
+
+            def is_alive(self):
+                return not self.closed
+
+            def close(self):
+                self.closed = True
+
+        pool = ghostscript.GhostscriptPool('barcode.ps', size=1)
+        original = ghostscript.GhostscriptWorker
+        try:
+            ghostscript.GhostscriptWorker = FailingWorker
+            self.assertRaises(OSError, pool.acquire)
+            self.assertEqual(pool.started, 0)
+
+            ghostscript.GhostscriptWorker = Worker
+            worker = pool.acquire()
+            pool.release(worker, discard=True)
+            self.assertTrue(worker.closed)
+            self.assertEqual(pool.started, 0)
+            self.assertFalse(pool.acquire() is worker)
+        finally:
+            ghostscript.GhostscriptWorker = original
+
+    def make_worker(self, args, timeout):
+        import subprocess
+        import tempfile
+        from pdfgen import ghostscript
+
+        # a worker whose process never answers a job
+        worker = ghostscript.GhostscriptWorker.__new__(ghostscript.GhostscriptWorker)
+        worker.library = 'barcode.ps'
+        worker.timeout = timeout
+        worker.jobs = 0
+        worker.buffer = ''
+        worker.directory = tempfile.mkdtemp(prefix='pdfgen-gs-')
+        worker.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return worker
+
+    def test_invalid_type(self):
+        worker = self.make_worker(['cat'], 1)
+        try:
+            self.assertEqual(worker.render('qrcode def (x) print', 'data', 1, 1), None)
+            self.assertEqual(worker.jobs, 0)
+        finally:
+            worker.close()
+
+    def test_timeout(self):
+        from pdfgen import ghostscript
+
+        worker = self.make_worker(['cat'], 0.2)
+        try:
+            self.assertRaises(ghostscript.GhostscriptError, worker.render, 'qrcode', 'data', 1, 1)
+            self.assertFalse(worker.is_alive())
+        finally:
+            worker.close()
+
+
+class ConcurrentRenderingTest(SimpleTestCase):
+
+    def test_concurrent_output_matches_serial(self):
+        from pdfgen import benchmark
+
+        with benchmark.BenchmarkEnvironment():
+            documents = benchmark.make_mixed_documents(6)
+            self.assertEqual(set(format for format, document in documents), set(benchmark.FORMATS))
+            self.assertEqual(benchmark.render_concurrently(documents, 4), [])
+
+
+class SharedAssetsTest(SimpleTestCase):
+
+    def test_images_save_no_bytes(self):
+        from pdfgen.assets import SharedAssets
+
+        assets = SharedAssets()
+        assets.assets = {
+            'image': ['image', 1000, 3, 'FormXob.image'],
+            'svg': ['svg', 100, 3, 'svg'],
+        }
+        report = assets.get_report()
+        self.assertEqual(report['image']['bytes_saved'], 0)
+        self.assertEqual(report['svg']['bytes_saved'], 200)
+        self.assertEqual(assets.bytes_saved(), 200)
+
+
+class FontRegistryTest(SimpleTestCase):
+
+    def test_retry_failed_fonts(self):
+        from pdfgen.fonts import FontRegistry
+        from pdfgen.loaders import FileSystemLoader
+
+        directory = os.path.join(os.path.dirname(__file__), 'test_templates')
+        registry = FontRegistry(retry_interval=0)
+        self.assertFalse(registry.register('missing', 'PdfgenTestMissing', FileSystemLoader(directory)))
+        self.assertTrue('PdfgenTestMissing' in registry.errors)
+
+        registry.retry_interval = 3600
+        loads = []
+        registry.load = lambda *args: loads.append(args)
+        self.assertFalse(registry.register('missing', 'PdfgenTestMissing'))
+        self.assertEqual(loads, [])
+
+        registry.retry_interval = 0
+        self.assertTrue(registry.register('missing', 'PdfgenTestMissing'))
+        self.assertEqual(len(loads), 1)
+        self.assertFalse('PdfgenTestMissing' in registry.errors)
+
+
+@override_settings(TEMPLATE_DIRS=(TEMPLATE_DIR,),
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalDownloadTest(SimpleTestCase):
+
+    def get_response(self, if_none_match=None):
+        from django.test.client import RequestFactory
+        from pdfgen.shortcuts import render_to_pdf_download
+
+        request = RequestFactory().get('/')
+        if if_none_match is not None:
+            request.META['HTTP_IF_NONE_MATCH'] = if_none_match
+        return render_to_pdf_download('footer.cltr', {'name': 'alice'}, cache_timeout=60, request=request)
+
+    def test_if_none_match(self):
+        etag = self.get_response()['ETag']
+        digest = etag.strip('"')
+
+        self.assertEqual(self.get_response(etag).status_code, 304)
+        self.assertEqual(self.get_response('"other", W/%s' % etag).status_code, 304)
+        self.assertEqual(self.get_response('*').status_code, 304)
+        self.assertEqual(self.get_response('"%sx"' % digest).status_code, 200)
+        self.assertEqual(self.get_response('"x%s"' % digest).status_code, 200)
+
+
+class JobBackendTestMixin(object):
+
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def submit(self, template_name):
+        from pdfgen.jobs import Job
+
+        return self.backend.submit(Job(template_name, {}))
+
+    def test_failed_job_output_removed(self):
+        from pdfgen.jobs import STATUS_FAILED, run_job
+
+        with override_settings(PDFGEN_JOB_SPOOL_DIR=self.directory, PDFGEN_JOB_BACKEND=self.backend_path):
+            job_id = self.submit('missing.cltr')
+            self.assertTrue(run_job(job_id))
+        self.assertEqual(self.backend.get_status(job_id), STATUS_FAILED)
+        self.assertFalse(os.path.exists(self.backend.get_output_path(job_id) + '.tmp'))
+
+    def test_fail_stale(self):
+        from pdfgen.jobs import STATUS_FAILED, STATUS_RUNNING
+
+        job_id = self.submit('footer.cltr')
+        self.assertTrue(self.backend.claim(job_id))
+        self.assertEqual(self.backend.fail_stale(3600), 0)
+        self.make_stale(job_id, 7200)
+        self.assertEqual(self.backend.fail_stale(3600), 1)
+        self.assertEqual(self.backend.get_status(job_id), STATUS_FAILED)
+        self.assertIn('3600 seconds', self.backend.get_error(job_id))
+
+        # the worker of a timed out job can't change its status anymore
+        self.backend.finish(job_id)
+        self.assertEqual(self.backend.get_status(job_id), STATUS_FAILED)
+
+
+class FileSystemJobBackendTest(JobBackendTestMixin, SimpleTestCase):
+    backend_path = 'pdfgen.jobs.FileSystemJobBackend'
+
+    def setUp(self):
+        from pdfgen.jobs import FileSystemJobBackend
+
+        JobBackendTestMixin.setUp(self)
+        self.backend = FileSystemJobBackend(self.directory)
+
+    def make_stale(self, job_id, age):
+        import time
+        from pdfgen.jobs import STATUS_RUNNING
+
+        started = time.time() - age
+        os.utime(self.backend.get_path(STATUS_RUNNING, job_id), (started, started))
+
+
+class DatabaseJobBackendTest(JobBackendTestMixin, TestCase):
+    backend_path = 'pdfgen.jobs.DatabaseJobBackend'
+
+    def setUp(self):
+        from pdfgen.jobs import DatabaseJobBackend
+
+        JobBackendTestMixin.setUp(self)
+        self.backend = DatabaseJobBackend(self.directory)
+
+    def make_stale(self, job_id, age):
+        import datetime
+        from pdfgen.models import PdfJob
+
+        PdfJob.objects.filter(pk=job_id).update(modified=datetime.datetime.now() - datetime.timedelta(seconds=age))
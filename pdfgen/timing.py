@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 needs the pytracemalloc backport
+    tracemalloc = None
+
+from pdfgen.signals import phase_finished
+
+logger = logging.getLogger('pdfgen')
+
+# the phases that are timed
+PHASE_TEMPLATE = 'template'
+PHASE_PARSE = 'parse'
+PHASE_BUILD = 'build'
+PHASE_BARCODE = 'barcode'
+PHASE_SVG = 'svg'
+
+_local = threading.local()
+
+
+def get_stack(name):
+    stack = getattr(_local, name, None)
+    if stack is None:
+        stack = []
+        setattr(_local, name, stack)
+    return stack
+
+
+def start_memory_tracing():
+    '''
+    Starts tracemalloc when PDFGEN_TRACE_MEMORY is set, returns whether
+    memory is traced
+    '''
+    from django.conf import settings
+
+    if tracemalloc is None:
+        return False
+    if getattr(settings, 'PDFGEN_TRACE_MEMORY', False) and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return tracemalloc.is_tracing()
+
+
+class Frame(object):
+    def __init__(self, phase):
+        self.phase = phase
+        self.memory_start = None
+        self.memory_peak = 0
+
+    def start_memory(self, frames):
+        current, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            # keep the peak so far for the enclosing phases before resetting it
+            for frame in frames:
+                frame.memory_peak = max(frame.memory_peak, peak)
+            tracemalloc.reset_peak()
+        self.memory_start = current
+
+    def stop_memory(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.memory_peak = max(self.memory_peak, peak)
+        return self.memory_peak - self.memory_start
+
+
+def record(phase, duration, memory_peak=None):
+    '''
+    Reports a phase that was timed by the caller, see timed
+    '''
+    logger.debug('%s took %.1f ms, memory peak %s bytes', phase, duration * 1000, memory_peak)
+    for timings in get_stack('collectors'):
+        timings.append((phase, duration, memory_peak))
+    phase_finished.send(sender=None, phase=phase, duration=duration, memory_peak=memory_peak)
+
+
+@contextmanager
+def timed(phase):
+    '''
+    Times the enclosed block as phase.
+
+    The duration and, when tracemalloc is tracing, the peak memory above the
+    memory in use at the start are logged to the 'pdfgen' logger, sent with the
+    phase_finished signal and added to the timings of collect_timings.
+    '''
+    frames = get_stack('frames')
+    frame = Frame(phase)
+    trace_memory = start_memory_tracing()
+    if trace_memory:
+        frame.start_memory(frames)
+
+    frames.append(frame)
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        frames.pop()
+        memory_peak = None
+        if trace_memory and tracemalloc.is_tracing():
+            memory_peak = frame.stop_memory()
+            if frames:
+                frames[-1].memory_peak = max(frames[-1].memory_peak, frame.memory_peak)
+
+        record(phase, duration, memory_peak)
+
+
+@contextmanager
+def collect_timings():
+    '''
+    Collects the (phase, duration, memory peak) tuples of the phases that are
+    timed in this thread within the block, in the list it yields
+    '''
+    collectors = get_stack('collectors')
+    timings = []
+    collectors.append(timings)
+    try:
+        yield timings
+    finally:
+        collectors.remove(timings)
+
+
+def format_server_timing(timings):
+    '''
+    Returns the value of a Server-Timing header for timings, the durations of
+    phases that were timed more than once are summed
+    '''
+    phases = []
+    durations = {}
+    for phase, duration, memory_peak in timings:
+        if phase not in durations:
+            phases.append(phase)
+            durations[phase] = 0.0
+        durations[phase] += duration
+    return ', '.join('%s;dur=%.1f' % (phase, durations[phase] * 1000) for phase in phases)
+
+
+def timer(phase):
+    '''
+    Decorator that times every call of the function as phase, see timed
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,5 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('pdfgen.views',
+    url(r'^jobs/(?P<job_id>[0-9a-f]+)/$', 'job_status', name='pdfgen_job'),
+)
@@ -0,0 +1,37 @@
+from django.core.exceptions import PermissionDenied
+from django.core.signing import BadSignature
+from django.http import HttpResponse, Http404
+
+from pdfgen import jobs
+from pdfgen.shortcuts import make_pdf_response
+
+
+def job_status(request, job_id):
+    '''
+    Returns the rendered PDF when the job is done. Otherwise it returns 202
+    while the job is pending or running, and 500 when the job failed. Only the
+    user or session that submitted the job can access it.
+    '''
+    status = jobs.get_status(job_id)
+    if status is None:
+        raise Http404
+
+    try:
+        job = jobs.get_job_backend().get_job(job_id)
+    except BadSignature:
+        raise Http404
+    if job is None:
+        # removed by the cleanup in the meantime
+        raise Http404
+    if not jobs.can_access(request, job):
+        raise PermissionDenied
+
+    if status == jobs.STATUS_DONE:
+        return make_pdf_response(job.filename, jobs.get_result(job_id))
+
+    response = HttpResponse(status, mimetype='text/plain')
+    if status == jobs.STATUS_FAILED:
+        response.status_code = 500
+    else:
+        response.status_code = 202
+    return response
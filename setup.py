@@ -11,6 +11,8 @@ setup(
     long_description=open('README.rst', 'r').read(),
     author='Jef Geskens, City Live nv',
     packages=find_packages('.'),
+    # StreamingHttpResponse and django.conf.urls
+    install_requires=['Django>=1.5'],
     #package_dir={'': 'templates/*'},
     classifiers=[
         'Intended Audience :: Developers',